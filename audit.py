@@ -0,0 +1,124 @@
+# Shadow auditing: a sample of finished boards is scored again by the exact engine, in a low priority worker
+# process, to see how far off the approximate (Monte-Carlo) scores that players got were.
+# Optionally tunes the approximate engine's iteration count from what it sees.
+import asyncio
+import multiprocessing
+import os
+import random
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import scoring
+from eventlog import events
+
+COLORS = ['B', 'G', 'Y']
+
+
+def lower_priority(nice):
+    os.nice(nice)
+    scoring.score(['rr', 'rr'], accurate=True)  # Compile Numba code before the first real board shows up
+
+
+def exact_score(board, budget):
+    t_start = time.monotonic()
+    return scoring.score(board, accurate=True, budget=budget), time.monotonic() - t_start
+
+
+class ShadowAuditor:
+    def __init__(self, sample=0.1, budget=50_000_000, workers=1, nice=19, tune=False, target_miss=0.02,
+                 iters=20_000, min_iters=2_000, max_iters=320_000, window=100):
+        self.sample = sample  # Share of finished games that get audited
+        self.budget = budget  # Exact engine search steps per color, it gives up on the color after that
+        self.workers = workers
+        self.nice = nice
+        self.executor = None  # Started on the first audit
+        self.backlog = 0
+
+        self.tune = tune
+        self.target_miss = target_miss  # Share of colors the approximate engine may under-report
+        self.iters = iters  # What the approximate engine should use, see tune
+        self.min_iters, self.max_iters = min_iters, max_iters
+        self.recent: deque[bool] = deque(maxlen=window)  # Did the approximate score find the snake, per audited color
+
+        self.audited, self.skipped, self.incomplete = 0, 0, 0
+        self.exact_time = 0.0
+        self.colors = {color: {'checked': 0, 'under': 0, 'over': 0, 'gap_sum': 0, 'max_under': 0, 'max_over': 0}
+                       for color in COLORS}
+
+    def offer(self, board, approx, iters):
+        """A game just ended with the approximate score approx, made with iters iterations. Maybe audit it."""
+        if self.sample <= 0 or random.random() >= self.sample:
+            return
+        if self.backlog >= 4 * self.workers:
+            self.skipped += 1  # Falling behind, the exact engine must not pile up work
+            return
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'),
+                                                initializer=lower_priority, initargs=(self.nice,))
+        self.backlog += 1
+        future = asyncio.get_event_loop().run_in_executor(self.executor, exact_score, board, self.budget)
+        future.add_done_callback(lambda fut: self.done(fut, approx, iters))
+
+    def done(self, future, approx, iters):
+        self.backlog -= 1
+        if future.cancelled() or future.exception() is not None:
+            events.error('audit', 'Audit failed: {error}',
+                         error=future.exception() if not future.cancelled() else 'cancelled')
+            return
+        exact, elapsed = future.result()
+        self.record(approx, exact, iters)
+        self.exact_time += elapsed
+
+    def record(self, approx, exact, iters):
+        self.audited += 1
+        for color in COLORS:
+            if exact[color] < 0:
+                self.incomplete += 1  # Out of budget, nothing to compare with
+                continue
+            gap = approx[color] - exact[color]
+            stats = self.colors[color]
+            stats['checked'] += 1
+            stats['gap_sum'] += gap
+            if gap < 0:
+                stats['under'] += 1
+                stats['max_under'] = max(stats['max_under'], -gap)
+            elif gap > 0:
+                stats['over'] += 1
+                stats['max_over'] = max(stats['max_over'], gap)
+            if iters == self.iters:  # Only what the current setting did says anything about it
+                self.recent.append(gap >= 0)  # Over-reporting is a bug, more iterations won't help with that
+        if any(approx[color] != exact[color] for color in COLORS if exact[color] >= 0):
+            events.info('audit', 'Audit: approximate {approx}, exact {exact}', approx=approx, exact=exact)
+        if self.tune:
+            self.tune_iters()
+
+    def miss_rate(self):
+        return self.recent.count(False) / len(self.recent) if len(self.recent) else 0.0
+
+    def tune_iters(self):
+        """More iterations while the approximate engine misses too often, fewer when it's comfortably right."""
+        if len(self.recent) < self.recent.maxlen // 4:
+            return
+        old = self.iters
+        if self.miss_rate() > self.target_miss:
+            self.iters = min(self.max_iters, self.iters * 2)
+        elif len(self.recent) == self.recent.maxlen and self.miss_rate() < self.target_miss / 4:
+            self.iters = max(self.min_iters, int(self.iters * 0.75))
+        if self.iters != old:
+            events.warn('audit', 'Audit: approximate scoring now does {iters} iterations (was {old}), '
+                        'missed {miss_rate:.1%} of colors', iters=self.iters, old=old, miss_rate=self.miss_rate())
+            self.recent.clear()
+
+    def stats(self):
+        return {
+            'audited': self.audited, 'skipped': self.skipped, 'incomplete': self.incomplete, 'backlog': self.backlog,
+            'exact_time': round(self.exact_time, 3), 'iters': self.iters, 'miss_rate': self.miss_rate(),
+            'colors': {color: {**{k: v for k, v in stats.items() if k != 'gap_sum'},
+                               'mean_gap': stats['gap_sum'] / stats['checked'] if stats['checked'] else 0.0}
+                       for color, stats in self.colors.items()},
+        }
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,191 @@
+# Server benchmarks over transport's in-memory loopback: the whole message path (parse, dispatch, game state,
+# fan-out) with no sockets or ports in the way, so the numbers repeat from run to run and commit to commit.
+# positions: one client asking over and over, the plain request-reply path
+# curpos: cursor moves in a full room, until every player got the update
+# game: lots of rooms playing whole games at once, a put until every player has the new positions, scoring included
+# python bench_server.py
+# python bench_server.py --rooms 50 --json bench.json --max-p95 5 --max-p99 250
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+from collections import deque
+
+import scoring
+import server
+import transport
+from eventlog import LEVELS, events
+
+UNLIMITED = {cmd: (1e9, 10 ** 9) for cmd in server.DEFAULT_RATE_LIMITS}  # Rate limiting is not what we measure
+
+
+class BenchClient:
+    """Talks raw JSON over the loopback. Waiters get the next message of the command they wait for."""
+    def __init__(self, ws):
+        self.ws = ws
+        self.waiters: dict[str, deque[asyncio.Future]] = {}
+        self.received = 0
+        self.positions = []
+        self.you = None
+        self.reader = asyncio.ensure_future(self.read())
+
+    async def read(self):
+        async for raw in self.ws:
+            msg = json.loads(raw)
+            self.received += 1
+            if msg['cmd'] == 'positions':
+                self.positions = msg['positions']
+            elif msg['cmd'] == 'you':
+                self.you = msg['you']
+            waiting = self.waiters.get(msg['cmd'])
+            if waiting:
+                waiting.popleft().set_result(msg)
+
+    def expect(self, cmd):
+        fut = asyncio.get_event_loop().create_future()
+        self.waiters.setdefault(cmd, deque()).append(fut)
+        return fut
+
+    async def send(self, msg):
+        await self.ws.send(json.dumps(msg))
+
+    async def request(self, msg, reply):
+        fut = self.expect(reply)
+        await self.send(msg)
+        return await fut
+
+    async def close(self):
+        await self.ws.close()
+        self.reader.cancel()
+
+
+async def join(address, game_id, players):
+    clients = []
+    for _ in range(players):
+        c = BenchClient(await transport.connect(address))
+        await c.request({'cmd': 'room', 'game_id': game_id}, 'descriptions')
+        clients.append(c)
+    return clients
+
+
+async def bench_positions(address, n):
+    c, = await join(address, 'positions', 1)
+    latencies = []
+    for _ in range(n):
+        t = time.perf_counter()
+        await c.request({'cmd': 'positions'}, 'positions')
+        latencies.append(time.perf_counter() - t)
+    await c.close()
+    return latencies, n * 2
+
+
+async def bench_curpos(address, n, players):
+    clients = await join(address, 'curpos', players)
+    rng = random.Random(1)
+    latencies = []
+    for k in range(n):
+        sender = clients[k % players]
+        everyone = [c.expect('player_data') for c in clients]
+        t = time.perf_counter()
+        await sender.send({'cmd': 'curpos', 'curpos': [rng.randint(0, 800), rng.randint(0, 800)]})
+        await asyncio.gather(*everyone)
+        latencies.append(time.perf_counter() - t)
+    for c in clients:
+        await c.close()
+    return latencies, n * (1 + players)
+
+
+async def play_room(address, game_id, players, seed, latencies):
+    clients = await join(address, game_id, players)
+    rng = random.Random(seed)
+    positions = clients[-1].positions  # Whoever joined last has seen them after everyone joined
+    over = [c.expect('game_over') for c in clients]
+    msgs, turn = 0, 0
+    while True:
+        free = [i for i, p in enumerate(positions) if p['type'] != 'board']
+        taken = {(p['ii'], p['uu']) for p in positions if p['type'] == 'board'}
+        cells = [(i, u) for i in range(5) for u in range(7) if (i, u) not in taken]
+        if not free or not cells:
+            break  # Same as Game.is_game_over
+        cur = clients[turn % players]  # Turns go around in joining order
+        everyone = [c.expect('positions') for c in clients]  # Nobody has a stale one queued up after this
+        t = time.perf_counter()
+        await cur.send({'cmd': 'put', 'idx': rng.choice(free), 'pos': rng.choice(cells), 'rot': rng.randint(0, 3)})
+        positions = (await asyncio.wait_for(asyncio.gather(*everyone), 5.0))[0]['positions']
+        latencies.append(time.perf_counter() - t)
+        msgs += 2 + players  # The put, its "Placement successful", positions for everyone
+        turn += 1
+    await asyncio.wait_for(asyncio.gather(*over), 5.0)
+    for c in clients:
+        await c.close()
+    return msgs + players
+
+
+async def bench_game(address, rooms, players):
+    latencies = []
+    msgs = await asyncio.gather(*[play_room(address, f'game{r}', players, r, latencies) for r in range(rooms)])
+    return latencies, sum(msgs)
+
+
+def summarize(name, latencies, msgs, elapsed):
+    latencies = sorted(latencies)
+    ps = {f'p{q}': 1000 * latencies[min(len(latencies) - 1, int(len(latencies) * q / 100))] for q in [50, 95, 99]}
+    return {'scenario': name, 'requests': len(latencies), 'msgs': msgs, 'seconds': round(elapsed, 4),
+            'msgs_per_s': msgs / max(elapsed, 1e-9), **ps, 'max': 1000 * latencies[-1]}
+
+
+def print_result(r):
+    print(f"{r['scenario']:<10}{r['requests']:>8}{r['msgs_per_s']:>12.0f}"
+          + ''.join(f'{r[q]:9.3f}' for q in ['p50', 'p95', 'p99', 'max']))
+
+
+async def main(args):
+    random.seed(args.seed)  # The server deals pieces with the global one
+    events.configure(level=LEVELS[args.log_level])
+    s = server.Server(rate_limits=UNLIMITED, room_pool=args.rooms + 2, lobby_tick=1.0)
+    s.rooms.fill()
+    loop = transport.LoopbackServer(s.listen_socket, name='bench')
+    scenarios = {
+        'positions': lambda: bench_positions(loop.address, args.n),
+        'curpos': lambda: bench_curpos(loop.address, args.n, args.players),
+        'game': lambda: bench_game(loop.address, args.rooms, args.players),
+    }
+    print(f"{'scenario':<10}{'requests':>8}{'msgs/s':>12}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9} ms")
+    results = []
+    for name in args.scenarios:
+        t = time.perf_counter()
+        latencies, msgs = await scenarios[name]()
+        results.append(summarize(name, latencies, msgs, time.perf_counter() - t))
+        print_result(results[-1])
+    await loop.close()
+    events.close()
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    failed = False
+    for q, limit in [('p95', args.max_p95), ('p99', args.max_p99)]:
+        slow = [r['scenario'] for r in results if limit is not None and r[q] > limit]
+        if slow:
+            print(f'Latency {q} over {limit} ms: {", ".join(slow)}')
+            failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scenarios', default=['positions', 'curpos', 'game'], nargs='+',
+                        choices=['positions', 'curpos', 'game'])
+    parser.add_argument('-n', default=2000, type=int, help='Requests in the positions and curpos scenarios')
+    parser.add_argument('--players', default=4, type=int, help='Players per room')
+    parser.add_argument('--rooms', default=20, type=int, help='Rooms playing at once in the game scenario')
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('--log-level', default='warn', choices=list(LEVELS.keys()))
+    parser.add_argument('--json', default=None, help='Write the results here too')
+    parser.add_argument('--max-p95', default=None, type=float, help='Fail (exit code 1) if any p95 is over this, ms')
+    parser.add_argument('--max-p99', default=None, type=float,
+                        help='Same for p99, where stalls like end-of-game scoring show up')
+    args = parser.parse_args()
+    scoring.score(['rr', 'rr'])  # Compile Numba code, not what we measure either
+    sys.exit(asyncio.run(main(args)))
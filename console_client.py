@@ -1,25 +1,46 @@
 # https://mortoray.com/high-throughput-game-message-server-with-python-websockets/
 # TODO: Thread safety, locks? What's that?
 # TODO: No exception handling, speedrun coding mode let's goo
+# Scripted mode, for probing a server from cron and such (no replies are waited for, latencies are printed at the end):
+# echo "repeat 50 ping" | python console_client.py --server example.org --script - --interval 0.1
+# Many rooms over one connection: "ch a", "room 1", "ch b", "watch 2". Replies about a channel come prefixed with it.
 
+import argparse
 import asyncio
 import json
-import websockets
+import sys
+import time
 
+import transport
 from constants import DEFAULT_PORT, GAME_VERSION
 
 
+def rotate_piece(d, times=1):
+    # Counter-clockwise, same as the server
+    for _ in range(times % 4):
+        d = d[1] + d[3] + d[0] + d[2]
+    return d
+
+
 class Client:
     def __init__(self, websocket):
         self.websocket = websocket
+        self.ch = None  # Channel commands go to, None for the connection itself
+        self.rooms = {}  # Channel -> (descriptions, h, w) of the room it is in
 
     async def send_stuff(self, msg):
+        if self.ch is not None:
+            msg = {**msg, 'ch': self.ch}
         await self.websocket.send(json.dumps(msg))
 
     async def cmd(self, cmd):
         match cmd[0]:
             case 'room':
                 await self.send_stuff({'cmd': 'room', 'game_id': cmd[1]})
+            case 'watch':
+                await self.send_stuff({'cmd': 'spectate', 'game_id': cmd[1]})
+            case 'unwatch':
+                await self.send_stuff({'cmd': 'unwatch'})
             case 'positions':
                 await self.send_stuff({'cmd': 'positions'})
             case 'descriptions':
@@ -29,11 +50,39 @@ class Client:
                                        'idx': int(cmd[1]), 'pos': (int(cmd[2]), int(cmd[3])), 'rot': int(cmd[4])})
             case 'op':
                 await self.send_stuff({'cmd': 'op', 'token': cmd[1]})
+            case 'ping':
+                await self.send_stuff({'cmd': 'ping', 't': time.perf_counter()})
+            case 'violations':
+                await self.send_stuff({'cmd': 'violations'})
+            case 'audit':
+                await self.send_stuff({'cmd': 'audit'})
+            case 'lobby':
+                await self.send_stuff({'cmd': 'lobby', 'filter': cmd[1] if len(cmd) > 1 else 'all',
+                                       'page': int(cmd[2]) if len(cmd) > 2 else 0})
+            case 'ch':
+                self.ch = cmd[1] if len(cmd) > 1 and cmd[1] != '-' else None
+            case 'leave':
+                await self.send_stuff({'cmd': 'leave'})
+                self.rooms.pop(self.ch, None)
+                self.ch = None
+            case 'profile':
+                await self.send_stuff({'cmd': 'profile', 'mode': cmd[1] if len(cmd) > 1 else 'cpu',
+                                       'seconds': float(cmd[2]) if len(cmd) > 2 else 10.0,
+                                       'file': len(cmd) > 3 and cmd[3] == 'file'})
             case 'help':
                 print('room <n>\n'
+                      'watch <n>\n'
+                      'unwatch\n'
                       'positions\n'
                       'descriptions\n'
-                      'put <piece_idx> <pos_h> <pos_w> <rotation>')
+                      'put <piece_idx> <pos_h> <pos_w> <rotation>\n'
+                      'ping\n'
+                      'lobby [all|playing|empty|fresh] [page]\n'
+                      'ch <name>  (following commands go to that channel, - for none)\n'
+                      'leave  (the current channel)\n'
+                      'profile <cpu|memory> <seconds> [file]  (op only)\n'
+                      'violations  (op only)\n'
+                      'audit  (op only)')
 
     async def command_loop(self):
         async def async_input():
@@ -43,9 +92,12 @@ class Client:
             await self.cmd(cmd.split(' '))
 
     async def process_message(self, msg):
+        ch = msg.get('ch')
+        tag = f'[{ch}] ' if ch is not None else ''
         match msg['cmd']:  # Do you feel the déjà vu?
             case 'descriptions':
-                print()
+                self.rooms[ch] = (msg['descriptions'], msg.get('h', 5), msg.get('w', 7))
+                print(tag)
                 pieces = msg['descriptions']
                 for chunk_offset in range(0, len(pieces), 8):
                     chunk = pieces[chunk_offset:chunk_offset + 8]
@@ -59,31 +111,192 @@ class Client:
                     print()
                 print()
             case 'positions':
-                print('Parsing of positions message is not implemented...')
+                self.print_positions(msg['positions'], ch)
+            case 'profile':
+                print(f"Profile written to {msg['path']} on the server" if 'path' in msg else msg['report'])
+            case 'audit':
+                a = msg['audit']
+                print(f"Audited {a['audited']} games ({a['skipped']} skipped, {a['incomplete']} colors out of budget), "
+                      f"approximate scoring misses {a['miss_rate']:.1%} at {a['iters']} iterations")
+                for color, st in a['colors'].items():
+                    print(f"  {color}: {st['checked']} checked, {st['under']} under (max {st['max_under']}), "
+                          f"{st['over']} over (max {st['max_over']}), mean gap {st['mean_gap']:+.2f}")
+            case 'violations':
+                if not msg['violations']:
+                    print('Nobody broke any rate limits')
+                for sid, counts in msg['violations'].items():
+                    print(f"  {sid}: " + ', '.join(f'{cmd} {n}' for cmd, n in sorted(counts.items())))
+            case 'lobby':
+                print(f"{tag}Rooms ({msg['filter']}), page {msg['page'] + 1} of {msg['pages']}, {msg['total']} in total")
+                for room in msg['rooms']:
+                    print(f"  {room['game_id']:<24} {room['players']} playing, {room['spectators']} watching, "
+                          f"{room['placed']}/{room['pieces']} placed, idle {room['idle']:.0f}s")
+            case 'pong':
+                print(f"{tag}pong in {1000 * (time.perf_counter() - msg['t']):.1f} ms")
+            case 'frame':
+                pass  # Spectator frames, nothing to print
             case 'game_over':
-                print(f"The game is over!"
+                print(f"{tag}The game is over!"
                       f"Your team got {msg['score']['total']} points.")
             case 'msg':
-                print(msg['msg'])
+                print(tag + msg['msg'])
             case 'version':
                 assert msg['version'] == GAME_VERSION
             case 'op':
                 print('Made you a server administrator.' if msg['status'] else
                       'The provided token is incorrect. This incident will be reported.')
 
+    def print_positions(self, positions, ch=None):
+        """The board, every cell as the two rows of its (rotated) piece, then the free pieces."""
+        descriptions, h, w = self.rooms.get(ch, ([], 5, 7))
+        rows = [['..'] * w for _ in range(2 * h)]
+        if ch is not None:
+            print(f'\n[{ch}]', end='')
+        free = []
+        for idx, pos in enumerate(positions):
+            if pos['type'] == 'board':
+                desc = rotate_piece(descriptions[idx], pos['r']) if idx < len(descriptions) else '????'
+                rows[2 * pos['ii']][pos['uu']] = desc[0:2]
+                rows[2 * pos['ii'] + 1][pos['uu']] = desc[2:4]
+            else:
+                free.append(str(idx) + (f"r{pos['r'] % 4}" if pos['r'] % 4 else ''))
+        print()
+        print('   ' + ''.join(str(u).ljust(3) for u in range(w)))
+        for r, row in enumerate(rows):
+            print((str(r // 2) if r % 2 == 0 else '').ljust(3) + ' '.join(row))
+        print(f"Free: {', '.join(free) if free else 'none'}")
+        print()
+
     async def reader(self, websocket):
         async for message_raw in websocket:
             msg = json.loads(message_raw)
             await self.process_message(msg)
 
 
-async def hello():
-    where = input('Enter ip: ')
+class Probe(Client):
+    """Non-interactive client. Sends a script's commands back to back, never waiting for replies,
+    and times each command until the reply that answers it."""
+    # What answers what. The server puts the command's id on everything it sends back while handling it,
+    # so the first one of the right kind with that id is the answer
+    REPLIES = {'room': 'positions', 'spectate': 'descriptions', 'positions': 'positions', 'descriptions': 'descriptions',
+               'put': 'positions', 'op': 'op', 'ping': 'pong', 'violations': 'violations', 'profile': 'profile',
+               'audit': 'audit', 'lobby': 'lobby'}
+
+    def __init__(self, websocket, verbose=False):
+        super().__init__(websocket)
+        self.verbose = verbose
+        self.next_id = 0
+        self.pending: dict[int, tuple[str, float]] = {}  # Id -> (cmd, sent at)
+        self.sent: dict[str, int] = {}
+        self.rtts: dict[str, list[float]] = {}
+        self.failed: dict[str, int] = {}
+        self.all_answered = asyncio.Event()
+        self.all_answered.set()
+
+    async def send_stuff(self, msg):
+        self.next_id += 1
+        msg = {**msg, 'id': self.next_id}  # The server sends it back with the replies, and with errors in 'yours'
+        if msg['cmd'] in self.REPLIES:
+            self.pending[self.next_id] = (msg['cmd'], time.perf_counter())
+            self.sent[msg['cmd']] = self.sent.get(msg['cmd'], 0) + 1
+            self.all_answered.clear()
+        await super().send_stuff(msg)
+
+    def answered(self, msg_id, ok):
+        cmd, t = self.pending.pop(msg_id)
+        if ok:
+            self.rtts.setdefault(cmd, []).append(time.perf_counter() - t)
+        else:
+            self.failed[cmd] = self.failed.get(cmd, 0) + 1
+        if len(self.pending) == 0:
+            self.all_answered.set()
+
+    async def process_message(self, msg):
+        yours = msg.get('yours')
+        if isinstance(yours, dict) and yours.get('id') in self.pending:
+            self.answered(yours['id'], ok=False)  # Erroneous command, or slowed down
+        elif msg.get('id') in self.pending and msg['cmd'] == self.REPLIES[self.pending[msg['id']][0]]:
+            self.answered(msg['id'], ok=True)
+        if self.verbose:
+            await super().process_message(msg)
+
+    async def wait(self, timeout):
+        try:
+            await asyncio.wait_for(self.all_answered.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def run_script(self, lines, interval=0.0, timeout=5.0):
+        """Lines are console commands, plus: sleep <seconds>, wait (for the replies so far), repeat <n> <command>."""
+        async for line in lines:
+            cmd = line.strip().split(' ')
+            if cmd[0] == '' or cmd[0].startswith('#'):
+                continue
+            times = 1
+            if cmd[0] == 'repeat':
+                times, cmd = int(cmd[1]), cmd[2:]
+            for _ in range(times):
+                match cmd[0]:
+                    case 'sleep':
+                        await asyncio.sleep(float(cmd[1]))
+                    case 'wait':
+                        await self.wait(timeout)
+                    case _:
+                        await self.cmd(cmd)
+                if interval > 0:
+                    await asyncio.sleep(interval)
+        await self.wait(timeout)
+
+    def summary(self):
+        """Prints latency percentiles per command. True if everything got answered fine."""
+        lost = {}
+        for cmd, _ in self.pending.values():
+            lost[cmd] = lost.get(cmd, 0) + 1
+        print(f"{'cmd':<14}{'sent':>6}{'ok':>6}{'failed':>7}{'lost':>6}{'p50':>9}{'p90':>9}{'p99':>9}{'max':>9} ms")
+        for cmd, sent in self.sent.items():
+            rtts = sorted(self.rtts.get(cmd, []))
+            if rtts:
+                ps = [rtts[min(len(rtts) - 1, int(len(rtts) * q))] for q in [0.5, 0.9, 0.99]] + [rtts[-1]]
+                ps_text = ''.join(f'{1000 * p:9.2f}' for p in ps)
+            else:
+                ps_text = f"{'-':>9}" * 4
+            print(f'{cmd:<14}{sent:>6}{len(rtts):>6}{self.failed.get(cmd, 0):>7}{lost.get(cmd, 0):>6}' + ps_text)
+        return len(lost) == 0 and len(self.failed) == 0
+
+
+async def script_lines(path):
+    f = sys.stdin if path == '-' else open(path)
+    while True:
+        line = await asyncio.to_thread(f.readline)  # Pipes may take their time
+        if not line:
+            break
+        yield line
+
+
+async def probe(where, script, interval, timeout, verbose):
+    async with transport.connect(where) as websocket:
+        c = Probe(websocket, verbose)  # No version of our own: the server has no handler for it, it sends its own
+        reader_task = asyncio.ensure_future(c.reader(websocket))
+        t_start = time.perf_counter()
+        await c.run_script(script_lines(script), interval, timeout)
+        reader_task.cancel()
+    print(f'Ran the script against {where} in {time.perf_counter() - t_start:.2f}s')
+    return 0 if c.summary() else 1
+
+
+def server_address(where):
     if where == 'l':
         where = '127.0.0.1'
     if ':' not in where:
         where = f'{where}:{DEFAULT_PORT}'
-    async with websockets.connect(f"ws://{where}") as websocket:
+    return where
+
+
+async def hello(where=None):
+    if where is None:
+        where = input('Enter ip: ')
+    where = server_address(where)
+    async with transport.connect(where) as websocket:
         c = Client(websocket)
         await c.send_stuff({'cmd': 'version', 'version': GAME_VERSION})
         reader_task = asyncio.ensure_future(c.reader(websocket))
@@ -95,4 +308,14 @@ async def hello():
 
 
 if __name__ == '__main__':
-    asyncio.get_event_loop().run_until_complete(hello())
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--server', default=None, help='host[:port], asked for if not given')
+    parser.add_argument('--script', default=None, help='Run these commands instead of asking for them, - for stdin')
+    parser.add_argument('--interval', default=0.0, type=float, help='Seconds between scripted commands')
+    parser.add_argument('--timeout', default=5.0, type=float, help='How long to wait for the last replies')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Print the replies in scripted mode too')
+    args = parser.parse_args()
+    if args.script is not None:
+        sys.exit(asyncio.run(probe(server_address(args.server or 'l'), args.script, args.interval, args.timeout,
+                                   args.verbose)))
+    asyncio.get_event_loop().run_until_complete(hello(args.server))
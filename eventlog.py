@@ -0,0 +1,133 @@
+# Server log that never makes the event loop wait. log() only checks level, sampling and rate limits and puts
+# a tuple on a queue; a thread formats the message and does the actual (possibly slow) writing.
+# from eventlog import events; events.info('put', '{sid} Put piece', sid=sid)
+import atexit
+import json
+import queue
+import sys
+import threading
+import time
+
+DEBUG, INFO, WARN, ERROR = 10, 20, 30, 40
+LEVELS = {'debug': DEBUG, 'info': INFO, 'warn': WARN, 'error': ERROR}
+LEVEL_NAMES = {v: k.upper() for k, v in LEVELS.items()}
+
+_STOP = object()
+
+
+class EventLog:
+    def __init__(self, level=INFO, samples=None, limits=None, stream=None, as_json=False, max_queue=10_000):
+        self.thread = None
+        self.queue = queue.SimpleQueue()
+        self.lock = threading.Lock()  # For dropped, both threads touch it
+        self.configure(level, samples, limits, stream, as_json, max_queue)
+
+    def configure(self, level=INFO, samples=None, limits=None, stream=None, as_json=False, max_queue=10_000):
+        """samples: event -> keep 1 in N. limits: event -> most records per second, '*' for every other event."""
+        self.level = level
+        self.samples = samples or {}
+        self.limits = limits or {}
+        self.stream = stream
+        self.as_json = as_json
+        self.max_queue = max_queue
+        self.seen: dict[str, int] = {}  # Event -> times logged at an enabled level, for sampling
+        self.window: dict[str, list] = {}  # Event -> [second, records in it, records suppressed in it]
+        with self.lock:
+            self.dropped = 0  # Writer thread fell behind
+
+    def log(self, level, event, msg, **fields):
+        """msg is a str.format template over fields, it gets formatted on the writer thread."""
+        if level < self.level:
+            return
+        every = self.samples.get(event)
+        if every is not None:
+            n = self.seen.get(event, 0)
+            self.seen[event] = n + 1
+            if n % every:
+                return
+        limit = self.limits.get(event, self.limits.get('*'))
+        if limit is not None:
+            now = int(time.monotonic())
+            w = self.window.get(event)
+            if w is None or w[0] != now:
+                if w is not None and w[2]:
+                    self.put((time.time(), WARN, event, '{suppressed} more {event} records in the last second',
+                              {'suppressed': w[2], 'event': event}))
+                w = self.window[event] = [now, 0, 0]
+            if w[1] >= limit:
+                w[2] += 1
+                return
+            w[1] += 1
+        self.put((time.time(), level, event, msg, fields))
+
+    def put(self, record, force=False):
+        if self.queue.qsize() >= self.max_queue and not force:
+            with self.lock:
+                self.dropped += 1
+            return
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.write_loop, name='eventlog', daemon=True)
+            self.thread.start()
+        self.queue.put(record)
+
+    def debug(self, event, msg, **fields):
+        self.log(DEBUG, event, msg, **fields)
+
+    def info(self, event, msg, **fields):
+        self.log(INFO, event, msg, **fields)
+
+    def warn(self, event, msg, **fields):
+        self.log(WARN, event, msg, **fields)
+
+    def error(self, event, msg, **fields):
+        self.log(ERROR, event, msg, **fields)
+
+    def always(self, event, msg, **fields):
+        """Goes out whatever level, sampling and limits say, for the few lines somebody has to see."""
+        self.put((time.time(), WARN, event, msg, fields), force=True)
+
+    def format(self, record):
+        t, level, event, msg, fields = record
+        try:
+            text = msg.format(**fields)
+        except (KeyError, IndexError, ValueError):
+            text = msg
+        if self.as_json:
+            return json.dumps({'t': round(t, 3), 'level': LEVEL_NAMES.get(level, level), 'event': event,
+                               'msg': text, **fields}, default=str)
+        return f'{time.strftime("%H:%M:%S", time.localtime(t))} {LEVEL_NAMES.get(level, level):<5} {text}'
+
+    def write_loop(self):
+        stopping = False
+        while not stopping:
+            record = self.queue.get()
+            stream = self.stream or sys.stdout
+            while True:
+                if record is _STOP:
+                    stopping = True
+                    break
+                try:
+                    stream.write(self.format(record) + '\n')
+                except Exception:
+                    pass  # Nowhere left to complain to
+                try:
+                    record = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            with self.lock:
+                dropped, self.dropped = self.dropped, 0
+            if dropped:
+                stream.write(self.format((time.time(), WARN, 'log', 'Log fell behind, dropped {n} records',
+                                          {'n': dropped})) + '\n')
+            stream.flush()  # Once per burst, not per line
+
+    def close(self):
+        """Writes out whatever is queued. Logging after this starts a new writer thread."""
+        if self.thread is not None:
+            self.queue.put(_STOP)
+            self.thread.join()
+            self.thread = None
+
+
+events = EventLog()
+atexit.register(events.close)  # Daemon thread, it would get killed with lines still queued
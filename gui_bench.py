@@ -0,0 +1,134 @@
+# Headless render benchmark. Drives GamingPhase.draw under SDL's dummy video driver, no window needed.
+# Feeds it a made-up game (lots of players wiggling cursors, board filling up) or a replay file,
+# and prints frame time percentiles for every render stage, for both render engines.
+# python gui_bench.py --players 8 --frames 1000
+# python gui_bench.py --replay game.fsqr --json bench.json --max-p95 8
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import sys
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+import pygame
+
+from gui_client import FrameProfiler, GamingPhase, PieceAtlas, RenderEngine, TextureProvider
+from replay import ReplayReader
+from server import Game
+
+
+def synthetic_frames(players, frames, seed=0, put_every=5):
+    """Messages a client gets during a made-up game, a list per frame.
+    Every cursor moves every frame, a piece goes on the board every few frames until it's full."""
+    rng = random.Random(seed)
+    g = Game(rng=rng)
+    for p in range(players):
+        g.add_player(f'bench{p}')
+    yield [{'cmd': 'you', 'you': g.players[0]},
+           {'cmd': 'descriptions', 'descriptions': g.p_descriptions, 'h': g.h, 'w': g.w},
+           {'cmd': 'positions', 'positions': [x.__dict__() for x in g.p_positions]}]
+    for frame in range(frames):
+        for k, player in enumerate(g.players):
+            a = frame / 20 + k * 2 * math.pi / players
+            g.player_data[player]['curpos'] = [int(400 + 300 * math.cos(a)), int(400 + 300 * math.sin(a * 1.3))]
+        msgs = [{'cmd': 'player_data', 'player_data': json.loads(json.dumps(g.player_data)),
+                 'cur_player': g.cur_player}]
+        if frame % put_every == 0 and not g.is_game_over():
+            free = [i for i, p in enumerate(g.p_positions) if p.type != 'board']
+            cells = [(i, u) for i in range(g.h) for u in range(g.w) if not g.occupied[i][u]]
+            g.put_piece(rng.choice(free), rng.choice(cells), rng.randint(0, 3), g.cur_player)
+            msgs.append({'cmd': 'positions', 'positions': [x.__dict__() for x in g.p_positions]})
+        yield msgs
+
+
+def replay_frames(path):
+    """A replay, every message is a frame."""
+    reader = ReplayReader(path)
+    for msg in reader.messages():
+        yield [msg]
+    reader.close()
+
+
+async def bench(frames, re, warmup=30):
+    screen = pygame.display.set_mode((800, 800))
+    tp = TextureProvider()
+    phase = GamingPhase(None, tp, PieceAtlas(tp), spectating=True)
+    phase.re = re
+    phase.profiler = FrameProfiler(history=None)
+    n = 0
+    for msgs in frames:
+        for msg in msgs:
+            await phase.process_message(msg)
+            phase.profiler.count('msgs')
+        phase.profiler.lap('prep')
+        dirty = phase.draw(screen)
+        if dirty is None:
+            pygame.display.flip()
+        else:
+            pygame.display.update(dirty)
+        phase.profiler.lap('present')
+        phase.profiler.end_frame()
+        await asyncio.sleep(0)  # Atlas prewarming runs in between, like it does in the game
+        n += 1
+        if n == warmup:
+            phase.profiler.frames.clear()  # Textures are loaded and pieces are in the atlas by now
+            phase.atlas.hits, phase.atlas.misses = 0, 0
+    p = phase.profiler
+    lookups = phase.atlas.hits + phase.atlas.misses
+    return {
+        'engine': re.name,
+        'frames': len(p.frames),
+        'stages': {stage: dict(zip(['p50', 'p95', 'p99'], p.percentiles(stage))) for stage in p.stages()},
+        'max_ms': 1000 * max((frame['frame'] for frame in p.frames), default=0.0),
+        'msgs_per_frame': sum(frame.get('#msgs', 0) for frame in p.frames) / max(len(p.frames), 1),
+        'atlas_hit_rate': phase.atlas.hits / lookups if lookups else 1.0,
+    }
+
+
+def print_result(result):
+    print(f'{result["engine"]}: {result["frames"]} frames, {result["msgs_per_frame"]:.1f} msgs/frame, '
+          f'atlas hit rate {result["atlas_hit_rate"]:.1%}, worst frame {result["max_ms"]:.2f} ms')
+    print(f'  {"stage":<8}{"p50":>8}{"p95":>8}{"p99":>8} ms')
+    for stage, ps in result['stages'].items():
+        print(f'  {stage:<8}' + ''.join(f'{ps[q]:8.2f}' for q in ['p50', 'p95', 'p99']))
+
+
+async def main(args):
+    pygame.init()
+    results = []
+    for engine in args.engines:
+        if args.replay is not None:
+            frames = replay_frames(args.replay)
+        else:
+            frames = synthetic_frames(args.players, args.frames, args.seed)
+        result = await bench(frames, RenderEngine[engine], args.warmup)
+        print_result(result)
+        results.append(result)
+    pygame.quit()
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.max_p95 is not None:
+        slow = [r['engine'] for r in results if r['stages']['frame']['p95'] > args.max_p95]
+        if slow:
+            print(f'Frame time p95 over {args.max_p95} ms: {", ".join(slow)}')
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--replay', default=None, help='Replay file to draw instead of a made-up game')
+    parser.add_argument('--players', default=6, type=int)
+    parser.add_argument('--frames', default=600, type=int)
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('--warmup', default=30, type=int, help='Frames left out of the stats')
+    parser.add_argument('--engines', default=['GEMS', 'SIMPLE'], nargs='+', choices=[e.name for e in RenderEngine])
+    parser.add_argument('--json', default=None, help='Write the results here too')
+    parser.add_argument('--max-p95', default=None, type=float, help='Fail (exit code 1) if frame time p95 is over this, ms')
+    args = parser.parse_args()
+    sys.exit(asyncio.run(main(args)))
@@ -1,28 +1,54 @@
-# python -m nuitka --include-package=pygame,websockets,pyperclip --nofollow-import-to=numpy,pygame.tests,pygame.examples --include-data-files=res/*=res/ --windows-icon-from-ico=res/green_tile.png --linux-icon=res/green_tile.png --standalone --onefile --disable-console --report=gui_client.report.txt gui_client.py
+# python pack_res.py && python -m nuitka --include-package=pygame,websockets,pyperclip --nofollow-import-to=numpy,pygame.tests,pygame.examples --include-data-files=res.fsqb=res.fsqb --windows-icon-from-ico=res/green_tile.png --linux-icon=res/green_tile.png --standalone --onefile --disable-console --report=gui_client.report.txt gui_client.py
 from __future__ import annotations
 import asyncio
+import io
 import json
 import math
+import mmap
 import os.path
 import random
+import struct
 import time
+from collections import OrderedDict, deque
 from enum import Enum
 
 import pygame
 import websockets
 
+import transport
 from constants import DEFAULT_PORT, GAME_VERSION
+from replay import ReplayConnector
 
 def res_path(res_name):
     return os.path.dirname(os.path.abspath(__file__)) + '/res/' + res_name
 
+
+BUNDLE_PATH = os.path.dirname(os.path.abspath(__file__)) + '/res.fsqb'  # Made by pack_res.py
+BUNDLE_MAGIC = b'FSQB1\n'
+
 class Connector:
-    def __init__(self):
+    RECONNECT_ATTEMPTS = 6
+
+    def __init__(self, on_message=None):
         self.websocket = None
+        self.where = None
+        self.token = None  # Session token, lets us get our seat back after a drop
+        self.last_seq = 0
+        self.room = None
+        self.inbox: asyncio.Queue = asyncio.Queue()  # Decoded messages, waiting for the next frame
+        self.receiver = None
+        self.on_message = on_message  # Called whenever something arrives, to wake up the frame scheduler
 
     async def send(self, msg):
-        assert self.websocket is not None
-        await self.websocket.send(json.dumps(msg))
+        assert self.where is not None
+        if msg['cmd'] == 'room':
+            self.room = msg['game_id']
+        if self.websocket is None:
+            return  # Reconnecting, this one is lost
+        try:
+            await self.websocket.send(json.dumps(msg))
+        except websockets.exceptions.ConnectionClosed:
+            pass  # messages() will deal with it
 
     async def activate(self, where):
         await self.deactivate()
@@ -30,56 +56,168 @@ class Connector:
             where = '127.0.0.1'  # 'localhost' does not work for Windows
         if ':' not in where:
             where = f'{where}:{DEFAULT_PORT}'
-        self.websocket = await websockets.connect(f"ws://{where}", open_timeout=1.0)
-        ts = time.monotonic()
-        ok = False
-        while time.monotonic() - ts < 1.0:
-            if ok:
-                break
-            async for msg in self.messages():
-                if msg['cmd'] == 'version':
-                    if msg['version'] != GAME_VERSION:  # Strict, can relax in the future
-                        await self.websocket.close()
-                        raise Exception('Server and client versions do not match.')
-                    else:
-                        ok = True
-                        break
-        if not ok:
+        self.where = where
+        await self.connect()
+        self.receiver = asyncio.ensure_future(self.receive())
+
+    async def connect(self):
+        self.websocket = await transport.connect(self.where, open_timeout=1.0)
+        try:
+            msg = json.loads(await asyncio.wait_for(self.websocket.recv(), timeout=1.0))
+        except asyncio.TimeoutError:
+            msg = None
+        if msg is None or msg['cmd'] != 'version' or msg['version'] != GAME_VERSION:
+            # Strict, can relax in the future
+            await self.websocket.close()
+            self.websocket = None
             raise Exception('Server and client versions do not match.')
 
+    async def reconnect(self):
+        self.websocket = None
+        for attempt in range(self.RECONNECT_ATTEMPTS):
+            try:
+                await self.connect()
+                await self.send({'cmd': 'resume', 'token': self.token, 'ack': self.last_seq})
+                return True
+            except Exception as e:
+                print(f'Reconnect attempt {attempt + 1} failed: {e}')
+                await asyncio.sleep(min(2.0, 0.25 * 2 ** attempt))
+        return False
 
     async def deactivate(self):
+        self.token = None
+        self.last_seq = 0
+        self.room = None
+        self.inbox = asyncio.Queue()
+        if self.receiver is not None:
+            self.receiver.cancel()
+            self.receiver = None
         if self.websocket is not None:
             await self.websocket.close()
             self.websocket = None
 
+    async def receive(self):
+        """Runs in the background for as long as we are connected. Network never waits for a frame."""
+        while self.websocket is not None:
+            try:
+                packet = await self.websocket.recv()
+            except websockets.exceptions.ConnectionClosed:
+                if self.token is None or not await self.reconnect():
+                    self.websocket = None
+                continue
+            msg = json.loads(packet)
+            if msg['cmd'] == 'resumed' and not msg['ok']:
+                # Too late, the seat is gone. Join again the expensive way, on a brand new session.
+                self.last_seq = msg['seq']
+                if self.room is not None:
+                    await self.send({'cmd': 'room', 'game_id': self.room})
+            elif 'seq' in msg:
+                if msg['seq'] <= self.last_seq:
+                    continue  # Seen that already
+                self.last_seq = msg['seq']
+            if msg['cmd'] == 'you':
+                self.token = msg.get('token')
+            self.inbox.put_nowait(msg)
+            if self.on_message is not None:
+                self.on_message()
+
     async def messages(self):
-        # My eyes need bleach. Now yours probably need it too :)
-        while True:
+        """Everything that arrived since the last call. Never waits."""
+        while not self.inbox.empty():
+            yield self.inbox.get_nowait()
+
+
+class FrameScheduler:
+    """Paces the main loop by awaiting, so the event loop keeps running between frames.
+    A frame comes at the target FPS, or sooner if poke() says the state changed - but never above max_fps."""
+    def __init__(self, fps=91, max_fps=240):
+        self.frame_time = 1 / fps
+        self.min_frame_time = 1 / max_fps
+        self.last_frame = time.monotonic()
+        self.wakeup = asyncio.Event()
+
+    def poke(self):
+        self.wakeup.set()
+
+    async def wait(self):
+        now = time.monotonic()
+        deadline = self.last_frame + self.frame_time
+        if deadline > now and not self.wakeup.is_set():
             try:
-                packet = await asyncio.wait_for(self.websocket.recv(), timeout=0.0025)
-                yield json.loads(packet)
+                await asyncio.wait_for(self.wakeup.wait(), deadline - now)
             except asyncio.TimeoutError:
-                return
+                pass
+        earliest = self.last_frame + self.min_frame_time
+        now = time.monotonic()
+        if now < earliest:
+            await asyncio.sleep(earliest - now)
+        else:
+            await asyncio.sleep(0)  # Whatever happens, let the network have its turn
+        self.wakeup.clear()
+        self.last_frame = time.monotonic()
+
+
+class FrameProfiler:
+    """Splits frames into stages: lap(stage) when a stage is over, end_frame() when the whole frame is.
+    Remembers the last few hundred frames, for percentiles and rates."""
+    def __init__(self, history=300):
+        self.frames: deque[dict[str, float]] = deque(maxlen=history)  # Seconds per stage, and '#counter' counts
+        self.current: dict[str, float] = {}
+        self.t_lap = self.t_frame = time.perf_counter()
+
+    def lap(self, stage):
+        now = time.perf_counter()
+        self.current[stage] = self.current.get(stage, 0.0) + now - self.t_lap
+        self.t_lap = now
+
+    def count(self, counter, n=1):
+        self.current[f'#{counter}'] = self.current.get(f'#{counter}', 0) + n
+
+    def end_frame(self):
+        now = time.perf_counter()
+        self.current['frame'] = now - self.t_frame
+        self.frames.append(self.current)
+        self.current = {}
+        self.t_lap = self.t_frame = now
+
+    def stages(self):
+        """Every stage seen, in the order they happen in a frame. The whole frame goes last."""
+        seen = {}
+        for frame in self.frames:
+            seen.update((k, None) for k in frame.keys() if not k.startswith('#') and k != 'frame')
+        return list(seen) + ['frame']
+
+    def percentiles(self, stage, qs=(50, 95, 99)):
+        """Milliseconds, nearest rank."""
+        values = sorted(frame.get(stage, 0.0) for frame in self.frames)
+        if len(values) == 0:
+            return [0.0 for _ in qs]
+        return [1000 * values[min(len(values) - 1, int(len(values) * q / 100))] for q in qs]
+
+    def rate(self, counter):
+        """Per second, over the remembered frames."""
+        elapsed = sum(frame['frame'] for frame in self.frames)
+        return sum(frame.get(f'#{counter}', 0) for frame in self.frames) / elapsed if elapsed > 0 else 0.0
 
 
 class Phase:
     def __init__(self):
         self.finished = False
         self.result = None
+        self.profiler = FrameProfiler()
 
     async def prep(self): pass
     async def process_event(self, screen): pass
-    def draw(self, screen): pass
+    def draw(self, screen): pass  # Returns dirty rectangles to push to the display, or None for all of it
 
 
 class TextInputPhase(Phase):
-    def __init__(self, my_text):
+    def __init__(self, my_text, tp):
         super().__init__()
         self.my_text = my_text
         self.finished = False
         self.result = ''
-        self.font = pygame.font.Font(res_path('nimbus-mono.bold.otf'), 32)
+        self.font = tp.font('nimbus-mono.bold.otf', 32)
 
     async def process_event(self, event):
         if event.type == pygame.KEYDOWN:
@@ -95,7 +233,7 @@ class TextInputPhase(Phase):
                 self.result += pyperclip.paste()
             else:
                 key = event.unicode
-                is_allowed = len(key) == 1 and (key[0].isalnum() or key[0] in '[].:')
+                is_allowed = len(key) == 1 and (key[0].isalnum() or key[0] in '[].:/_-')
                 if is_allowed:
                     self.result += event.unicode
 
@@ -117,22 +255,241 @@ class RenderEngine(Enum):
 
 
 class TextureProvider:
-    def __init__(self):
+    """Loads textures once and hands out the very same surface every time.
+    Treat what you get as read-only, copy() it first if you want to draw on it.
+    With a resource bundle around (see pack_res.py) nothing gets decoded: the bundle is memory-mapped,
+    and textures are made right on top of its pixels when first asked for. Otherwise it's the PNGs in res/."""
+    def __init__(self, bundle_path=BUNDLE_PATH):
         self.loaded: dict[str, pygame.Surface] = {}
+        self.bundle = None
+        self.entries: dict[str, dict] = {}
+        if bundle_path is not None and os.path.exists(bundle_path):
+            self.open_bundle(bundle_path)
+
+    def open_bundle(self, path):
+        res_dir = os.path.dirname(res_path(''))
+        if os.path.isdir(res_dir):
+            newest = max(os.path.getmtime(os.path.join(res_dir, fn)) for fn in os.listdir(res_dir))
+            if newest > os.path.getmtime(path):
+                print('Resource bundle is older than res/, using res/ instead. Run pack_res.py again')
+                return
+        with open(path, 'rb') as f:
+            # Copy-on-write, so surfaces can be drawn on without touching the file
+            bundle = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        if bundle[:len(BUNDLE_MAGIC)] != BUNDLE_MAGIC:
+            print('Not a resource bundle, using res/ instead')
+            return
+        header_size = struct.unpack_from('<I', bundle, len(BUNDLE_MAGIC))[0]
+        header_offset = len(BUNDLE_MAGIC) + 4
+        self.entries = json.loads(bundle[header_offset:header_offset + header_size])['entries']
+        self.bundle = bundle
+
+    def bundled(self, key):
+        entry = self.entries[key]
+        return memoryview(self.bundle)[entry['offset']:entry['offset'] + entry['length']]
 
     def __getitem__(self, key):
-        if not self.present(key):
-            self.loaded[key] = pygame.image.load(res_path(f'{key}.png'))
-        return self.loaded[key].copy()
+        if key not in self.loaded:
+            if key in self.entries:
+                self.loaded[key] = pygame.image.frombuffer(self.bundled(key), self.entries[key]['size'], 'RGBA')
+            else:
+                self.loaded[key] = pygame.image.load(res_path(f'{key}.png'))
+        return self.loaded[key]
 
     def __setitem__(self, key, value):
-        self.loaded[key] = value.copy()
+        self.loaded[key] = value
 
     def present(self, key):
-        return key in self.loaded
+        return key in self.loaded or key in self.entries
+
+    def font(self, name, size):
+        if name in self.entries:
+            return pygame.font.Font(io.BytesIO(self.bundled(name).tobytes()), size)
+        return pygame.font.Font(res_path(name), size)
 
     def clear_cache(self):
-        self.loaded.clear()
+        """Forgets everything but the bundle's textures, those are only views on the memory-mapped file anyway."""
+        self.loaded = {key: surf for key, surf in self.loaded.items() if key in self.entries}
+
+
+class SpriteCache:
+    """Sprites made on the fly (tinted cursors, turn indicator frames), least recently used ones go first."""
+    def __init__(self, max_items):
+        self.max_items = max_items
+        self.items: OrderedDict = OrderedDict()
+
+    def get(self, key, make):
+        if key in self.items:
+            self.items.move_to_end(key)
+        else:
+            while len(self.items) >= self.max_items:
+                self.items.popitem(last=False)
+            self.items[key] = make()
+        return self.items[key]
+
+
+class PieceAtlas:
+    """All four rotations of every piece, pre-rendered into big shared pages, one set of pages per piece size.
+    Least recently used pieces make room for new ones, so memory stays bounded no matter how many games are played."""
+    SLOTS_PER_ROW = 16
+
+    def __init__(self, tp, size=64, max_pieces=256):
+        self.tp = tp
+        self.size = size  # Unless asked for another one
+        self.max_pieces = max_pieces
+        self.pages: dict[int, list[pygame.Surface]] = {}
+        self.free_slots: dict[int, list[tuple[int, int, int]]] = {}  # Page, x, y
+        self.pieces: OrderedDict[tuple, tuple[list[pygame.Surface], list[tuple[int, int, int]]]] = OrderedDict()
+        self.warming = None
+        self.hits, self.misses = 0, 0
+
+    def key(self, re, description, seed, size=None):
+        # Only blue, green and yellow have texture variants, empty cells and bricks look the same whatever the seed
+        seeded = re == RenderEngine.GEMS and any(c in description for c in 'BGY')
+        return re, description, seed if seeded else 0, size or self.size
+
+    def piece(self, re, description, seed, rotation=0, size=None):
+        key = self.key(re, description, seed, size)
+        if key in self.pieces:
+            self.pieces.move_to_end(key)
+            self.hits += 1
+        else:
+            self.add(key)
+            self.misses += 1
+        return self.pieces[key][0][rotation % 4]
+
+    def add(self, key):
+        re, description, seed, size = key
+        if re == RenderEngine.GEMS:
+            base = self.build_gem_piece(description, seed, size)
+        else:
+            base = self.build_simple_piece(description, size)
+        while len(self.pieces) >= self.max_pieces:
+            old_key, (_, slots) = self.pieces.popitem(last=False)
+            self.free_slots[old_key[3]] += slots
+        views, slots = [], []
+        for rotation in range(4):
+            slot = self.take_slot(size)
+            page, x, y = slot
+            rect = pygame.Rect(x, y, size, size)
+            self.pages[size][page].fill((0, 0, 0, 0), rect)
+            rotated = base if rotation == 0 else pygame.transform.rotate(base, rotation * 90)
+            self.pages[size][page].blit(rotated, rect, special_flags=pygame.BLEND_RGBA_MAX)  # Plain copy, alpha included
+            views.append(self.pages[size][page].subsurface(rect))
+            slots.append(slot)
+        self.pieces[key] = (views, slots)
+
+    def take_slot(self, size):
+        pages = self.pages.setdefault(size, [])
+        free_slots = self.free_slots.setdefault(size, [])
+        if len(free_slots) == 0:
+            page_px = self.SLOTS_PER_ROW * size
+            pages.append(pygame.Surface((page_px, page_px), pygame.SRCALPHA))
+            page = len(pages) - 1
+            free_slots += [(page, x * size, y * size)
+                           for y in reversed(range(self.SLOTS_PER_ROW)) for x in reversed(range(self.SLOTS_PER_ROW))]
+        return free_slots.pop()
+
+    def build_gem_piece(self, description, seed, size):
+        if self.tp.present(f'baked_gem_{description}_{size}'):
+            return self.tp[f'baked_gem_{description}_{size}']  # Blurred ahead of time by pack_res.py
+        r = random.Random(f'{seed}-{description}')
+        surf = pygame.Surface((128, 128), pygame.SRCALPHA)
+        poss = (0, 0), (64, 0), (0, 64), (64, 64)
+        for i in range(4):
+            fn = {'Y': 'yellow', 'G': 'green', 'B': 'blue', 'w': 'white', 'r': 'brick'}[description[i]] + '_tile'
+            if description[i] in ['Y', 'G', 'B']:
+                fn += str(r.randint(1, 5))
+            texture: pygame.Surface = self.tp[fn]
+            texture_part = texture.subsurface((poss[i][0], poss[i][1], 64, 64))
+            surf.blit(texture_part, poss[i])
+        if description[0] == 'w':
+            surf.fill((255, 255, 255, 128), None, pygame.BLEND_RGBA_MULT)  # "I will fix it in post"
+        surf = surf.subsurface((5, 5, 128 - 10, 128 - 10))
+        surf = pygame.transform.smoothscale(surf, (size - size // 9, size - size // 9))  # Blur, basically
+        surf = pygame.transform.smoothscale(surf, (size, size))
+        return surf
+
+    def build_simple_piece(self, description, size):
+        if 'w' in description:
+            border = 0
+        else:
+            border = size // 16
+        surf = pygame.Surface((size, size), pygame.SRCALPHA)
+        surf.fill((128, 128, 128))
+        half_size = (size + 1) // 2
+        points = [(border, border), (half_size, border), (border, half_size), (half_size, half_size)]
+        colors = {'B': (53, 85, 122), 'G': (81, 157, 60), 'Y': (187, 187, 72), 'r': (139, 65, 62), 'w': (240, 240, 240)}
+        for i in range(4):
+            color = colors[description[i]]
+            pos = list(points[i]) + [half_size - border, half_size - border]
+            pygame.draw.rect(surf, color, tuple(pos))
+        return surf
+
+    def prewarm(self, re, descriptions, size=None):
+        """Renders the pieces of a fresh game in the background, a piece per event loop iteration."""
+        if self.warming is not None:
+            self.warming.cancel()
+        self.warming = asyncio.ensure_future(self._prewarm(re, list(descriptions), size))
+
+    async def _prewarm(self, re, descriptions, size):
+        for piece_i, description in enumerate(descriptions):
+            if self.key(re, description, piece_i, size) not in self.pieces:
+                self.piece(re, description, piece_i, size=size)
+                await asyncio.sleep(0)
+        self.warming = None
+
+
+class SpatialIndex:
+    """Uniform grid over the world. A rectangle is filed under every bucket it touches,
+    so looking up a point checks one bucket, and looking up a rectangle only the buckets under it."""
+    BUCKET = 128  # World px, two pieces across
+
+    def __init__(self):
+        self.buckets: dict[tuple[int, int], set] = {}
+        self.rects: dict = {}
+        self.right, self.bottom = 0, 0  # How far the world goes
+
+    def cells(self, rect):
+        b = self.BUCKET
+        return [(bx, by)
+                for by in range(int(rect[1] // b), int((rect[1] + rect[3]) // b) + 1)
+                for bx in range(int(rect[0] // b), int((rect[0] + rect[2]) // b) + 1)]
+
+    def put(self, key, rect):
+        self.remove(key)
+        if rect is None:
+            return
+        self.rects[key] = rect
+        for cell in self.cells(rect):
+            self.buckets.setdefault(cell, set()).add(key)
+        self.right = max(self.right, rect[0] + rect[2])
+        self.bottom = max(self.bottom, rect[1] + rect[3])
+
+    def remove(self, key):
+        rect = self.rects.pop(key, None)
+        if rect is not None:
+            for cell in self.cells(rect):
+                self.buckets[cell].discard(key)
+
+    def at(self, pos, inset=0):
+        """Keys whose rectangle (shrunk by inset on every side) has the point in it."""
+        b = self.BUCKET
+        found = []
+        for key in self.buckets.get((int(pos[0] // b), int(pos[1] // b)), ()):
+            x, y, w, h = self.rects[key]
+            if x + inset <= pos[0] < x + w - inset and y + inset <= pos[1] < y + h - inset:
+                found.append(key)
+        return found
+
+    def overlapping(self, rect):
+        found = set()
+        for cell in self.cells(rect):
+            found |= self.buckets.get(cell, set())
+        return [key for key in found
+                if self.rects[key][0] < rect[0] + rect[2] and rect[0] < self.rects[key][0] + self.rects[key][2] and
+                self.rects[key][1] < rect[1] + rect[3] and rect[1] < self.rects[key][1] + self.rects[key][3]]
+
 
 class GameState:
     def __init__(self):
@@ -141,70 +498,222 @@ class GameState:
         self.player_data: dict[str, dict] = {}
         self.me = None
         self.cur_player = None
+        self.h, self.w = 5, 7  # Unless the server says otherwise
 
         self.piece_size = 64
-        self.selected_piece = None  # TODO: Rework to work with multiplayer
+        self._selected_piece = None  # TODO: Rework to work with multiplayer
         self.score = None  # Set only if game over
 
+        # Where every piece is, in world pixels. Hit tests look here instead of going through all the pieces
+        self.index = SpatialIndex()
+        self.changed: set[int] = set()  # Pieces that may look different since the renderer last asked
+
         self.init_time = time.monotonic()
 
+    @property
+    def selected_piece(self):
+        return self._selected_piece
+
+    @selected_piece.setter
+    def selected_piece(self, piece_i):
+        self.changed.update(i for i in [self._selected_piece, piece_i] if i is not None)
+        self._selected_piece = piece_i
+
     def set_positions(self, positions):
+        old = self.p_positions
         self.p_positions = positions
+        for i in range(max(len(old), len(positions))):
+            if i >= len(old) or i >= len(positions) or old[i] != positions[i]:
+                self.touch(i)
 
-    def set_descriptions(self, descriptions):
+    def set_descriptions(self, descriptions, h=None, w=None):
         self.p_descriptions = descriptions
+        if h is not None and (h, w) != (self.h, self.w):
+            self.h, self.w = h, w  # The pool sits under the board, so everything moves
+            self.index = SpatialIndex()
+            for i in range(len(self.p_positions)):
+                self.touch(i)
+        self.changed.update(range(len(self.p_positions)))
+
+    def touch(self, piece_i):
+        """Call after changing a piece's position in place."""
+        self.changed.add(piece_i)
+        pos = self.p_positions[piece_i] if piece_i < len(self.p_positions) else None
+        pos_px = self.piece_px_pos(pos) if pos is not None else None
+        self.index.put(piece_i, None if pos_px is None else (pos_px[0], pos_px[1], self.piece_size, self.piece_size))
+
+    def take_changed(self):
+        changed, self.changed = self.changed, set()
+        return changed
+
+    def piece_px_pos(self, pos):
+        if pos['type'] == 'board':
+            return self.board_pos_px(pos['ii'], pos['uu'])
+        elif pos['type'] == 'free':
+            return self.laying_pos_px(pos['ii'], pos['uu'])
+        return None
 
     def locate_piece_by_px_pos(self, click_pos):
-        for i, pos in enumerate(self.p_positions):
-            pos_px = None
-            if pos['type'] == 'board':
-                pos_px = self.board_pos_px(pos['ii'], pos['uu'])
-            elif pos['type'] == 'free':
-                pos_px = self.laying_pos_px(pos['ii'], pos['uu'])
-            if pos_px is None:
-                continue
-            hit = (pos_px[0] + 3 <= click_pos[0] < pos_px[0] + self.piece_size - 3 and
-                   pos_px[1] + 3 <= click_pos[1] < pos_px[1] + self.piece_size - 3)
-            if hit:
-                return i
-        return None
+        hits = self.index.at(click_pos, inset=3)
+        return min(hits) if len(hits) else None  # Overlapping pieces: the first one wins, like it always did
 
     def board_cell_by_px_pos(self, click_pos):
-        for i in range(5):
-            for u in range(7):
-                pos_px = self.board_pos_px(i, u)
-                hit = (pos_px[0] + 3 <= click_pos[0] < pos_px[0] + self.piece_size - 3 and
-                       pos_px[1] + 3 <= click_pos[1] < pos_px[1] + self.piece_size - 3)
-                if hit:
-                    return i, u
+        x, y = click_pos[0] - 152, click_pos[1] - 32
+        i, u = int(y // 72), int(x // 72)
+        if not (0 <= i < self.h and 0 <= u < self.w):
+            return None
+        if 3 <= x - u * 72 < self.piece_size - 3 and 3 <= y - i * 72 < self.piece_size - 3:
+            return i, u
         return None
 
     def board_pos_px(self, i, u):
         return 152 + u * 72, 32 + i * 72
 
     def laying_pos_px(self, i, u):
-        return 88 + u * 80, 430 + 32 + i * 80
+        return 88 + u * 80, self.h * 72 + 70 + 32 + i * 80
+
+
+class Viewport:
+    """Which part of the world (board and pool, in unzoomed pixels) is on the screen."""
+    ZOOMS = [0.25, 0.375, 0.5, 0.75, 1.0, 1.5, 2.0]
+
+    def __init__(self, size=(800, 800)):
+        self.size = size
+        self.zoom_i = self.ZOOMS.index(1.0)
+        self.sx, self.sy = 0, 0  # Where the world's origin is on the screen
+
+    @property
+    def zoom(self):
+        return self.ZOOMS[self.zoom_i]
+
+    def state(self):
+        return self.sx, self.sy, self.zoom_i, tuple(self.size)
+
+    def px(self, n):
+        return int(n * self.zoom)
+
+    def to_screen(self, pos):
+        return int(pos[0] * self.zoom) + self.sx, int(pos[1] * self.zoom) + self.sy
+
+    def to_world(self, pos):
+        return (pos[0] - self.sx) / self.zoom, (pos[1] - self.sy) / self.zoom
+
+    def screen_rect(self, rect):
+        x0, y0 = self.to_screen((rect[0], rect[1]))
+        x1, y1 = self.to_screen((rect[0] + rect[2], rect[1] + rect[3]))
+        return pygame.Rect(x0, y0, x1 - x0, y1 - y0)
+
+    def world_rect(self, rect):
+        x0, y0 = self.to_world((rect[0], rect[1]))
+        x1, y1 = self.to_world((rect[0] + rect[2], rect[1] + rect[3]))
+        return x0 - 1, y0 - 1, x1 - x0 + 2, y1 - y0 + 2  # A pixel of slack for the rounding
+
+    def pan(self, rel):
+        self.sx += rel[0]
+        self.sy += rel[1]
+
+    def zoom_at(self, steps, anchor):
+        """Zooms in (or out, for negative steps) keeping the world under the anchor in place."""
+        world = self.to_world(anchor)
+        self.zoom_i = max(0, min(len(self.ZOOMS) - 1, self.zoom_i + steps))
+        self.sx = anchor[0] - int(world[0] * self.zoom)
+        self.sy = anchor[1] - int(world[1] * self.zoom)
+
+    def clamp(self, right, bottom):
+        """Some of the world should always stay in sight."""
+        self.sx = max(64 - self.px(right), min(self.sx, self.size[0] - 64))
+        self.sy = max(64 - self.px(bottom), min(self.sy, self.size[1] - 64))
+
+    def reset(self):
+        self.zoom_i = self.ZOOMS.index(1.0)
+        self.sx, self.sy = 0, 0
+
+
+class CursorTrack:
+    """Someone else's cursor. Drawn a little in the past, between the positions we actually got,
+    so it glides instead of teleporting every time an update arrives."""
+    DELAY = 0.1  # Seconds behind real time, about two updates
+    EXTRAPOLATE = 0.05  # How far past the last update we dare to guess
+
+    def __init__(self):
+        self.samples: deque[tuple[float, tuple]] = deque(maxlen=8)  # (Arrival time, position)
+        self.start = None  # Made up sample the current move glides from, after standing still (see add)
+
+    def add(self, pos, t=None):
+        pos = tuple(pos)
+        t = time.monotonic() if t is None else t
+        if len(self.samples) and self.samples[-1][1] == pos:
+            return
+        if len(self.samples) and t - self.samples[-1][0] > self.DELAY:
+            # It stood still for a while, the old samples say nothing about this move.
+            # Start over from where it stood, as if it left just now, so it glides over instead of jumping
+            self.start = (t - self.DELAY, self.samples[-1][1])
+            self.samples.clear()
+            self.samples.append(self.start)
+        self.samples.append((t, pos))
+
+    def position(self, now=None):
+        if len(self.samples) == 0:
+            return None
+        t = (time.monotonic() if now is None else now) - self.DELAY
+        if len(self.samples) == 1 or t <= self.samples[0][0]:
+            return self.samples[0][1] if t <= self.samples[0][0] else self.samples[-1][1]
+        for (t0, p0), (t1, p1) in zip(self.samples, list(self.samples)[1:]):
+            if t <= t1:
+                break
+        else:
+            # Ran out of samples. Keep going the way it was going for a bit, then ease back to where it really is.
+            (t0, p0), (t1, p1) = self.samples[-2], self.samples[-1]
+            overshoot = max(0.0, min(t - t1, 2 * self.EXTRAPOLATE - (t - t1)))
+            if overshoot == 0.0 or (t0, p0) == self.start:
+                return p1  # Settled, or the speed is a made up one
+            t = t1 + overshoot
+        k = (t - t0) / max(t1 - t0, 1e-6)
+        return tuple(int(round(p0[i] + (p1[i] - p0[i]) * k)) for i in range(2))
 
 
 class GamingPhase(Phase):
-    def __init__(self, connector, tp):
+    CURSOR_SEND_RATE = 20  # Our own cursor updates per second, at most
+    def __init__(self, connector, tp, atlas, spectating=False):
         super().__init__()
         self.finished = False
         self.connector = connector
+        self.spectating = spectating
         self.gs = GameState()
         self.font = pygame.font.SysFont("monospace", 32, bold=True)
 
         self.re = RenderEngine.GEMS
         self.tp: TextureProvider = tp
+        self.atlas: PieceAtlas = atlas
+        # Per player color, so they go away with the game. Turn indicators are 31 frames each, ~0.5 MB
+        self.cursors, self.turn_indicators = SpriteCache(64), SpriteCache(24)
+        self.layers = None  # Cached render layers, see build_layers
+        self.drawn_pieces: dict[int, tuple] = {}  # What the layers show for every piece
+        self.viewport = Viewport()
+        self.panning = False
+        self.show_stats = False
+        self.stats_font = tp.font('nimbus-mono.bold.otf', 14)
+        self.cursor_tracks: dict[str, CursorTrack] = {}
+        self.pending_curpos = None  # Where our cursor went, not sent yet
+        self.sent_curpos = None
+        self.last_curpos_time = 0.0
 
     async def process_message(self, msg):
         if msg['cmd'] == 'positions':  # Do you feel the déjà vu?
                 self.gs.set_positions(msg['positions'])
         if msg['cmd'] == 'descriptions':
-                self.gs.set_descriptions(msg['descriptions'])
+                self.gs.set_descriptions(msg['descriptions'], msg.get('h'), msg.get('w'))
+                self.atlas.prewarm(self.re, msg['descriptions'], self.viewport.px(64))
+                self.invalidate()
         if msg['cmd'] == 'player_data':
                 self.gs.player_data = msg['player_data']
                 self.gs.cur_player = msg['cur_player']
+                self.track_cursors()
+        if msg['cmd'] == 'frame':
+                self.gs.set_positions(msg['positions'])
+                self.gs.player_data = msg['player_data']
+                self.gs.cur_player = msg['cur_player']
+                self.track_cursors()
         if msg['cmd'] == 'you':
                 self.gs.me = msg['you']
         if msg['cmd'] == 'game_over':
@@ -214,19 +723,65 @@ class GamingPhase(Phase):
         if msg['cmd'] == 'op':
                 pass  # Not implemented
 
+    def track_cursors(self):
+        for player, data in self.gs.player_data.items():
+            if player != self.gs.me and data.get('curpos') is not None:
+                self.cursor_tracks.setdefault(player, CursorTrack()).add(data['curpos'])
+        for player in self.cursor_tracks.keys() - self.gs.player_data.keys():
+            del self.cursor_tracks[player]
+
     async def prep(self):
         async for msg in self.connector.messages():
             await self.process_message(msg)
+            self.profiler.count('msgs')
+        await self.send_cursor()
+
+    async def send_cursor(self):
+        """Our cursor goes out at CURSOR_SEND_RATE, only the latest position, and only if it moved."""
+        if self.pending_curpos is None or self.pending_curpos == self.sent_curpos:
+            return
+        now = time.monotonic()
+        if now - self.last_curpos_time < 1 / self.CURSOR_SEND_RATE:
+            return
+        self.last_curpos_time = now
+        self.sent_curpos, self.pending_curpos = self.pending_curpos, None
+        await self.connector.send({'cmd': 'curpos', 'curpos': self.sent_curpos})
+
+    def move_view(self, event):
+        """Wheel zooms, middle button drags the view around, Home puts it back. True if the event is used up."""
+        view = self.viewport.state()
+        if event.type == pygame.MOUSEWHEEL:
+            self.viewport.zoom_at(1 if event.y > 0 else -1, pygame.mouse.get_pos())
+        elif event.type == pygame.KEYDOWN and event.key in [pygame.K_EQUALS, pygame.K_PLUS, pygame.K_MINUS]:
+            center = (self.viewport.size[0] // 2, self.viewport.size[1] // 2)
+            self.viewport.zoom_at(-1 if event.key == pygame.K_MINUS else 1, center)
+        elif event.type == pygame.KEYDOWN and event.key == pygame.K_HOME:
+            self.viewport.reset()
+        elif event.type in [pygame.MOUSEBUTTONDOWN, pygame.MOUSEBUTTONUP] and event.button == 2:
+            self.panning = event.type == pygame.MOUSEBUTTONDOWN
+            return True
+        elif event.type == pygame.MOUSEMOTION and self.panning:
+            self.viewport.pan(event.rel)
+        else:
+            return False
+        self.viewport.clamp(self.gs.index.right, self.gs.index.bottom)
+        if self.viewport.state() != view:
+            self.atlas.prewarm(self.re, self.gs.p_descriptions, self.viewport.px(64))
+        return event.type != pygame.MOUSEMOTION  # The cursor still moved
 
     async def process_event(self, event):
+        if self.move_view(event):
+            return
+        if self.spectating and event.type in [pygame.MOUSEMOTION, pygame.MOUSEBUTTONDOWN]:
+            return  # Look, but don't touch
         if event.type == pygame.MOUSEMOTION:
             if self.gs.score is None:
-                mouse_position = pygame.mouse.get_pos()
-                await self.connector.send({'cmd': 'curpos', 'curpos': mouse_position})
+                # World coordinates, everyone has their own viewport. Goes out in prep()
+                self.pending_curpos = tuple(int(c) for c in self.viewport.to_world(pygame.mouse.get_pos()))
             else:
                 pass  # Not implemented ;(
         if event.type == pygame.MOUSEBUTTONDOWN:
-            click_pos = pygame.mouse.get_pos()
+            click_pos = self.viewport.to_world(pygame.mouse.get_pos())
             clicked_piece = self.gs.locate_piece_by_px_pos(click_pos)
             if event.button == 1:
                 if self.gs.selected_piece is not None:
@@ -241,6 +796,7 @@ class GamingPhase(Phase):
                         self.gs.p_positions[self.gs.selected_piece]['type'] = 'board'
                         self.gs.p_positions[self.gs.selected_piece]['ii'] = hit[0]
                         self.gs.p_positions[self.gs.selected_piece]['uu'] = hit[1]
+                        self.gs.touch(self.gs.selected_piece)
 
                         self.gs.selected_piece = None
                         return
@@ -252,70 +808,32 @@ class GamingPhase(Phase):
             if event.button == 3:
                 if self.gs.selected_piece is not None:
                     self.gs.p_positions[self.gs.selected_piece]['r'] += 1  # TODO: To server
+                    self.gs.touch(self.gs.selected_piece)
                 elif clicked_piece is not None and self.gs.p_positions[clicked_piece]['type'] == 'free':
                     self.gs.p_positions[clicked_piece]['r'] += 1  # TODO: To server
+                    self.gs.touch(clicked_piece)
+        if event.type in [pygame.VIDEOEXPOSE, pygame.WINDOWEXPOSED]:
+            self.invalidate()
         if event.type == pygame.KEYDOWN:
+            if event.key == pygame.K_F3:
+                self.show_stats = not self.show_stats
+                self.atlas.hits, self.atlas.misses = 0, 0
             if event.key == pygame.K_v:
                 self.re = RenderEngine.SIMPLE if self.re == RenderEngine.GEMS else RenderEngine.GEMS
-            if self.gs.score is not None and event.key == pygame.K_ESCAPE:
+                self.atlas.prewarm(self.re, self.gs.p_descriptions, self.viewport.px(64))
+            if (self.gs.score is not None or self.spectating) and event.key == pygame.K_ESCAPE:
                 self.finished = True
+            if isinstance(self.connector, ReplayConnector) and event.key in [pygame.K_LEFT, pygame.K_RIGHT]:
+                self.gs.score = None
+                self.connector.seek_relative(-1 if event.key == pygame.K_LEFT else +1)
 
     def render_piece(self, description, seed, size, rotation=0):
-        """Piece_i should be used as as seed"""
-        if self.re == RenderEngine.GEMS:
-            name_id = f'cached_piece_{str(description)}-{seed}'
-            if not self.tp.present(name_id):
-                r = random.Random(f'{seed}-{description}')
-                surf = pygame.Surface((128, 128), pygame.SRCALPHA)
-                poss = (0, 0), (64, 0), (0, 64), (64, 64)
-                for i in range(4):
-                    fn = {'Y': 'yellow', 'G': 'green', 'B': 'blue', 'w': 'white', 'r': 'brick'}[description[i]] + '_tile'
-                    if description[i] in ['Y', 'G', 'B']:
-                        fn += str(r.randint(1, 5))
-                    texture: pygame.Surface = self.tp[fn]
-                    texture_part = texture.subsurface((poss[i][0], poss[i][1], 64, 64))
-                    surf.blit(texture_part, poss[i])
-                if description[0] == 'w':
-                    surf.fill((255, 255, 255, 128), None, pygame.BLEND_RGBA_MULT)  # "I will fix it in post"
-                surf = surf.subsurface((5, 5, 128 - 10, 128 - 10))
-                surf = pygame.transform.smoothscale(surf, (57, 57))  # Blur, basically
-                surf = pygame.transform.smoothscale(surf, (64, 64))
-                self.tp[name_id] = surf
-            surf = pygame.transform.rotate(self.tp[name_id], (rotation * 90) % 360)
-            return surf
-        elif self.re == RenderEngine.SIMPLE:
-            for _ in range(rotation % 4):
-                description = description[1] + description[3] + description[0] + description[2]
-            if 'w' in description:
-                border = 0
-            else:
-                border = size // 16
-            surf = pygame.Surface((size, size), pygame.SRCALPHA)
-            surf.fill((128, 128, 128))
-            half_size = (size + 1) // 2
-            points = [(border, border), (half_size, border), (border, half_size), (half_size, half_size)]
-            colors = {'B': (53, 85, 122), 'G': (81, 157, 60), 'Y': (187, 187, 72), 'r': (139, 65, 62), 'w': (240, 240, 240)}
-            for i in range(4):
-                color = colors[description[i]]
-                pos = list(points[i]) + [half_size - border, half_size - border]
-                pygame.draw.rect(surf, color, tuple(pos))
-            return surf
+        """Piece_i should be used as as seed. The surface is shared, copy() before drawing on it."""
+        return self.atlas.piece(self.re, description, seed, rotation, size)
 
     def render_cursor(self, color):
         if self.re == RenderEngine.GEMS:
-            name_id = f'cached_cursor_{str(color)}'
-            if not self.tp.present(name_id):
-                cursor = self.tp['cursor']
-                color += [255]
-                color[1] = 255
-                for x in range(cursor.get_width()):
-                    for y in range(cursor.get_height()):
-                        c = cursor.get_at((x, y))  # Preserve the alpha value.
-                        c = [int(c[i] * color[i] / 255) for i in range(4)]
-                        cursor.set_at((x, y), c)  # Set the color of the pixel.
-                cursor = pygame.transform.smoothscale(cursor, (24, 24))
-                self.tp[name_id] = cursor
-            return self.tp[name_id]
+            return self.cursors.get(tuple(color), lambda: self.make_cursor(color))
         elif self.re == RenderEngine.SIMPLE:
             surf = pygame.Surface((64, 64), pygame.SRCALPHA)
             brigth_color = tuple([int(c * 0.85) for c in color])
@@ -326,37 +844,51 @@ class GamingPhase(Phase):
             pygame.draw.rect(surf, brigth_color, (0, 0, 4, 4))
             return surf
 
-    def render_turn_indicator(self, color, is_active):
+    def make_cursor(self, color):
+        cursor = self.tp['cursor'].copy()
+        color += [255]
+        color[1] = 255
+        cursor.fill(color, None, pygame.BLEND_RGBA_MULT)  # Tints and preserves the alpha, all in one go
+        return pygame.transform.smoothscale(cursor, (24, 24))
+
+    TURN_INDICATOR_PERIOD = 2.5  # Seconds
+    TURN_INDICATOR_FRAMES = 30
+
+    def turn_indicator_frame(self):
         t = time.monotonic() - self.gs.init_time
-        coff = math.cos(t * math.pi / 1.25) * 0.3 + 0.7  # is_active coff
+        return int(t / self.TURN_INDICATOR_PERIOD * self.TURN_INDICATOR_FRAMES) % self.TURN_INDICATOR_FRAMES
 
+    def render_turn_indicator(self, color, is_active):
+        """Every animation frame is made once per color, after that it's just a lookup."""
+        frames = self.turn_indicators.get((self.re, tuple(color)), lambda: self.make_turn_indicator_frames(color))
+        return frames[self.turn_indicator_frame() if is_active else -1]  # Idle one is last
+
+    def make_turn_indicator_frames(self, color):
+        """All the animation frames for one color, and the idle one at the end."""
+        coffs = [math.cos(2 * math.pi * frame / self.TURN_INDICATOR_FRAMES) * 0.3 + 0.7
+                 for frame in range(self.TURN_INDICATOR_FRAMES)]
+        frames = []
         if self.re == RenderEngine.GEMS:
-            name_id = f'cached_turnindicator_{str(color)}'
-            if not self.tp.present(name_id):
-                surf = self.tp['turn_indicator_base']
-                color += [255]
-                for x in range(surf.get_width()):
-                    for y in range(surf.get_height()):
-                        c = surf.get_at((x, y))
-                        c = [c[i] * color[i] / 255 for i in range(4)]
-                        c = [min(255, int(x)) for x in c]
-                        surf.set_at((x, y), c)
-                self.tp[name_id] = surf
-            surf_base = self.tp[name_id]
-            if is_active:
-                extra_surf = self.tp['turn_indicator_on']
+            base = self.tp['turn_indicator_base'].copy()
+            base.fill(color + [255], None, pygame.BLEND_RGBA_MULT)
+            for coff in coffs:
+                extra_surf = self.tp['turn_indicator_on'].copy()
                 extra_surf.fill((255, 255, 255, int(255 * coff)), None, pygame.BLEND_RGBA_MULT)
-                surf_base.blit(extra_surf, (0, 0))
-            return surf_base
+                surf = base.copy()
+                surf.blit(extra_surf, (0, 0))
+                frames.append(surf)
+            frames.append(base)
         elif self.re == RenderEngine.SIMPLE:
-            surf = pygame.Surface((64, 64), pygame.SRCALPHA)
             brigth_color = tuple([int(c * 0.85) for c in color])
             dim_color = tuple([int(c * 0.70) for c in color])
-            pygame.draw.rect(surf, dim_color, (0, 0, 64, 64))
-            pygame.draw.rect(surf, brigth_color, (8, 8, 64 - 2 * 8, 64 - 2 * 8))
-            if is_active:
-                pygame.draw.circle(surf, dim_color, (32, 32), coff * 16.0)
-            return surf
+            for coff in coffs + [None]:
+                surf = pygame.Surface((64, 64), pygame.SRCALPHA)
+                pygame.draw.rect(surf, dim_color, (0, 0, 64, 64))
+                pygame.draw.rect(surf, brigth_color, (8, 8, 64 - 2 * 8, 64 - 2 * 8))
+                if coff is not None:
+                    pygame.draw.circle(surf, dim_color, (32, 32), coff * 16.0)
+                frames.append(surf)
+        return frames
 
 
     def render_score_box(self, score):
@@ -372,112 +904,292 @@ class GamingPhase(Phase):
             box.blit(text_surf, (vals[2][0], vals[2][1]))
         return box
 
-    def draw(self, screen):
-        # TODO: fancy cursors
-
-        background = pygame.Surface(screen.get_size(), pygame.SRCALPHA)
-        background = background.convert()
-        background.fill((250, 250, 250))
+    STATS_REFRESH = 4  # Times per second, so the numbers can be read
+
+    def render_stats(self):
+        p = self.profiler
+        lines = ['stage     p50   p95   p99 ms']
+        for stage in p.stages():
+            if stage != 'wait':
+                lines.append(f'{stage:<7}' + ''.join(f'{v:6.1f}' for v in p.percentiles(stage)))
+        busy = sorted(frame['frame'] - frame.get('wait', 0.0) for frame in p.frames)
+        if len(busy):
+            lines.append(f'busy {1000 * busy[len(busy) // 2]:.1f} ms, {len(p.frames) / sum(f["frame"] for f in p.frames):.0f} fps')
+        lines.append(f'msgs/s {p.rate("msgs"):.1f}')
+        lookups = self.atlas.hits + self.atlas.misses
+        hit_rate = self.atlas.hits / lookups if lookups else 1.0
+        lines.append(f'atlas hits {hit_rate:.1%}, {len(self.atlas.pieces)} pieces')
+        box = pygame.Surface((260, 8 + 16 * len(lines)), pygame.SRCALPHA)
+        box.fill((32, 32, 32, 200))
+        for i, line in enumerate(lines):
+            box.blit(self.stats_font.render(line, True, (240, 240, 240)), (8, 4 + 16 * i))
+        return box
 
+    def invalidate(self):
+        """Throws away every cached layer, next frame is drawn from scratch."""
+        self.layers = None
+
+    def piece_rect(self, pos):
+        """Screen rectangle of a piece, with room for the selection box around free pieces."""
+        pos_px = self.gs.piece_px_pos(pos)
+        if pos_px is None:
+            return None
+        return self.viewport.screen_rect((pos_px[0] - 6, pos_px[1] - 6, 64 + 12, 64 + 12))
+
+    def piece_sig(self, piece_i):
+        if piece_i >= len(self.gs.p_positions):
+            return None
+        pos = self.gs.p_positions[piece_i]
+        return (pos['type'], pos['ii'], pos['uu'], pos['r'], self.gs.p_descriptions[piece_i],
+                piece_i == self.gs.selected_piece)
+
+    def pieces_in(self, rect, kind):
+        """Pieces of one kind under a screen rectangle, in drawing order. Off-screen pieces are never looked at."""
+        return sorted(i for i in self.gs.index.overlapping(self.viewport.world_rect(rect))
+                      if self.gs.p_positions[i]['type'] == kind)
+
+    def build_layers(self, screen):
+        """Layers, bottom to top. Each one is opaque and starts as a copy of the one below:
+        static (background and empty board), placed (pieces on the board), free (selection box and free pieces).
+        Cursors, the ghost piece and boxes go on top as an overlay, straight to the screen.
+        Layers are as big as the screen and only hold what the viewport sees. Zooming builds them again,
+        panning scrolls them and fills in the strip that came into view."""
+        self.layers = {name: pygame.Surface(screen.get_size()).convert() for name in ['static', 'placed', 'free']}
+        self.redraw_all(screen.get_rect())
+        self.overlay_drawn = {}
+        self.overlay_cache = {}
+        self.drawn_re = self.re
+        self.drawn_view = self.viewport.state()
+        self.own_cursor_sig = None
+
+    def scroll_layers(self, dx, dy):
+        w, h = self.layers['static'].get_size()
+        if abs(dx) >= w or abs(dy) >= h:
+            self.redraw_all(self.layers['static'].get_rect())
+            return
+        for layer in self.layers.values():
+            layer.scroll(dx, dy)
+        if dx != 0:
+            self.redraw_all(pygame.Rect(0 if dx > 0 else w + dx, 0, abs(dx), h))
+        if dy != 0:
+            self.redraw_all(pygame.Rect(0, 0 if dy > 0 else h + dy, w, abs(dy)))
+
+    def redraw_all(self, rect):
+        self.redraw_static(rect)
+        self.redraw_placed(rect)
+        self.redraw_free(rect)
+
+    def redraw_static(self, rect):
+        layer = self.layers['static']
+        layer.set_clip(rect)
+        layer.fill((250, 250, 250), rect)
+        size = self.viewport.px(64)
+        x0, y0, w, h = self.viewport.world_rect(rect)
+        for i in range(max(0, int((y0 - 32) // 72)), min(self.gs.h, int((y0 + h - 32) // 72) + 1)):
+            for u in range(max(0, int((x0 - 152) // 72)), min(self.gs.w, int((x0 + w - 152) // 72) + 1)):
+                layer.blit(self.render_piece('wwww', 0, size), self.viewport.to_screen(self.gs.board_pos_px(i, u)))
+        layer.set_clip(None)
+
+    def redraw_placed(self, rect):
+        layer = self.layers['placed']
+        layer.set_clip(rect)
+        layer.blit(self.layers['static'], rect, rect)
+        size = self.viewport.px(64)
+        hit = []
+        for piece_i in self.pieces_in(rect, 'board'):
+            pos = self.gs.p_positions[piece_i]
+            hit.append((piece_i, pos, self.viewport.to_screen(self.gs.board_pos_px(pos['ii'], pos['uu']))))
+        for piece_i, pos, pos_px in hit:
+            layer.fill((250, 250, 250), (pos_px[0], pos_px[1], size, size))  # No empty cell under a piece
+        for piece_i, pos, pos_px in hit:
+            layer.blit(self.render_piece(self.gs.p_descriptions[piece_i], piece_i, size, rotation=pos['r']), pos_px)
+        layer.set_clip(None)
+
+    def redraw_free(self, rect):
+        layer = self.layers['free']
+        layer.set_clip(rect)
+        layer.blit(self.layers['placed'], rect, rect)
         # Drawing selected piece box
         if self.gs.selected_piece is not None:
+            posdraw = self.piece_rect(self.gs.p_positions[self.gs.selected_piece])
             if self.re == RenderEngine.GEMS:
-                posdraw = self.gs.p_positions[self.gs.selected_piece]
-                posdraw = self.gs.laying_pos_px(posdraw['ii'], posdraw['uu'])
-                posdraw = tuple([posdraw[0] - 6, posdraw[1] - 6, 64 + 12, 64 + 12])
-                pygame.draw.rect(background, (128, 128, 128, 128), posdraw)
+                pygame.draw.rect(layer, (128, 128, 128), posdraw)
             elif self.re == RenderEngine.SIMPLE:
-                posdraw = self.gs.p_positions[self.gs.selected_piece]
-                posdraw = self.gs.laying_pos_px(posdraw['ii'], posdraw['uu'])
-                posdraw = tuple([posdraw[0] - 6, posdraw[1] - 6, 64 + 12, 64 + 12])
-                pygame.draw.rect(background, (64, 64, 64), posdraw)
-
-        # Draw pieces
-        filled = set()
-        for piece_i in range(len(self.gs.p_positions)):
-            desc = self.gs.p_descriptions[piece_i]
+                pygame.draw.rect(layer, (64, 64, 64), posdraw)
+        size = self.viewport.px(64)
+        for piece_i in self.pieces_in(rect, 'free'):
             pos = self.gs.p_positions[piece_i]
-            render = self.render_piece(desc, piece_i,64, rotation=pos['r'])
-            pos_px = None
-            filled.add((pos['ii'], pos['uu']))
-            if pos['type'] == 'board':
-                pos_px = self.gs.board_pos_px(pos['ii'], pos['uu'])
-            elif pos['type'] == 'free':
-                pos_px = self.gs.laying_pos_px(pos['ii'], pos['uu'])
-            background.blit(render, pos_px)
-
-        # Draw empty board
-        for i in range(5):
-            for u in range(7):
-                if (i, u) in filled:
-                    continue
-                pos_px = self.gs.board_pos_px(i, u)
-                render = self.render_piece('wwww', 0, 64)
-                background.blit(render, pos_px)
-
+            pos_px = self.viewport.to_screen(self.gs.laying_pos_px(pos['ii'], pos['uu']))
+            layer.blit(self.render_piece(self.gs.p_descriptions[piece_i], piece_i, size, rotation=pos['r']), pos_px)
+        layer.set_clip(None)
+
+    def overlay_items(self):
+        """What goes on top of the layers this frame: (key, signature, make surface, position).
+        Surfaces are only made again when their signature changes."""
+        items = []
         # Draw cursor piece
         if self.gs.selected_piece is not None and self.gs.cur_player == self.gs.me:
-            hovered_board_slot = self.gs.board_cell_by_px_pos(pygame.mouse.get_pos())
-            hovered_piece = self.gs.locate_piece_by_px_pos(pygame.mouse.get_pos())
+            mouse_pos = self.viewport.to_world(pygame.mouse.get_pos())
+            hovered_board_slot = self.gs.board_cell_by_px_pos(mouse_pos)
+            hovered_piece = self.gs.locate_piece_by_px_pos(mouse_pos)
             if hovered_board_slot is not None and hovered_piece is None:
                 p_i = self.gs.selected_piece
-                render = self.render_piece(self.gs.p_descriptions[p_i],
-                                           p_i, 64,
-                                           rotation=self.gs.p_positions[p_i]['r'])
-                render.fill((255, 255, 255, int(255 * 0.6)), None, pygame.BLEND_RGBA_MULT)
-                pos_px = self.gs.board_pos_px(hovered_board_slot[0], hovered_board_slot[1])
-                background.blit(render, pos_px)
+                size = self.viewport.px(64)
+                def make_ghost():
+                    render = self.render_piece(self.gs.p_descriptions[p_i], p_i, size,
+                                               rotation=self.gs.p_positions[p_i]['r']).copy()
+                    render.fill((255, 255, 255, int(255 * 0.6)), None, pygame.BLEND_RGBA_MULT)
+                    return render
+                items.append(('ghost', (p_i, self.gs.p_positions[p_i]['r'], size), make_ghost,
+                              self.viewport.to_screen(self.gs.board_pos_px(*hovered_board_slot))))
 
         # Draw your turn indicator
         if self.gs.cur_player is not None and self.gs.cur_player in self.gs.player_data:
             if len(self.gs.player_data.keys()) > 1:
-                color = self.gs.player_data[self.gs.cur_player]['color'].copy()
+                color = self.gs.player_data[self.gs.cur_player]['color']
                 is_active = self.gs.me == self.gs.cur_player and self.gs.score is None
-                render = self.render_turn_indicator(color, is_active)
-                background.blit(render, (44, 64))
+                # Animation is a handful of precomputed frames, the indicator is only dirty when the frame changes
+                frame = self.turn_indicator_frame() if is_active else None
+                items.append(('turn', (tuple(color), is_active, frame),
+                              lambda: self.render_turn_indicator(color.copy(), is_active), (44, 64)))
 
         # Draw cursors
         for player in self.gs.player_data.keys():
             data = self.gs.player_data[player]
-            render = self.render_cursor(data['color'].copy())
             if self.gs.me == player:
-                pygame.mouse.set_cursor(pygame.cursors.Cursor((0, 0), render))
-            else:
-                # pos = data['curpos'] if self.gs.me != player else pygame.mouse.get_pos()
-                if self.gs.score is None and 'curpos' in data and data['curpos'] is not None:
-                    background.blit(render, data['curpos'])
+                sig = (tuple(data['color']), self.re)
+                if sig != self.own_cursor_sig:
+                    self.own_cursor_sig = sig
+                    try:
+                        pygame.mouse.set_cursor(pygame.cursors.Cursor((0, 0), self.render_cursor(data['color'].copy())))
+                    except pygame.error:
+                        pass  # Headless video drivers have no cursors
+            elif self.gs.score is None and player in self.cursor_tracks:
+                color = data['color']
+                items.append((('cursor', player), tuple(color), lambda c=color: self.render_cursor(c.copy()),
+                              self.viewport.to_screen(self.cursor_tracks[player].position())))
 
         # Draw game over score
         if self.gs.score is not None:
-            score_box = self.render_score_box(self.gs.score)
-            background.blit(score_box, (200, 200))
+            score = self.gs.score
+            items.append(('score', tuple(sorted(score.items())), lambda: self.render_score_box(score), (200, 200)))
 
-        screen.blit(background, (0, 0))
+        # F3: where the frame time goes
+        if self.show_stats:
+            items.append(('stats', int(time.monotonic() * self.STATS_REFRESH), self.render_stats,
+                          (self.viewport.size[0] - 268, 8)))
+        return items
+
+    def draw(self, screen):
+        """Redraws only what changed. Returns the dirty rectangles, or None if the whole screen is new."""
+        self.viewport.size = screen.get_size()
+        view = self.viewport.state()
+        full = self.layers is None or self.drawn_re != self.re or self.drawn_view != view
+        rebuilt = self.layers is None or self.drawn_re != self.re or self.drawn_view[2:] != view[2:]
+        if rebuilt:
+            self.build_layers(screen)
+        elif self.drawn_view != view:
+            self.scroll_layers(view[0] - self.drawn_view[0], view[1] - self.drawn_view[1])
+            self.drawn_view = view
+        self.profiler.lap('layers')
+
+        # Which pieces moved, turned, got (de)selected or placed. Only the ones GameState says were touched
+        placed_dirty, free_dirty = [], []
+        screen_rect = screen.get_rect()
+        for piece_i in self.gs.take_changed():
+            sig = self.piece_sig(piece_i)
+            old = self.drawn_pieces.get(piece_i)
+            if old == sig:
+                continue
+            if sig is None:
+                del self.drawn_pieces[piece_i]
+            else:
+                self.drawn_pieces[piece_i] = sig
+            if rebuilt:
+                continue  # Already drawn as it is now
+            for s in [old, sig]:
+                if s is None:
+                    continue
+                rect = self.piece_rect({'type': s[0], 'ii': s[1], 'uu': s[2]})
+                if rect is not None and rect.colliderect(screen_rect):
+                    (placed_dirty if s[0] == 'board' else free_dirty).append(rect)
+
+        for rect in placed_dirty:
+            self.redraw_placed(rect)
+        for rect in placed_dirty + free_dirty:
+            self.redraw_free(rect)
+        dirty = placed_dirty + free_dirty
+        self.profiler.lap('pieces')
+
+        # Overlay: whatever changed leaves a hole behind, and gets drawn at its new spot
+        items = self.overlay_items()
+        drawn = {}
+        for key, sig, make, pos in items:
+            cached = self.overlay_cache.get(key)
+            if cached is None or cached[0] != sig:
+                cached = self.overlay_cache[key] = (sig, make())
+            rect = cached[1].get_rect(topleft=pos)
+            drawn[key] = (sig, rect)
+            if self.overlay_drawn.get(key) != (sig, rect):
+                dirty.append(rect)
+                if key in self.overlay_drawn:
+                    dirty.append(self.overlay_drawn[key][1])
+        for key in self.overlay_drawn.keys() - drawn.keys():
+            dirty.append(self.overlay_drawn[key][1])
+            del self.overlay_cache[key]
+        self.overlay_drawn = drawn
+        self.profiler.lap('overlay')
+
+        if full:
+            screen.blit(self.layers['free'], (0, 0))
+            for key, _, _, _ in items:
+                screen.blit(self.overlay_cache[key][1], drawn[key][1])
+            self.profiler.lap('blit')
+            return None
+        for rect in dirty:
+            screen.blit(self.layers['free'], rect, rect)
+        for key, _, _, _ in items:
+            if drawn[key][1].collidelist(dirty) != -1:
+                screen.blit(self.overlay_cache[key][1], drawn[key][1])
+        self.profiler.lap('blit')
+        return dirty
 
 
 class Gui:
     def __init__(self):
         pygame.init()
-        self.connector = Connector()
+        self.scheduler = FrameScheduler(91)
+        self.connector = Connector(on_message=self.scheduler.poke)
         self.phase_i = None
         self.phase: Phase | None = None
         self.screen = None
         self.tp = TextureProvider()
+        self.atlas = PieceAtlas(self.tp)  # Outlives phases, pieces of the last game are likely to show up again
 
     async def reset_phase(self):
         self.screen = pygame.display.set_mode([500, 300])
         self.phase_i = 0
-        self.phase = TextInputPhase('Enter server IP:')
+        self.phase = TextInputPhase('Enter server IP:', self.tp)
 
     async def switch_phase(self):
         result: str = self.phase.result
         self.tp.clear_cache()
         # pygame.mouse.set_visible(True)
-        if self.phase_i == 0:
+        if self.phase_i == 0 and result.endswith('.fsqr'):
+                try:
+                    self.connector = ReplayConnector(result)
+                except Exception as e:
+                    print(e)
+                    await self.reset_phase()
+                    return
+                self.screen = pygame.display.set_mode([800, 800])
+                self.phase_i = 2
+                self.phase = GamingPhase(self.connector, self.tp, self.atlas, spectating=True)
+        elif self.phase_i == 0:
                 try:
                     await self.connector.activate(result)
                     self.phase_i = 1
-                    self.phase = TextInputPhase('Enter room:')
+                    self.phase = TextInputPhase('Enter room:', self.tp)
                 except Exception as e:
                     if e.__class__ is asyncio.exceptions.TimeoutError:
                         print('Connection timed out')
@@ -489,15 +1201,25 @@ class Gui:
                 if result.startswith('op'):
                     token = result.split(':')[0][2:]
                     await self.connector.send({'cmd': 'op', 'token': token})
-                    result = result.split(':')[1]
-                await self.connector.send({'cmd': 'room', 'game_id': result})
+                    result = result.split(':', 1)[1]
+                spectating = result.startswith('watch:')
+                if spectating:
+                    await self.connector.send({'cmd': 'spectate', 'game_id': result[len('watch:'):]})
+                else:
+                    await self.connector.send({'cmd': 'room', 'game_id': result})
                 self.phase_i = 2
-                self.phase = GamingPhase(self.connector, self.tp)
+                self.phase = GamingPhase(self.connector, self.tp, self.atlas, spectating)
                 # pygame.mouse.set_visible(False)
+        elif self.phase_i == 2 and isinstance(self.connector, ReplayConnector):
+                await self.connector.deactivate()
+                self.connector = Connector(on_message=self.scheduler.poke)
+                await self.reset_phase()
         elif self.phase_i == 2:
+                if self.phase.spectating:
+                    await self.connector.send({'cmd': 'unwatch'})  # Or its frames would follow us into the next room
                 self.screen = pygame.display.set_mode([500, 300])
                 self.phase_i = 1
-                self.phase = TextInputPhase('Enter room:')
+                self.phase = TextInputPhase('Enter room:', self.tp)
 
     async def run(self):
         splash_text = random.choice([
@@ -520,21 +1242,30 @@ class Gui:
         pygame.display.set_caption(f'FriendlySquares - {splash_text}')
         # Why doesn't it work?!
         # pygame.display.set_icon(pygame.image.load('res/green_tile.png'))
-        clock = pygame.time.Clock()
 
         running = True
         await self.reset_phase()
         while running:
+            profiler = self.phase.profiler
             await self.phase.prep()
+            profiler.lap('prep')
             for event in pygame.event.get():
                 if event.type == pygame.QUIT:
                     running = False
                 await self.phase.process_event(event)
-            self.phase.draw(self.screen)
+            profiler.lap('events')
+            dirty = self.phase.draw(self.screen)
+            profiler.lap('draw')
             if self.phase.finished:
                 await self.switch_phase()
-            pygame.display.flip()
-            clock.tick(91)
+            if dirty is None:
+                pygame.display.flip()
+            else:
+                pygame.display.update(dirty)
+            profiler.lap('present')
+            await self.scheduler.wait()
+            profiler.lap('wait')
+            profiler.end_frame()
         pygame.quit()
 
 
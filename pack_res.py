@@ -0,0 +1,67 @@
+# Packs res/ into a single bundle the client memory-maps at startup (gui_client.TextureProvider).
+# Images are stored already decoded, as raw RGBA, so there's no PNG decoding at runtime. Pieces that look
+# the same whatever the seed (empty cells, bricks) are stored already composited and blurred, for every zoom level.
+# Layout: magic, <I header size, JSON header (name -> offset, length, size), then the blobs.
+# python pack_res.py
+import argparse
+import json
+import os
+import struct
+
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+import pygame
+
+from gui_client import BUNDLE_MAGIC, BUNDLE_PATH, PieceAtlas, TextureProvider, Viewport, res_path
+
+BAKED_GEMS = ['wwww', 'rrrr']
+
+
+def pack(path):
+    res_dir = os.path.dirname(res_path(''))
+    blobs = {}  # Name -> (bytes, size or None)
+    for fn in sorted(os.listdir(res_dir)):
+        name, ext = os.path.splitext(fn)
+        if ext == '.png':
+            surf = pygame.image.load(os.path.join(res_dir, fn))
+            blobs[name] = (pygame.image.tobytes(surf, 'RGBA'), surf.get_size())
+        else:
+            with open(os.path.join(res_dir, fn), 'rb') as f:
+                blobs[fn] = (f.read(), None)  # Fonts and such, as they are
+
+    atlas = PieceAtlas(TextureProvider(bundle_path=None))
+    for size in sorted({int(64 * zoom) for zoom in Viewport.ZOOMS}):
+        for description in BAKED_GEMS:
+            surf = atlas.build_gem_piece(description, 0, size)
+            blobs[f'baked_gem_{description}_{size}'] = (pygame.image.tobytes(surf, 'RGBA'), surf.get_size())
+
+    # Header size depends on the offsets and the other way around, so lay out the blobs relative first
+    entries = {}
+    relative = 0
+    for name, (data, size) in blobs.items():
+        entries[name] = {'offset': relative, 'length': len(data)}
+        if size is not None:
+            entries[name]['size'] = list(size)
+        relative += len(data)
+    base = 0
+    while True:
+        header = json.dumps({'entries': {name: {**entry, 'offset': entry['offset'] + base}
+                                         for name, entry in entries.items()}}).encode()
+        if len(BUNDLE_MAGIC) + 4 + len(header) <= base:
+            break
+        base = len(BUNDLE_MAGIC) + 4 + len(header)  # Offsets got longer, so did the header. Again
+    header += b' ' * (base - len(BUNDLE_MAGIC) - 4 - len(header))
+
+    with open(path, 'wb') as f:
+        f.write(BUNDLE_MAGIC)
+        f.write(struct.pack('<I', len(header)))
+        f.write(header)
+        for data, _ in blobs.values():
+            f.write(data)
+    print(f'Packed {len(blobs)} resources into {path} ({os.path.getsize(path) / 1e6:.1f} MB)')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-o', '--output', default=BUNDLE_PATH)
+    args = parser.parse_args()
+    pack(args.output)
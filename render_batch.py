@@ -0,0 +1,205 @@
+# Headless batch renderer: finished boards to PNG thumbnails, replays to videos. No window, a process pool,
+# every worker keeps its own textures and piece atlas for all the boards it gets.
+# Boards come from simulator files (.fsqc), or JSON lines (.jsonl) of colored states as Game.get_colored_state
+# makes them, either bare lists of rows or {"name": ..., "board": [...]}. Replays (.fsqr) turn into a video
+# with a frame per turn, plus a thumbnail of the final board. Videos need imageio (requirements_full.txt).
+# python render_batch.py sims.fsqc -o thumbs --size 24
+# python render_batch.py replays/*.fsqr -o clips --video mp4 --fps 4
+import argparse
+import json
+import multiprocessing
+import os
+import struct
+import tempfile
+import time
+import zlib
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+import pygame
+
+from gui_client import PieceAtlas, RenderEngine, TextureProvider
+from replay import ReplayReader
+from simulator import read_columnar
+
+BACKGROUND = (250, 250, 250)  # Same as the game's
+SEED_VARIANTS = 8  # Thumbnails don't know which piece was which, cells get one of a few looks instead
+
+_worker = None  # (atlas, render engine, piece size, output directory, PNG compression level) of this process
+
+
+def init_worker(engine, size, out_dir, png_level):
+    global _worker
+    tp = TextureProvider()
+    _worker = PieceAtlas(tp, size=size, max_pieces=1024), RenderEngine[engine], size, out_dir, png_level
+
+
+def save_png(surf, path, level=1):
+    """Unfiltered RGB PNG. pygame.image.save squeezes harder but takes ~4x longer, 10x longer than drawing the board."""
+    w, h = surf.get_size()
+    raw = pygame.image.tobytes(surf, 'RGB')
+    stride = 3 * w
+    data = b''.join(b'\x00' + raw[y * stride:(y + 1) * stride] for y in range(h))
+
+    def chunk(tag, body):
+        return struct.pack('>I', len(body)) + tag + body + struct.pack('>I', zlib.crc32(tag + body))
+    with open(path, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', w, h, 8, 2, 0, 0, 0)) +
+                chunk(b'IDAT', zlib.compress(data, level)) + chunk(b'IEND', b''))
+
+
+def render_cells(atlas, re, cells, h, w, size):
+    """cells: (i, u, description, seed, rotation) of every piece to draw, empty cells are 'wwww'."""
+    surf = pygame.Surface((w * size, h * size))
+    surf.fill(BACKGROUND)
+    for i, u, description, seed, rotation in cells:
+        surf.blit(atlas.piece(re, description, seed, rotation, size), (u * size, i * size))
+    return surf
+
+
+def board_cells(board):
+    """Colored state (2h rows of 2w colors) to cells. Pieces in it are already rotated."""
+    h, w = len(board) // 2, len(board[0]) // 2
+    return [(i, u, board[2 * i][2 * u:2 * u + 2] + board[2 * i + 1][2 * u:2 * u + 2], (i * w + u) % SEED_VARIANTS, 0)
+            for i in range(h) for u in range(w)], h, w
+
+
+def positions_cells(descriptions, positions, h, w):
+    placed = {(p['ii'], p['uu']): (idx, p['r']) for idx, p in enumerate(positions) if p['type'] == 'board'}
+    cells = []
+    for i in range(h):
+        for u in range(w):
+            idx, r = placed.get((i, u), (None, 0))
+            cells.append((i, u, 'wwww', 0, 0) if idx is None else (i, u, descriptions[idx], idx, r))
+    return cells
+
+
+def render_boards(boards):
+    """Job: a list of (file name, colored state)."""
+    atlas, re, size, out_dir, png_level = _worker
+    for name, board in boards:
+        cells, h, w = board_cells(board)
+        save_png(render_cells(atlas, re, cells, h, w, size), os.path.join(out_dir, name), png_level)
+    return len(boards)
+
+
+def render_replay(path, video, fps):
+    """Job: one replay file. A frame per turn into a video, and the final board as a thumbnail."""
+    atlas, re, size, out_dir, png_level = _worker
+    stem = os.path.splitext(os.path.basename(path))[0]
+    reader = ReplayReader(path)
+    descriptions, h, w = [], 5, 7
+    frames = []
+    for msg in reader.messages():
+        if msg['cmd'] == 'descriptions':
+            descriptions, h, w = msg['descriptions'], msg.get('h', h), msg.get('w', w)
+        elif msg['cmd'] == 'positions':
+            frames.append(render_cells(atlas, re, positions_cells(descriptions, msg['positions'], h, w), h, w, size))
+    reader.close()
+    if not frames:
+        return 0
+    save_png(frames[-1], os.path.join(out_dir, f'{stem}.png'), png_level)
+    if video is not None:
+        import imageio.v2 as imageio
+        import numpy
+        with imageio.get_writer(os.path.join(out_dir, f'{stem}.{video}'), fps=fps) as writer:
+            for frame in frames:
+                writer.append_data(numpy.ascontiguousarray(pygame.surfarray.array3d(frame).swapaxes(0, 1)))
+    return len(frames)
+
+
+def run_job(job):
+    """(kind, how many got rendered, what went wrong or None). A bad file must not take the whole batch down."""
+    kind, payload = job[0], job[1:]
+    try:
+        return kind, render_boards(*payload) if kind == 'boards' else render_replay(*payload), None
+    except Exception as e:
+        what = payload[0][0][0] + '...' if kind == 'boards' else payload[0]
+        return kind, 0, f'{what}: {e!r}'
+
+
+def video_problem(video, fps):
+    """Writes a tiny video, so a missing writer (mp4 needs imageio-ffmpeg) shows up before any work is done.
+    None if it went fine, else what went wrong."""
+    try:
+        import imageio.v2 as imageio
+        import numpy
+        with tempfile.TemporaryDirectory() as d:
+            with imageio.get_writer(os.path.join(d, f'check.{video}'), fps=fps) as writer:
+                writer.append_data(numpy.zeros((16, 16, 3), numpy.uint8))
+    except Exception as e:
+        return repr(e)
+    return None
+
+
+def board_jobs(path, board_w, batch):
+    """Boards of a simulator or JSON lines file, in batches. The file itself is read here, only boards travel."""
+    stem = os.path.splitext(os.path.basename(path))[0]
+    boards = []
+    if path.endswith('.fsqc'):
+        meta, tables = read_columnar(path)
+        flat = tables['games']['board'].tobytes().decode()
+        width = meta['widths']['games']['board']
+        cols = 2 * board_w
+        for n, game in enumerate(tables['games']['game']):
+            cells = flat[n * width:(n + 1) * width]
+            boards.append((f'{stem}_{game:06}.png', [cells[r:r + cols] for r in range(0, width, cols)]))
+    else:
+        with open(path) as f:
+            for n, line in enumerate(f):
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                if isinstance(entry, dict):
+                    boards.append((f"{entry.get('name', f'{stem}_{n:06}')}.png", entry['board']))
+                else:
+                    boards.append((f'{stem}_{n:06}.png', entry))
+    return [('boards', boards[i:i + batch]) for i in range(0, len(boards), batch)]
+
+
+def render_batch(paths, out_dir, engine='GEMS', size=32, video='mp4', fps=4, board_w=7, workers=None, batch=128,
+                 png_level=1):
+    os.makedirs(out_dir, exist_ok=True)
+    if video is not None and any(p.endswith('.fsqr') for p in paths):
+        problem = video_problem(video, fps)  # Find out now, not in every worker
+        if problem is not None:
+            print(f'Cannot write {video} videos ({problem}), replays get a thumbnail only. '
+                  f'pip install imageio imageio-ffmpeg, or try --video gif')
+            video = None
+    jobs = []
+    for path in paths:
+        if path.endswith('.fsqr'):
+            jobs.append(('replay', path, video, fps))
+        else:
+            jobs += board_jobs(path, board_w, batch)
+    done = {'boards': 0, 'replay': 0}
+    failed = []
+    t_start = time.monotonic()
+    with multiprocessing.Pool(workers, initializer=init_worker, initargs=(engine, size, out_dir, png_level)) as pool:
+        for kind, n, problem in pool.imap_unordered(run_job, jobs):
+            done[kind] += n
+            if problem is not None:
+                print(f'Failed: {problem}')
+                failed.append(problem)
+    elapsed = time.monotonic() - t_start
+    print(f'Rendered {done["boards"]} boards and {done["replay"]} replay frames into {out_dir} in {elapsed:.2f}s '
+          f'({done["boards"] / max(elapsed, 1e-9):.0f} boards/s)' + (f', {len(failed)} jobs failed' if failed else ''))
+    return done
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('paths', nargs='+', help='.fsqc (simulator), .jsonl (colored states) or .fsqr (replay) files')
+    parser.add_argument('-o', '--output', default='renders')
+    parser.add_argument('--engine', default='GEMS', choices=[e.name for e in RenderEngine])
+    parser.add_argument('--size', default=32, type=int, help='Piece size, px')
+    parser.add_argument('--video', default='mp4', help='Video format for replays (mp4, gif, ...), none for thumbnails only')
+    parser.add_argument('--fps', default=4.0, type=float, help='Turns per second in videos')
+    parser.add_argument('--board-w', default=7, type=int, help='Board width in pieces, simulator files do not say')
+    parser.add_argument('--workers', default=None, type=int)
+    parser.add_argument('--batch', default=128, type=int, help='Boards per job')
+    parser.add_argument('--png-level', default=1, type=int, help='zlib level, 9 for smaller but slower thumbnails')
+    args = parser.parse_args()
+    render_batch(args.paths, args.output, args.engine, args.size, None if args.video == 'none' else args.video,
+                 args.fps, args.board_w, args.workers, args.batch, args.png_level)
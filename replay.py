@@ -0,0 +1,221 @@
+# Replays: a room's message stream, squashed into a seekable file.
+# Layout: magic, header block (descriptions), one zlib block per turn, turn index, trailer.
+# Every block is JSON lines. Positions are stored as a full keyframe every few turns and as deltas otherwise,
+# so jumping to turn N decodes the header, the nearest keyframe and a handful of tiny blocks - never the whole file.
+# python replay.py game.fsqr --turn 10
+import argparse
+import asyncio
+import json
+import struct
+import time
+import zlib
+
+REPLAY_MAGIC = b'FSQR1\n'
+TRAILER_MAGIC = b'FSQRIX'
+TRAILER = struct.Struct('<QI6s')  # Index offset, turn count, magic
+
+
+class ReplayWriter:
+    def __init__(self, path, game_id, keyframe_every=8, player_data_interval=0.1):
+        self.f = open(path, 'wb')
+        self.f.write(REPLAY_MAGIC)
+        self.game_id = game_id
+        self.keyframe_every = keyframe_every
+        self.player_data_interval = player_data_interval
+        self.t_start = time.monotonic()
+        self.header = [{'cmd': 'replay', 'game_id': game_id, 'time': time.time(), 'keyframe_every': keyframe_every}]
+        self.header_offset = None
+        self.offsets = []
+        self.block = []
+        self.last_positions = None
+        self.pending_player_data = None
+        self.last_player_data_t = -1.0
+
+    def stamp(self, msg):
+        return {'t': round(time.monotonic() - self.t_start, 3), **msg}
+
+    def record(self, msg):
+        """Takes a message as it would go to the room's players."""
+        if msg['cmd'] == 'descriptions' and self.header_offset is None:
+            self.header.append(msg)
+            return
+        if msg['cmd'] == 'player_data':
+            # Cursor spam gets squashed to a few updates per second, the latest one wins
+            self.pending_player_data = self.stamp(msg)
+            if self.pending_player_data['t'] - self.last_player_data_t >= self.player_data_interval:
+                self.flush_player_data()
+            return
+        self.flush_player_data()
+        if msg['cmd'] == 'positions':
+            self.block.append(self.stamp(self.encode_positions(msg['positions'])))
+            return
+        self.block.append(self.stamp(msg))
+
+    def flush_player_data(self):
+        if self.pending_player_data is not None:
+            # Server hands us its live dicts, freeze them
+            self.block.append(json.loads(json.dumps(self.pending_player_data)))
+            self.last_player_data_t = self.pending_player_data['t']
+            self.pending_player_data = None
+
+    def encode_positions(self, positions):
+        is_keyframe = len(self.offsets) % self.keyframe_every == 0 or self.last_positions is None
+        if is_keyframe:
+            msg = {'cmd': 'positions', 'positions': positions}
+        else:
+            changed = {str(i): p for i, p in enumerate(positions) if p != self.last_positions[i]}
+            msg = {'cmd': 'positions_delta', 'changed': changed}
+        self.last_positions = [dict(p) for p in positions]
+        return msg
+
+    def write_block(self, msgs):
+        offset = self.f.tell()
+        raw = zlib.compress('\n'.join(json.dumps(m, separators=(',', ':')) for m in msgs).encode(), 9)
+        self.f.write(struct.pack('<I', len(raw)))
+        self.f.write(raw)
+        return offset
+
+    def seal(self):
+        if self.header_offset is None:
+            self.header_offset = self.write_block(self.header)
+        self.flush_player_data()
+        if self.block:
+            self.offsets.append(self.write_block(self.block))
+        self.block = []
+
+    def next_turn(self, positions):
+        """Seals the current turn. The new turn starts with the given positions."""
+        self.seal()
+        self.block.append(self.stamp(self.encode_positions(positions)))
+
+    def close(self):
+        if self.f.closed:
+            return
+        self.seal()
+        index_offset = self.f.tell()
+        self.f.write(struct.pack(f'<Q{len(self.offsets)}Q', self.header_offset, *self.offsets))
+        self.f.write(TRAILER.pack(index_offset, len(self.offsets), TRAILER_MAGIC))
+        self.f.close()
+
+
+class ReplayReader:
+    def __init__(self, path):
+        self.f = open(path, 'rb')
+        assert self.f.read(len(REPLAY_MAGIC)) == REPLAY_MAGIC, 'Not a replay file'
+        self.f.seek(-TRAILER.size, 2)
+        index_offset, count, magic = TRAILER.unpack(self.f.read(TRAILER.size))
+        assert magic == TRAILER_MAGIC, 'Replay file is truncated (game never ended?)'
+        self.f.seek(index_offset)
+        index = struct.unpack(f'<Q{count}Q', self.f.read(8 * (count + 1)))
+        self.header_offset, self.offsets = index[0], index[1:]
+        self.header = self.read_block(self.header_offset)
+        self.keyframe_every = self.header[0]['keyframe_every']
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def read_block(self, offset):
+        self.f.seek(offset)
+        size = struct.unpack('<I', self.f.read(4))[0]
+        return [json.loads(line) for line in zlib.decompress(self.f.read(size)).decode().split('\n') if line]
+
+    def turn(self, n, positions=None):
+        """Messages of turn n, deltas already applied. Pass the previous turn's positions to skip the keyframe walk."""
+        if positions is None:
+            positions = []
+            for k in range(n - n % self.keyframe_every, n):
+                positions = self.apply(self.read_block(self.offsets[k]), positions)[1]
+        msgs, _ = self.apply(self.read_block(self.offsets[n]), positions)
+        return msgs
+
+    def apply(self, block, positions):
+        msgs = []
+        for m in block:
+            if m['cmd'] == 'positions_delta':
+                positions = [dict(p) for p in positions]
+                for i, p in m['changed'].items():
+                    positions[int(i)] = p
+                m = {'t': m['t'], 'cmd': 'positions', 'positions': positions}
+            elif m['cmd'] == 'positions':
+                positions = m['positions']
+            msgs.append(m)
+        return msgs, positions
+
+    def messages(self, start_turn=0):
+        """Header (descriptions), then everything from start_turn on."""
+        yield from self.header
+        positions = None
+        for n in range(start_turn, len(self)):
+            msgs = self.turn(n, positions)
+            for m in msgs:
+                if m['cmd'] == 'positions':
+                    positions = m['positions']
+            yield from msgs
+
+    def close(self):
+        self.f.close()
+
+
+class ReplayConnector:
+    """Pretends to be a server connection, but plays a replay file. Feed it to GamingPhase."""
+    def __init__(self, path, speed=1.0):
+        self.reader = ReplayReader(path)
+        self.speed = speed
+        self.seek(0)
+
+    async def send(self, msg):
+        pass  # Nobody is listening
+
+    async def activate(self, where):
+        pass
+
+    async def deactivate(self):
+        self.reader.close()
+
+    def seek(self, turn):
+        self.start_turn = max(0, min(turn, len(self.reader) - 1))
+        self.cur_turn = self.start_turn - 1  # Every turn block starts with positions
+        self.stream = self.reader.messages(self.start_turn)
+        self.next_msg = None
+        self.t_base = None
+        self.done = False
+
+    def seek_relative(self, delta):
+        self.seek(self.cur_turn + delta)
+
+    async def messages(self):
+        while True:
+            if self.next_msg is None:
+                self.next_msg = next(self.stream, None)
+                if self.next_msg is None:
+                    self.done = True
+                    return
+            if 't' in self.next_msg:
+                if self.t_base is None:
+                    self.t_base = time.monotonic() - self.next_msg['t'] / self.speed
+                if (time.monotonic() - self.t_base) * self.speed < self.next_msg['t']:
+                    return  # Not yet
+            msg, self.next_msg = self.next_msg, None
+            if msg['cmd'] == 'positions':
+                self.cur_turn += 1
+            yield msg
+
+
+async def play_to_console(path, turn, speed):
+    from console_client import Client
+    c = Client(None)
+    connector = ReplayConnector(path, speed)
+    connector.seek(turn)
+    while not connector.done:
+        async for msg in connector.messages():
+            await c.process_message(msg)
+        await asyncio.sleep(0.01)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path')
+    parser.add_argument('--turn', default=0, type=int, help='Turn to start from')
+    parser.add_argument('--speed', default=1.0, type=float)
+    args = parser.parse_args()
+    asyncio.run(play_to_console(args.path, args.turn, args.speed))
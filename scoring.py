@@ -3,18 +3,28 @@ try:
     import numpy
     def wrap_numpy(f):
         return numpy.array(f)
+
+    @njit
+    def zeros(n):
+        return numpy.zeros(n, numpy.int64)
 except Exception as e:
     print(f"WARINING! Numba failed to import! Score calculation will lag!")
     def wrap_numpy(f):
         return f
     from builtins import range as prange
-    def njit(parallel=False):
-        def Inner(func): return lambda *args, **kwargs: func(*args, **kwargs)
-        return Inner
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):  # Used as a bare @njit
+            return args[0]
+        return lambda func: func
+
+    def zeros(n):
+        return [0] * n
 
 
 @njit
-def _accurate_scoring_core(f, o, b, heuristic):
+def _accurate_scoring_core(f, o, b, heuristic, budget=-1):
+    """Budget is how many search steps each color may take, -1 for no limit.
+    A color that runs out of steps is scored -1, as in "unknown"."""
     scores = [0, 0, 0]
 
     # Brute force implementation that turned out to be incredibly slow
@@ -24,7 +34,10 @@ def _accurate_scoring_core(f, o, b, heuristic):
     for color in range(3):
         #processed_states = set()
         #processed_states.add(0)
+        steps = 0
         for start_i in range(1, len(f) - 1):
+            if scores[color] < 0:
+                break
             for start_u in range(1, len(f[0]) - 1):
                 if color != f[start_i][start_u]:
                     continue
@@ -36,6 +49,9 @@ def _accurate_scoring_core(f, o, b, heuristic):
                 st = [-1]
                 #st_bitset = 0
                 while len(st):
+                    steps += 1
+                    if budget >= 0 and steps > budget:
+                        break
                     scores[color] = max(scores[color], len(st))
                     bite_head = True
                     o[pos_i][pos_u] = True
@@ -62,10 +78,16 @@ def _accurate_scoring_core(f, o, b, heuristic):
                             break
                         pos_i -= D_Is[st[-1]]
                         pos_u -= D_Us[st[-1]]
+                if budget >= 0 and steps > budget:
+                    for i in range(len(o)):  # The search got cut short, clean up after it
+                        for u in range(len(o[0])):
+                            o[i][u] = False
+                    scores[color] = -1
+                    break
     return scores
 
 
-def score(f, accurate=False, heuristic=False):
+def score(f, accurate=False, heuristic=False, iters=20_000, budget=-1):
     f = ['b' * len(f[0])] + f + ['r' * len(f[0])]
     f = ['b' + x + 'b' for x in f]
     def conv(el):
@@ -88,86 +110,96 @@ def score(f, accurate=False, heuristic=False):
                 b_c[f[i][u]] += 1
         b = wrap_numpy(b)
 
-        sc = _accurate_scoring_core(f, o, b, heuristic)
+        sc = _accurate_scoring_core(f, o, b, heuristic, budget)
     else:
-        sc = approximate_score(f)
-    scores = {'B': sc[0], 'G': sc[1], 'Y': sc[2], 'total': sum(sc)}
+        sc = approximate_score(f, iters)
+    scores = {'B': sc[0], 'G': sc[1], 'Y': sc[2], 'total': sum(sc) if min(sc) >= 0 else -1}
     return scores
 
 @njit
+def _touching(a, b, w):
+    """Are flat cells a and b neighbors (diagonals count)? w is the row length."""
+    return abs(a // w - b // w) <= 1 and abs(a % w - b % w) <= 1
+
+
+@njit(nogil=True)
 def approximate_score(f, iters=20_000):
     """Calculates score using Monte-carlo. In each iteration, a random cell is used.
     Then, extend operation is used as many times as possible, each time incrementing the snake length by one.
     Each time, incrementing is attempted for a random cell. Extending can be done in four ways:
-    first cell, extend "tail", extend "head", or extend in the middle."""
+    first cell, extend "tail", extend "head", or extend in the middle.
+    Cells are flat indices, the snake is a linked list through nxt/prv, and "is it in the snake / queued"
+    is an iteration stamp per cell, so nothing needs clearing and an iteration never walks the snake."""
     f_ii = len(f) - 2
     f_uu = len(f[0]) - 2
+    w = len(f[0])
+    n = len(f) * w
 
-    scores = [0, 0, 0]
-
-    # Quick pseudorandom number generator
-    random_state = 777
-    def new_coords():
-        nonlocal random_state
-
-        random_state = (28 * random_state + 13) % 1_000_033
-        q_i = 1 + (random_state >> 8) % f_ii
-        q_u = 1 + random_state % f_uu
-        return q_i, q_u
+    colors = zeros(n)
+    for i in range(len(f)):
+        for u in range(w):
+            colors[i * w + u] = f[i][u]
+    around = [-w - 1, -w, -w + 1, -1, 1, w - 1, w, w + 1]
 
-    def is_neighbor(i1, u1, i2, u2):
-        return abs(i1 - i2) <= 1 and abs(u1 - u2) <= 1
+    nxt = zeros(n)
+    prv = zeros(n)
+    in_snake = zeros(n)  # Iteration (+1) that put the cell into the snake
+    queued = zeros(n)  # Same, for being in the bag
+    bag = zeros(n)  # Cells waiting for their try, in no particular order
 
-    snaek = []
-    queued = [[False] * len(x) for x in f]
-    done = [[False] * len(x) for x in f]
+    scores = [0, 0, 0]
+    random_state = 777  # Quick pseudorandom number generator
     for current_iter in range(iters):
-        i, u = 1 + (current_iter % f_ii), 1 + ((current_iter // f_ii) % f_uu)
-        color = f[i][u]
+        gen = current_iter + 1
+        cell = (1 + current_iter % f_ii) * w + 1 + (current_iter // f_ii) % f_uu
+        color = colors[cell]
         if color < 0:
             continue
 
-        queued[i][u] = True
-        qq = 1
-        while qq:
-            while not queued[i][u]:
-                i, u = new_coords()
-            approved = False
-            idx = -1
-            if len(snaek):
-                if is_neighbor(snaek[0][0], snaek[0][1], i, u):
-                    idx = 0
-                    approved = True
-                elif is_neighbor(snaek[-1][0], snaek[-1][1], i, u):
-                    idx = len(snaek) - 1
-                    approved = True
+        head, tail, length = -1, -1, 0
+        bag[0] = cell
+        bag_len = 1
+        queued[cell] = gen
+        while bag_len:
+            random_state = (28 * random_state + 13) % 1_000_033
+            k = (random_state >> 4) % bag_len
+            cell = bag[k]
+            bag_len -= 1
+            bag[k] = bag[bag_len]
+            queued[cell] = 0
+
+            if length == 0:
+                head, tail = cell, cell
+                prv[cell], nxt[cell] = -1, -1
+            elif _touching(head, cell, w):
+                prv[cell], nxt[cell] = -1, head
+                prv[head] = cell
+                head = cell
+            elif _touching(tail, cell, w):
+                prv[cell], nxt[cell] = tail, -1
+                nxt[tail] = cell
+                tail = cell
             else:
-                approved = True
-                idx = 0
-            if not approved:
-                for snaek_ik in range(0, 103 * (len(snaek) - 1), 103):
-                    snaek_i = snaek_ik % (len(snaek) - 1)
-                    if is_neighbor(snaek[snaek_i][0], snaek[snaek_i][1], i, u) \
-                            and is_neighbor(snaek[snaek_i + 1][0], snaek[snaek_i + 1][1], i, u):
-                        approved = True
-                        idx = snaek_i + 1
-
-            if not approved:
-                queued[i][u] = False
-                qq -= 1
-                continue
-
-            snaek.insert(idx, (i, u))
-            for ni in range(i-1, i+2):
-                for nu in range(u-1, u+2):
-                    if f[ni][nu] == color and not done[ni][nu] and not queued[ni][nu]:
-                        queued[ni][nu] = True
-                        qq += 1
-            done[i][u] = True
-            queued[i][u] = False
-            qq -= 1
-        scores[color] = max(scores[color], len(snaek))
-        for i, u in snaek:
-            done[i][u] = False
-        snaek.clear()
+                # Between two snake cells that both touch this one. Only neighbors can be that, so look at them
+                after = -1
+                for d in range(8):
+                    a = cell + around[(d + random_state) % 8]
+                    if in_snake[a] == gen and nxt[a] >= 0 and _touching(nxt[a], cell, w):
+                        after = a
+                        break
+                if after < 0:
+                    continue  # Dropped, a neighbor joining later may queue it again
+                prv[cell], nxt[cell] = after, nxt[after]
+                prv[nxt[after]] = cell
+                nxt[after] = cell
+            in_snake[cell] = gen
+            length += 1
+
+            for d in around:
+                nb = cell + d
+                if colors[nb] == color and in_snake[nb] != gen and queued[nb] != gen:
+                    queued[nb] = gen
+                    bag[bag_len] = nb
+                    bag_len += 1
+        scores[color] = max(scores[color], length)
     return scores
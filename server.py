@@ -3,13 +3,26 @@
 
 import asyncio
 import argparse
+import bisect
+import contextvars
+import cProfile
+import io
 import json
+import os
+import pstats
 import random
+import re
 import time
 import traceback
+import tracemalloc
 import uuid
+from collections import deque
 import websockets
 import scoring
+import transport
+from audit import ShadowAuditor
+from eventlog import events, LEVELS
+from replay import ReplayWriter
 from constants import DEFAULT_PORT, GAME_VERSION
 
 
@@ -38,56 +51,171 @@ class PiecePos(CustomDict):
         super().__init__({'type': type, 'ii': ii, 'uu': uu, 'r': r})
 
 
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate  # Tokens per second
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last = time.monotonic()
+
+    def take(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens >= 1.0:
+            self.tokens -= 1.0
+            return True
+        return False
+
+    def wait_time(self):
+        """Seconds until the next token."""
+        return max(0.0, (1.0 - self.tokens) / self.rate)
+
+
+# Command -> (tokens per second, burst). '*' is for everything not listed.
+DEFAULT_RATE_LIMITS = {
+    'curpos': (30.0, 10),
+    'put': (5.0, 5),
+    'room': (2.0, 5),
+    'spectate': (2.0, 5),
+    'resume': (1.0, 3),
+    'op': (0.5, 3),
+    'ping': (10.0, 20),
+    '*': (20.0, 40),
+}
+
+# The message being handled, as (client it came from, its id). Each connection is a task of its own, so this is
+# per connection: whatever gets sent to that client meanwhile is a reply, and carries the id back
+replying_to = contextvars.ContextVar('replying_to', default=(None, None))
+
+
 class Client:
-    def __init__(self, ws, path):
-        self.websocket = ws
+    # Bytes of messages kept around for resuming a dropped session, only while holding a seat: nobody else can
+    # resume. Cursors don't count, see send_volatile
+    OUTBOX_BYTES = 64 * 1024
+
+    def __init__(self, ws, path, channel=None, parent=None):
+        self.websocket = ws  # None while the session waits for a reconnect
         self.path = path
+        self.channel = channel  # Set for a room followed over someone else's connection, see Server.open_channel
+        self.parent = parent
+        self.channels: dict[str, Client] = {}  # Channel -> its client, on the connection's own client
         self.client_id = str(uuid.uuid4())
+        self.token = str(uuid.uuid4())
         self.is_op = False
         self.game = None
+        self.watching = None  # Spectators have no game, only the game they watch
+        self.seq = 0
+        self.outbox: deque[tuple[int, str]] = deque()
+        self.outbox_bytes = 0
+        self.buckets: dict[str, TokenBucket] = {}
+        self.violations: dict[str, int] = {}  # Command -> how many times it got rejected or coalesced
+        self.throttled: set[str] = set()  # Commands we already told the client to slow down on
+        self.strikes: TokenBucket | None = None  # Rejected messages it may still send before we hang up
+        self.pending_curpos = None  # Latest cursor position that did not fit into the rate limit
+        self.curpos_handle = None
 
     async def send_stuff(self, msg):
-        await self.websocket.send(json.dumps(msg))
+        to, msg_id = replying_to.get()
+        if to is self and msg_id is not None:
+            msg = {**msg, 'id': msg_id}
+        self.seq += 1
+        raw = json.dumps({**msg, 'seq': self.seq})
+        self.keep(raw)
+        if self.websocket is None:
+            return  # Will be delivered on resume, if it ever comes
+        try:
+            await self.websocket.send(self.tag(raw))
+        except websockets.exceptions.ConnectionClosed:
+            pass  # listen_socket will notice soon enough
+
+    async def send_volatile(self, msg):
+        """For state that is stale by the next update (cursors). No seq, not kept for resuming, and nothing
+        at all while the session waits for a reconnect: whoever resumes just gets the latest one."""
+        if self.websocket is None:
+            return
+        try:
+            await self.websocket.send(self.tag(json.dumps(msg)))
+        except websockets.exceptions.ConnectionClosed:
+            pass
 
+    def keep(self, raw):
+        """Into the outbox, the oldest ones make room. One message is always kept, however big."""
+        if self.game is None:
+            self.outbox.clear()  # Not resumable, and a gap in it would go unnoticed later
+            self.outbox_bytes = 0
+            return
+        self.outbox.append((self.seq, raw))
+        self.outbox_bytes += len(raw)
+        while self.outbox_bytes > self.OUTBOX_BYTES and len(self.outbox) > 1:
+            self.outbox_bytes -= len(self.outbox.popleft()[1])
+
+    def tag(self, raw):
+        """Messages of a channel carry its name, so the other end knows which room they are about."""
+        return raw if self.channel is None else '{"ch": ' + json.dumps(self.channel) + ', ' + raw[1:]
+
+    def missed_since(self, ack):
+        """Buffered messages after ack, or None if the outbox no longer reaches that far back."""
+        if ack == self.seq:
+            return []
+        if len(self.outbox) == 0 or self.outbox[0][0] > ack + 1:
+            return None
+        return [raw for seq, raw in self.outbox if seq > ack]
 
-class Game:
-    def __init__(self):
-        self.p_descriptions, self.p_positions = self.generate_pieces()
 
+class Game:
+    # Prototype, copies per leading color. Digits are color offsets, rotated through 'BGY'.
+    PROTOTYPES = [("0012", 2), ("0221", 1), ("0002", 2), ("0011", 2), ("0110", 2), ("0000", 1)]
+    RED_PIECES = 5
+
+    def __init__(self, rng=None, prototypes=None, red=None):
+        # Headless runs (simulator.py) pass their own seeded Random, the server just uses the global one
+        self.rng = rng if rng is not None else random
+        self.prototypes = prototypes if prototypes is not None else self.PROTOTYPES
+        self.red = red if red is not None else self.RED_PIECES
         self.h, self.w = 5, 7
         self.occupied: list[list[bool]] = [[False for _ in range(self.w)] for _ in range(self.h)]
+        self.reset()
+
+    def reset(self):
+        """A brand new game, same settings. Finished games get recycled with this instead of built again."""
+        self.p_descriptions, self.p_positions = self.generate_pieces()
+        for row in self.occupied:
+            row[:] = [False] * self.w
         self.players: list[str] = []
         self.player_data: dict[str, dict] = {}
         self.cur_player = None
         self.last_piece_time = time.monotonic()
-        self.red_attack(5)
+        self.placed = 0  # Pieces on the board, red ones too. Same as occupied cells
+        self.red_attack(self.red)
 
     def generate_pieces(self):
         colors = 'BGY'
         descriptions = []
         for leading in range(3):
-            for prototype, times in [("0012", 2), ("0221", 1), ("0002", 2), ("0011", 2), ("0110", 2), ("0000", 1)]:
+            for prototype, times in self.prototypes:
                 for _ in range(times):
                     desc = "".join([colors[(int(prototype[i]) + leading) % 3] for i in range(4)])
-                    desc = self.rotate_piece(desc, random.randint(0, 3))
+                    desc = self.rotate_piece(desc, self.rng.randrange(4))
                     descriptions.append(desc)
-        random.shuffle(descriptions)
+        self.rng.shuffle(descriptions)
 
         positions = []
         for i in range(len(descriptions)):
             pos_i, pos_u = float(i // 8), float(i % 8)
-            pos_i += random.uniform(-0.1, +0.1)
-            pos_u += random.uniform(-0.1, +0.1)
-            positions.append(PiecePos('free', float(pos_i), float(pos_u), random.randint(0, 3)))
+            pos_i += self.rng.uniform(-0.1, +0.1)
+            pos_u += self.rng.uniform(-0.1, +0.1)
+            positions.append(PiecePos('free', float(pos_i), float(pos_u), self.rng.randrange(4)))
         return descriptions, positions
 
     def red_attack(self, n):
         for pp in range(n):
             for attempt in range(1000):  # Deadlock protection
-                i = random.sample(range(self.h * self.w), 1)[0]
+                i = self.rng.randrange(self.h * self.w)
                 if not self.occupied[i // self.w][i % self.w]:
                     self.occupied[i // self.w][i % self.w] = True
                     self.p_positions.append(PiecePos('board', i // self.w, i % self.w, 0))
+                    self.placed += 1
                     break
             assert len(self.p_descriptions) + 1 == len(self.p_positions)
             self.p_descriptions.append('rrrr')
@@ -103,10 +231,11 @@ class Game:
         self.next_cur_player()
         self.p_positions[idx] = PiecePos('board', pos[0], pos[1], rot)
         self.occupied[pos[0]][pos[1]] = True
+        self.placed += 1
 
     def is_game_over(self):
-        are_all_placed = all([x.type == 'board' for x in self.p_positions])
-        is_all_occupied = all([all(row) for row in self.occupied])
+        are_all_placed = self.placed == len(self.p_positions)
+        is_all_occupied = self.placed == self.h * self.w
         return are_all_placed or is_all_occupied
 
     def rotate_piece(self, d, times=1):
@@ -127,8 +256,9 @@ class Game:
             f[fi + 1] = f[fi + 1][:fu] + desc[2:] + f[fi + 1][fu + 2:]
         return f
 
-    def add_player(self, player_id: str):
+    def add_player(self, player_id: str, color=None):
         # You know what? I think we can drop the requirement to have 3 people max!
+        # Headless runs don't show colors, they pass any and skip looking for a nice one
         self.players.append(player_id)
 
         def dist(c1, c2):
@@ -154,7 +284,7 @@ class Game:
                     best_c = c
                     best_dist = this_dist
             return best_c
-        data = {'curpos': None, 'color': nice_color()}
+        data = {'curpos': None, 'color': color if color is not None else nice_color()}
         self.player_data[player_id] = data
         if self.cur_player is None:
             self.cur_player = self.players[0]
@@ -175,9 +305,20 @@ class Game:
 
 
 class GameServerMode(Game):
-    def __init__(self):
-        super().__init__()
+    def reset(self):
+        super().reset()
         self.clients: dict[str, Client] = {}
+        self.spectators: dict[str, Client] = {}
+        self.frame_handle = None  # Pending spectator frame flush, if any
+        self.last_frame_time = 0.0
+        self.replay: ReplayWriter | None = None
+
+    def encode_frame(self):
+        """Everything a spectator needs to draw the room, already serialized. Done once for all of them."""
+        return json.dumps({'cmd': 'frame',
+                           'positions': [x.__dict__() for x in self.p_positions],
+                           'player_data': self.player_data,
+                           'cur_player': self.cur_player})
 
     def add_player(self, sid, client):
         super().add_player(sid)
@@ -188,28 +329,283 @@ class GameServerMode(Game):
         del self.clients[sid]
 
 
+class RoomPool:
+    """Games ready to be played, so hosting a room doesn't generate pieces on the spot.
+    Finished games come back and get reset in the background, a few per event loop turn."""
+    def __init__(self, size=64, slice=0.001):
+        self.size = size
+        self.slice = slice  # Seconds spent preparing games before letting everyone else run
+        self.ready: deque[GameServerMode] = deque()
+        self.used: deque[GameServerMode] = deque()  # Finished, waiting for a reset
+        self.refilling = None
+        self.hits, self.misses = 0, 0
+
+    def take(self):
+        if self.ready:
+            g = self.ready.popleft()
+            g.last_piece_time = time.monotonic()  # It might have been waiting for a while
+            self.hits += 1
+        else:
+            g = GameServerMode()
+            self.misses += 1
+        self.start_refill()
+        return g
+
+    def give_back(self, g):
+        if len(self.ready) + len(self.used) < self.size:
+            self.used.append(g)
+        self.start_refill()
+
+    def prepare(self):
+        if self.used:
+            g = self.used.popleft()
+            g.reset()
+        else:
+            g = GameServerMode()
+        self.ready.append(g)
+
+    def fill(self):
+        while len(self.ready) < self.size:
+            self.prepare()
+
+    def start_refill(self):
+        if self.refilling is None and (len(self.ready) < self.size or self.used):
+            self.refilling = asyncio.ensure_future(self.refill())
+
+    async def refill(self):
+        try:
+            while len(self.ready) < self.size:
+                t_end = time.perf_counter() + self.slice
+                while len(self.ready) < self.size and time.perf_counter() < t_end:
+                    self.prepare()  # Around 0.4ms each
+                await asyncio.sleep(0)
+            self.used.clear()  # Anything left over is surplus
+        finally:
+            self.refilling = None
+
+
+class Lobby:
+    """Room directory for the lobby command. A room's row is only rebuilt after something happened in it, at most
+    once a tick, and moved within views that are kept sorted, so a page costs the same with ten rooms or ten thousand."""
+    FILTERS = {
+        'all': lambda row: True,
+        'playing': lambda row: row['players'] > 0,
+        'empty': lambda row: row['players'] == 0,
+        'fresh': lambda row: row['placed'] == 0,  # Nobody has put a piece yet
+    }
+
+    def __init__(self, games, tick=1.0):
+        self.games = games
+        self.tick = tick
+        self.rows: dict[str, dict] = {}
+        self.dirty: set[str] = set()  # Rooms that changed since the last refresh
+        self.views: dict[str, list[dict]] = {flt: [] for flt in self.FILTERS}  # Busiest rooms first
+        self.refreshed = None
+
+    @staticmethod
+    def order(row):
+        return -row['players'], row['game_id']
+
+    def touch(self, game_id):
+        self.dirty.add(game_id)
+
+    def refresh(self):
+        self.refreshed = time.monotonic()
+        for game_id in self.dirty:
+            old = self.rows.pop(game_id, None)
+            g = self.games.get(game_id)
+            new = None
+            if g is not None:
+                new = self.rows[game_id] = {
+                    'game_id': game_id, 'players': len(g.players), 'spectators': len(g.spectators),
+                    'placed': g.placed - g.red,
+                    'pieces': len(g.p_descriptions) - g.red, 'last_move': g.last_piece_time}
+            for flt, view in self.views.items():
+                if old is not None and self.FILTERS[flt](old):
+                    del view[bisect.bisect_left(view, self.order(old), key=self.order)]
+                if new is not None and self.FILTERS[flt](new):
+                    bisect.insort(view, new, key=self.order)
+        self.dirty.clear()
+
+    def page(self, flt='all', page=0, per_page=20):
+        assert flt in self.FILTERS, f'Filter is one of {", ".join(self.FILTERS)}'
+        per_page = max(1, min(int(per_page), 100))
+        if self.refreshed is None or time.monotonic() - self.refreshed >= self.tick:
+            self.refresh()
+        view = self.views[flt]
+        page = max(0, int(page))
+        now = time.monotonic()
+        rooms = [{**{k: v for k, v in row.items() if k != 'last_move'}, 'idle': round(now - row['last_move'], 1)}
+                 for row in view[page * per_page:(page + 1) * per_page]]
+        return {'cmd': 'lobby', 'filter': flt, 'page': page, 'pages': -(-len(view) // per_page), 'total': len(view),
+                'rooms': rooms, 'age': round(now - self.refreshed, 2)}
+
+
 class Server:
-    def __init__(self):
+    def __init__(self, spectator_fps=10.0, replay_dir=None, grace=30.0, rate_limits=None, max_violations=500,
+                 profile_dir='.', auditor=None, room_pool=64, max_channels=64, lobby_tick=1.0,
+                 violation_window=60.0):
         self.op_token = str(random.randint(int(1e10), int(9e10)))
-        print(f'Op token is: {self.op_token}')
+        events.always('op', 'Op token is: {token}', token=self.op_token)  # Op commands are useless without it
         self.clients: dict[str, Client] = {}
         self.games: dict[str, GameServerMode] = {}
         self.games_last_id = 0
+        self.rooms = RoomPool(room_pool)
+        self.lobby = Lobby(self.games, lobby_tick)
+        self.max_channels = max_channels  # Rooms one connection may follow at once
+        self.spectator_fps = spectator_fps
+        self.replay_dir = replay_dir
+        self.grace = grace  # Seconds a dropped player keeps their seat
+        self.sessions: dict[str, str] = {}  # Token -> client id
+        self.rate_limits = {**DEFAULT_RATE_LIMITS, **(rate_limits or {})}
+        self.max_violations = max_violations  # Rejected messages before we hang up on the client...
+        self.violation_window = violation_window  # ...within about this many seconds, old ones are forgiven
+        self.profile_dir = profile_dir
+        self.profiling = None  # Mode of the profile being taken, nothing is hooked in otherwise
+        self.auditor = auditor  # audit.ShadowAuditor, rechecks some final scores with the exact engine
 
     async def player_to_room(self, sid, game_id):
         assert self.clients[sid].game is None
+        self.unwatch(self.clients[sid])  # Watching one room while playing in another makes a mess of frames
         if game_id not in self.games:
-            self.games[game_id] = GameServerMode()
-            print(f'Hosted game {game_id}')
+            self.games[game_id] = self.rooms.take()
+            events.info('room', 'Hosted game {game_id}', game_id=game_id)
+        if self.games[game_id].replay is None:
+            self.start_replay(game_id)  # New room, or an old one that stood empty and got its replay sealed
         self.games[game_id].add_player(sid, self.clients[sid])
         self.clients[sid].game = game_id
+        self.lobby.touch(game_id)
+        self.record(self.games[game_id], self.player_data_msg(self.games[game_id]))
         await self.clients[sid].send_stuff({'cmd': 'msg', 'msg': f'You are now in game {game_id}'})
-        await self.clients[sid].send_stuff({'cmd': 'you', 'you': sid})
+        await self.clients[sid].send_stuff({'cmd': 'you', 'you': sid, 'token': self.clients[sid].token})
+        self.sessions[self.clients[sid].token] = sid
         await self.cmd_positions(sid)
         await self.cmd_descriptions(sid)
         await self.boardcast_state([sid])  # TODO: fix wrong usage
+        self.schedule_frame(self.games[game_id])
         # TODO: refactor some stuff from Server into ServerGame
 
+    async def resume_session(self, sid, token, ack):
+        """The new connection (sid) takes over the identity of the dropped one and gets what it missed."""
+        c = self.clients[sid]
+        old_sid = self.sessions.get(token)
+        if old_sid is None or old_sid not in self.clients or c.game is not None:
+            await c.send_stuff({'cmd': 'resumed', 'ok': False})
+            return
+        old = self.clients[old_sid]
+        if old.channel is not None:
+            old.parent.channels.pop(old.channel, None)  # Only the channel moves, its connection lives on
+        elif old.websocket is not None:
+            await old.websocket.close()  # Zombie connection, the client has clearly moved on
+
+        del self.clients[sid]
+        c.client_id, c.token, c.is_op, c.game = old.client_id, old.token, old.is_op, old.game
+        c.seq, c.outbox, c.outbox_bytes = old.seq, old.outbox, old.outbox_bytes
+        old.game = None
+        self.clients[c.client_id] = c
+        if c.game is not None:
+            self.games[c.game].clients[c.client_id] = c
+
+        missed = c.missed_since(ack)
+        if missed is not None:
+            for raw in missed:
+                await c.websocket.send(c.tag(raw))
+            await c.send_stuff({'cmd': 'resumed', 'ok': True, 'you': c.client_id, 'replayed': len(missed)})
+        else:
+            await c.send_stuff({'cmd': 'resumed', 'ok': True, 'you': c.client_id, 'replayed': None})
+            if c.game is not None:
+                await self.cmd_positions(c.client_id)
+                await self.cmd_descriptions(c.client_id)
+        if c.game is not None:
+            await self.boardcast_state([c.client_id])  # Cursors were not kept while away
+
+    async def expire_session(self, c):
+        await asyncio.sleep(self.grace)
+        if c.websocket is None and self.clients.get(c.client_id) is c:
+            self.drop_client(c)
+            events.info('session', ' {sid} Session expired', sid=c.client_id)
+
+    def drop_client(self, c):
+        if c.game is not None:
+            self.games[c.game].remove_player(c.client_id)
+            self.lobby.touch(c.game)
+            self.record(self.games[c.game], self.player_data_msg(self.games[c.game]))
+            self.schedule_frame(self.games[c.game])
+            if not self.games[c.game].players:
+                self.end_replay(self.games[c.game])  # Could stay empty forever, don't hold on to the file
+            c.game = None
+            # The game itself might persist, even if there are zero players - this is not a bug, this is a feature!
+        self.unwatch(c)
+        self.sessions.pop(c.token, None)
+        del self.clients[c.client_id]
+        if c.parent is not None and c.parent.channels.get(c.channel) is c:
+            del c.parent.channels[c.channel]
+
+    def unwatch(self, c):
+        """Stops sending frames to c, if it was watching anything."""
+        if c.watching is not None:
+            del self.games[c.watching].spectators[c.client_id]
+            self.lobby.touch(c.watching)
+            c.watching = None
+
+    async def spectator_to_room(self, sid, game_id):
+        c = self.clients[sid]
+        if c.game is not None:
+            await c.send_stuff({'cmd': 'msg', 'msg': f'You are playing in game {c.game}, leave it to watch another'})
+            return
+        assert game_id in self.games, 'No such game'
+        self.unwatch(c)  # One room at a time, the newest one wins
+        g = self.games[game_id]
+        g.spectators[sid] = c
+        c.watching = game_id
+        self.lobby.touch(game_id)
+        await c.send_stuff({'cmd': 'msg', 'msg': f'You are now watching game {game_id}'})
+        await c.send_stuff(self.descriptions_msg(g))
+        await c.websocket.send(c.tag(g.encode_frame()))
+
+    def start_replay(self, game_id):
+        if self.replay_dir is None:
+            return
+        g = self.games[game_id]
+        safe_id = re.sub(r'[^A-Za-z0-9._-]', '_', game_id)[:64]
+        path = os.path.join(self.replay_dir, f'{safe_id}-{int(time.time())}.fsqr')
+        n = 1
+        while os.path.exists(path):  # Same room again within a second, after its replay got sealed
+            n += 1
+            path = os.path.join(self.replay_dir, f'{safe_id}-{int(time.time())}-{n}.fsqr')
+        g.replay = ReplayWriter(path, game_id)
+        g.replay.record(self.descriptions_msg(g))
+        g.replay.next_turn([x.__dict__() for x in g.p_positions])
+
+    def end_replay(self, g):
+        """Writes the index and closes the file, it's a complete replay from here on."""
+        if g.replay is not None:
+            g.replay.close()
+            g.replay = None
+
+    def record(self, g, msg):
+        if g.replay is not None:
+            g.replay.record(msg)
+
+    def schedule_frame(self, g):
+        """Spectators get at most spectator_fps frames per second, whatever the players are doing."""
+        if g.frame_handle is not None or len(g.spectators) == 0:
+            return
+        delay = max(0.0, g.last_frame_time + 1 / self.spectator_fps - time.monotonic())
+        g.frame_handle = asyncio.get_event_loop().call_later(delay, self.flush_frame, g)
+
+    def flush_frame(self, g):
+        g.frame_handle = None
+        g.last_frame_time = time.monotonic()
+        self.broadcast(g.spectators.values(), g.encode_frame())
+
+    def broadcast(self, clients, raw):
+        """Same message to many clients without waiting on any of them. Channels get their own tagged copy."""
+        transport.broadcast([c.websocket for c in clients if c.channel is None and c.websocket is not None], raw)
+        for c in clients:
+            if c.channel is not None and c.websocket is not None:
+                transport.broadcast([c.websocket], c.tag(raw))
+
     async def cmd_positions(self, sid):
         c = self.clients[sid]
         g = self.games[c.game]
@@ -218,31 +614,112 @@ class Server:
     async def cmd_descriptions(self, sid):
         c = self.clients[sid]
         g = self.games[c.game]
-        await c.send_stuff({'cmd': 'descriptions', 'descriptions': g.p_descriptions})
+        await c.send_stuff(self.descriptions_msg(g))
 
     async def cmd_put(self, sid, idx, pos, rot):
         c = self.clients[sid]
-        g = self.games[c.game]
+        game_id = c.game
+        g = self.games[game_id]
         g.put_piece(idx, pos, rot, sid)
+        self.lobby.touch(c.game)
         await c.send_stuff({'cmd': 'msg', 'msg': 'Placement successful'})
+        if g.replay is not None:
+            g.replay.next_turn([x.__dict__() for x in g.p_positions])
+            g.replay.record(self.player_data_msg(g))
 
         # Push this info
         for c in g.clients.values():
             sid = c.client_id
             await self.cmd_positions(sid)
+        self.schedule_frame(g)
 
         if g.is_game_over():
-            await asyncio.sleep(0)
             t_start = time.monotonic()
-            score = scoring.score(g.get_colored_state(), accurate=False)
-            print(f'Game {c.game} Scoring took {(time.monotonic() - t_start) * 1000:.3f}ms')
+            iters = self.auditor.iters if self.auditor is not None else 20_000
+            # In a thread, Numba lets go of the GIL: other rooms carry on meanwhile, however many iterations it takes
+            score = await asyncio.to_thread(scoring.score, g.get_colored_state(), accurate=False, iters=iters)
+            events.info('score', 'Game {game_id} Scoring took {ms:.3f}ms', game_id=game_id,
+                        ms=(time.monotonic() - t_start) * 1000)
+            if self.auditor is not None:
+                self.auditor.offer(g.get_colored_state(), score, iters)
             for c in g.clients.values():
                 await c.send_stuff({'cmd': 'game_over', 'score': score})
-            game_id = c.game
+            if g.replay is not None:
+                g.replay.record({'cmd': 'game_over', 'score': score})
+                self.end_replay(g)
             for c in g.clients.keys():
                 self.clients[c].game = None
+            if g.frame_handle is not None:
+                g.frame_handle.cancel()
+            self.broadcast(g.spectators.values(), json.dumps({'cmd': 'game_over', 'score': score}))
+            for c in g.spectators.values():
+                c.watching = None
             del self.games[game_id]
-            print(f'Ended game {game_id} with score {score}')
+            self.lobby.touch(game_id)
+            self.rooms.give_back(g)
+            events.info('game_over', 'Ended game {game_id} with score {score}', game_id=game_id, score=score)
+
+    async def cmd_profile(self, sid, mode='cpu', seconds=10.0, top=25, to_file=False):
+        c = self.clients[sid]
+        assert c.is_op, 'Not an op'
+        assert mode in ['cpu', 'memory'], 'Mode is cpu or memory'
+        assert self.profiling is None, f'Already taking a {self.profiling} profile'
+        seconds = max(0.0, min(float(seconds), 600.0))
+        self.profiling = mode
+        await c.send_stuff({'cmd': 'msg', 'msg': f'Taking a {mode} profile for {seconds}s'})
+        # In the background, this client's messages shouldn't wait for it
+        asyncio.ensure_future(self.take_profile(c, mode, seconds, int(top), to_file))
+
+    async def take_profile(self, c, mode, seconds, top, to_file):
+        """Everything the event loop runs meanwhile gets in: messages, broadcasts, scoring."""
+        try:
+            if mode == 'cpu':
+                profiler = cProfile.Profile()
+                profiler.enable()
+                try:
+                    await asyncio.sleep(seconds)
+                finally:
+                    profiler.disable()
+                out = io.StringIO()
+                stats = pstats.Stats(profiler, stream=out)
+                stats.sort_stats('tottime').print_stats(top)
+                stats.sort_stats('cumulative').print_stats(top)
+                report = out.getvalue()
+            else:
+                was_tracing = tracemalloc.is_tracing()
+                if not was_tracing:
+                    tracemalloc.start()
+                try:
+                    before = tracemalloc.take_snapshot()
+                    await asyncio.sleep(seconds)
+                    after = tracemalloc.take_snapshot()
+                finally:
+                    if not was_tracing:
+                        tracemalloc.stop()
+                report = '\n'.join([f'Grew the most in {seconds}s:'] +
+                                    [str(d) for d in after.compare_to(before, 'lineno')[:top]] +
+                                    ['', 'Biggest now:'] + [str(st) for st in after.statistics('lineno')[:top]])
+        finally:
+            self.profiling = None
+        reply = {'cmd': 'profile', 'mode': mode, 'seconds': seconds}
+        if to_file:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            path = os.path.join(self.profile_dir, f'profile-{mode}-{int(time.time())}.txt')
+            with open(path, 'w') as f:
+                f.write(report)
+            reply['path'] = path
+        else:
+            reply['report'] = report
+        events.info('profile', ' {sid} Got a {mode} profile', sid=c.client_id, mode=mode)
+        await c.send_stuff(reply)
+
+    async def cmd_ping(self, sid, msg):
+        c = self.clients[sid]
+        # Straight to the socket: pongs are not part of the session, a resumed client has no use for old ones
+        try:
+            await c.websocket.send(c.tag(json.dumps({'cmd': 'pong', 'id': msg.get('id'), 't': msg.get('t')})))
+        except websockets.exceptions.ConnectionClosed:
+            pass
 
     async def cmd_curpos(self, sid, pos):
         c = self.clients[sid]
@@ -252,6 +729,14 @@ class Server:
         g = self.games[c.game]
         g.player_data[sid]['curpos'] = pos
         await self.boardcast_state(g.players)  # Yikes, this will spawn some spam. Whatever.
+        self.record(g, self.player_data_msg(g))
+        self.schedule_frame(g)  # Spectators are spared from the spam
+
+    def descriptions_msg(self, g):
+        return {'cmd': 'descriptions', 'descriptions': g.p_descriptions, 'h': g.h, 'w': g.w}
+
+    def player_data_msg(self, g):
+        return {'cmd': 'player_data', 'player_data': g.player_data, 'cur_player': g.cur_player}
 
     async def boardcast_state(self, sids):
         for sid in sids:
@@ -259,72 +744,263 @@ class Server:
             g = self.games[c.game]
             if g is None:
                 continue
-            await c.send_stuff({'cmd': 'player_data',
-                                'player_data': g.player_data,
-                                'cur_player': g.cur_player})
+            await c.send_volatile(self.player_data_msg(g))
 
     async def process_message(self, client_id, msg):
         if msg['cmd'] == 'msg':
-                print(f" {client_id} Tells us: '{msg['msg']}'")
+                events.info('msg', " {sid} Tells us: '{msg}'", sid=client_id, msg=msg['msg'])
         elif msg['cmd'] == 'room':
                 await self.player_to_room(client_id, msg['game_id'])
-                print(f" {client_id} Joined game {msg['game_id']}")
+                events.info('room', ' {sid} Joined game {game_id}', sid=client_id, game_id=msg['game_id'])
+        elif msg['cmd'] == 'resume':
+                await self.resume_session(client_id, msg['token'], msg['ack'])
+                events.info('session', ' {sid} Resumed a session', sid=client_id)
+        elif msg['cmd'] == 'spectate':
+                await self.spectator_to_room(client_id, msg['game_id'])
+                events.info('spectate', ' {sid} Watches game {game_id}', sid=client_id, game_id=msg['game_id'])
+        elif msg['cmd'] == 'unwatch':
+                self.unwatch(self.clients[client_id])
+                events.info('spectate', ' {sid} Stopped watching', sid=client_id)
         elif msg['cmd'] == 'positions':
                 await self.cmd_positions(client_id)
-                print(f" {client_id} Requested positions")
+                events.debug('positions', ' {sid} Requested positions', sid=client_id)
         elif msg['cmd'] == 'descriptions':
                 await self.cmd_descriptions(client_id)
-                print(f" {client_id} Requested positions")
+                events.debug('descriptions', ' {sid} Requested descriptions', sid=client_id)
         elif msg['cmd'] == 'put':
                 await self.cmd_put(client_id, msg['idx'], msg['pos'], msg['rot'])
-                print(f" {client_id} Put piece")
+                events.info('put', ' {sid} Put piece', sid=client_id)
         elif msg['cmd'] == 'curpos':
                 await self.cmd_curpos(client_id, msg['curpos'])
+        elif msg['cmd'] == 'ping':
+                await self.cmd_ping(client_id, msg)
         elif msg['cmd'] == 'op':
                 if msg['token'] == self.op_token:
                     self.clients[client_id].is_op = True
-                    print(f' {client_id} OPPED')
+                    events.warn('op', ' {sid} OPPED', sid=client_id)
                 else:
-                    print(f' {client_id} Not opped')
+                    events.warn('op', ' {sid} Not opped', sid=client_id)
                 await self.clients[client_id].send_stuff({'cmd': 'op', 'status': self.clients[client_id].is_op})
+        elif msg['cmd'] == 'violations':
+                c = self.clients[client_id]
+                assert c.is_op, 'Not an op'
+                await c.send_stuff({'cmd': 'violations', 'violations': {
+                    sid: cl.violations for sid, cl in self.clients.items() if cl.violations and cl.parent is None}})
+        elif msg['cmd'] == 'audit':
+                c = self.clients[client_id]
+                assert c.is_op, 'Not an op'
+                assert self.auditor is not None, 'Auditing is off'
+                await c.send_stuff({'cmd': 'audit', 'audit': self.auditor.stats()})
+        elif msg['cmd'] == 'lobby':
+                await self.clients[client_id].send_stuff(self.lobby.page(
+                    msg.get('filter', 'all'), msg.get('page', 0), msg.get('per_page', 20)))
+        elif msg['cmd'] == 'leave':
+                c = self.clients[client_id]
+                assert c.channel is not None, 'Only channels can be left, just hang up'
+                self.drop_client(c)
+                await c.send_stuff({'cmd': 'msg', 'msg': f'Left channel {c.channel}'})
+                events.info('channel', ' {sid} Left channel {ch}', sid=c.parent.client_id, ch=c.channel)
+        elif msg['cmd'] == 'profile':
+                await self.cmd_profile(client_id, msg.get('mode', 'cpu'), msg.get('seconds', 10.0),
+                                       msg.get('top', 25), msg.get('file', False))
         else:
                 raise NotImplemented('Weird command')
 
-    async def listen_socket(self, websocket, path):
+    def admit(self, c, cmd):
+        """Token bucket per client per command. True if the message may be processed right now."""
+        key = cmd if cmd in self.rate_limits else '*'
+        if key not in c.buckets:
+            c.buckets[key] = TokenBucket(*self.rate_limits[key])
+        if c.buckets[key].take():
+            c.throttled.discard(key)
+            return True
+        return False
+
+    def violate(self, c, cmd):
+        """Counts a rejected message. True if that was one too many and it's time to hang up.
+        Strikes refill like rate limit tokens do, so a client that behaves for a while gets a clean slate."""
+        c.violations[cmd] = c.violations.get(cmd, 0) + 1
+        if cmd == 'curpos_coalesced':
+            return False  # Not the client's fault, cursors just move fast
+        if c.strikes is None:
+            c.strikes = TokenBucket(self.max_violations / self.violation_window, self.max_violations)
+        return not c.strikes.take()
+
+    def coalesce_curpos(self, c, pos):
+        """Too many cursor updates, keep only the latest and process it as soon as there is a token."""
+        self.violate(c, 'curpos_coalesced')
+        c.pending_curpos = pos
+        if c.curpos_handle is None:
+            delay = c.buckets['curpos'].wait_time()
+            c.curpos_handle = asyncio.get_event_loop().call_later(
+                delay, lambda: asyncio.ensure_future(self.flush_curpos(c)))
+
+    async def flush_curpos(self, c):
+        c.curpos_handle = None
+        if c.pending_curpos is None or self.clients.get(c.client_id) is not c:
+            return
+        if not self.admit(c, 'curpos'):
+            self.coalesce_curpos(c, c.pending_curpos)
+            return
+        pos, c.pending_curpos = c.pending_curpos, None
+        await self.cmd_curpos(c.client_id, pos)
+
+    def open_channel(self, c, ch):
+        """The client that stands for channel ch on c's connection, made on first use.
+        It is a client of its own (id, token, room, outbox) that shares the socket and the rate limits."""
+        sub = c.channels.get(ch)
+        if sub is None:
+            assert isinstance(ch, str) and 0 < len(ch) <= 64, 'Channel is a short string'
+            assert len(c.channels) < self.max_channels, 'Too many channels'
+            sub = Client(c.websocket, c.path, channel=ch, parent=c)
+            sub.is_op = c.is_op
+            if c.strikes is None:
+                c.strikes = TokenBucket(self.max_violations / self.violation_window, self.max_violations)
+            sub.buckets, sub.violations, sub.throttled, sub.strikes = c.buckets, c.violations, c.throttled, c.strikes
+            c.channels[ch] = sub
+            self.clients[sub.client_id] = sub
+            events.debug('channel', ' {sid} Opened channel {ch}', sid=c.client_id, ch=ch)
+        return sub
+
+    async def listen_socket(self, websocket, path=None):
+        """One connection, from start to end. Newer websockets and transport.LoopbackServer don't pass a path."""
         c = Client(websocket, path)
-        await c.send_stuff({'cmd': 'version', 'version': GAME_VERSION})
+        await c.websocket.send(json.dumps({'cmd': 'version', 'version': GAME_VERSION}))  # Not part of the session
         c = self.clients[c.client_id] = c
-        print(f' {c.client_id} Connected')
+        events.info('connect', ' {sid} Connected', sid=c.client_id)
         try:
             async for message_raw in c.websocket:
-                message = json.loads(message_raw)
+                message = message_raw
+                to = c  # Whoever the message is from: the connection itself or one of its channels
+                replying_to.set((None, None))
                 try:
-                    await self.process_message(c.client_id, message)
+                    message = json.loads(message_raw)
+                    cmd = message['cmd']
+                    if 'ch' in message:
+                        to = self.open_channel(c, message['ch'])
+                    replying_to.set((to, message.get('id')))
+                    if not self.admit(to, cmd):
+                        if cmd == 'curpos':
+                            self.coalesce_curpos(to, message['curpos'])
+                            continue
+                        if self.violate(to, cmd):
+                            events.warn('violations', ' {sid} Too many rejected messages, disconnecting',
+                                        sid=c.client_id)
+                            await c.websocket.close(1008, 'Rate limit')
+                            break
+                        if cmd not in c.throttled:  # One notice per burst is plenty
+                            c.throttled.add(cmd)
+                            await to.send_stuff({'cmd': 'msg', 'msg': 'Slow down', 'yours': message})
+                        await asyncio.sleep(0)  # Let the other rooms breathe
+                        continue
+                    if cmd == 'curpos':
+                        to.pending_curpos = None  # Fresher than whatever was waiting
+                    await self.process_message(to.client_id, message)
                 except:
-                    print(f' {c.client_id} ERR {traceback.format_exc()}')
-                    await c.send_stuff({'cmd': 'msg', 'msg': f'Erroneous command', 'yours': message})
+                    events.error('error', ' {sid} ERR {tb}', sid=c.client_id, tb=traceback.format_exc())
+                    await to.send_stuff({'cmd': 'msg', 'msg': f'Erroneous command', 'yours': message})
         except websockets.exceptions.ConnectionClosedError:
             pass
-        if c.game is not None:
-            self.games[c.game].remove_player(c.client_id)
-            c.game = None
-            # The game itself might persist, even if there are zero players - this is not a bug, this is a feature!
-        del self.clients[c.client_id]
-        print(f' {c.client_id} Disconnected')
+        for sub in list(c.channels.values()):
+            self.hang_up(sub)
+        self.hang_up(c)
+
+    def close(self):
+        """Shutting down. Replays of rooms still going get sealed, so they can be played back up to here."""
+        for g in self.games.values():
+            self.end_replay(g)
+        if self.auditor is not None:
+            self.auditor.close()
+
+    def hang_up(self, c):
+        """The connection is gone. Players keep their seat for a while, everyone else is dropped right away."""
+        if c.curpos_handle is not None:
+            c.curpos_handle.cancel()
+        if self.clients.get(c.client_id) is not c:
+            return  # Somebody resumed this session from another connection
+        if c.game is not None and self.grace > 0:
+            c.websocket = None  # Keep the seat warm
+            asyncio.ensure_future(self.expire_session(c))
+            events.info('connect', ' {sid} Dropped, holding the seat for {grace}s', sid=c.client_id, grace=self.grace)
+            return
+        self.drop_client(c)
+        events.info('connect', ' {sid} Disconnected', sid=c.client_id)
+
+
+def parse_rate_limit(s):
+    """cmd=rate:burst, for --rate-limit."""
+    try:
+        cmd, limit = s.split('=')
+        rate, burst = float(limit.split(':')[0]), int(limit.split(':')[1])
+    except (ValueError, IndexError):
+        raise argparse.ArgumentTypeError(f'{s} is not cmd=rate:burst')
+    if rate <= 0 or burst < 1:
+        raise argparse.ArgumentTypeError(f'{s}: rate must be over 0 and burst at least 1')
+    return cmd, (rate, burst)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("-p", "--port", default=None, type=int)
+    parser.add_argument("--spectator-fps", default=10.0, type=float, help="Frame rate cap for spectators")
+    parser.add_argument("--replays", default=None, help="Directory to write finished games' replays into")
+    parser.add_argument("--grace", default=30.0, type=float, help="Seconds a dropped player keeps their seat")
+    parser.add_argument("--rate-limit", default=[], action='append', type=parse_rate_limit,
+                        help="Per-client limit as cmd=rate:burst, like curpos=30:10. Use * for the rest.")
+    parser.add_argument("--max-violations", default=500, type=int,
+                        help="Rejected messages before a client is kicked, see --violation-window")
+    parser.add_argument("--violation-window", default=60.0, type=float,
+                        help="Seconds it takes to forgive --max-violations rejected messages")
+    parser.add_argument("--max-queue", default=16, type=int, help="Inbound messages buffered per client")
+    parser.add_argument("--max-size", default=2 ** 16, type=int, help="Largest inbound message, in bytes")
+    parser.add_argument("--profiles", default='.', help="Directory the profile command writes into, when asked to")
+    parser.add_argument("--audit-sample", default=0.0, type=float,
+                        help="Share of finished games to rescore with the exact engine in the background, 0 is off")
+    parser.add_argument("--audit-budget", default=50_000_000, type=int, help="Exact engine steps per color")
+    parser.add_argument("--audit-workers", default=1, type=int)
+    parser.add_argument("--audit-tune", action='store_true',
+                        help="Adjust approximate scoring iterations from what the audit finds")
+    parser.add_argument("--audit-target", default=0.02, type=float,
+                        help="Share of colors approximate scoring may under-report, when tuning")
+    parser.add_argument("--room-pool", default=64, type=int, help="Games kept ready for new rooms")
+    parser.add_argument("--max-channels", default=64, type=int,
+                        help="Rooms one connection may follow at once. Each seat keeps up to 64 KiB for resuming")
+    parser.add_argument("--lobby-tick", default=1.0, type=float, help="Seconds the lobby listing may lag behind")
+    parser.add_argument("--log-level", default='info', choices=list(LEVELS.keys()))
+    parser.add_argument("--log-sample", default=[], action='append',
+                        help="Keep one in N records of an event, as event=N, like put=10")
+    parser.add_argument("--log-limit", default=['*=100'], action='append',
+                        help="Most records per second of an event, as event=N. Use * for the rest.")
+    parser.add_argument("--log-json", action='store_true', help="Log JSON lines instead of text")
     args = parser.parse_args()
-
-    print(f'FriendlySquares server {GAME_VERSION} has started')
-    s = Server()
-    start_server = websockets.serve(s.listen_socket, ['0.0.0.0'], args.port or DEFAULT_PORT)
+    events.configure(level=LEVELS[args.log_level], as_json=args.log_json,
+                     samples={k: int(v) for k, v in (x.split('=') for x in args.log_sample)},
+                     limits={k: int(v) for k, v in (x.split('=') for x in args.log_limit)})
+    rate_limits = dict(args.rate_limit)
+
+    events.info('server', 'FriendlySquares server {version} has started', version=GAME_VERSION)
+    if args.replays is not None:
+        os.makedirs(args.replays, exist_ok=True)
+    auditor = None
+    if args.audit_sample > 0:
+        auditor = ShadowAuditor(sample=args.audit_sample, budget=args.audit_budget, workers=args.audit_workers,
+                                tune=args.audit_tune, target_miss=args.audit_target)
+    s = Server(spectator_fps=args.spectator_fps, replay_dir=args.replays, grace=args.grace, rate_limits=rate_limits,
+               max_violations=args.max_violations, violation_window=args.violation_window,
+               profile_dir=args.profiles, auditor=auditor, room_pool=args.room_pool, max_channels=args.max_channels, lobby_tick=args.lobby_tick)
+    s.rooms.fill()
+    # websockets stops reading from a client whose queue is full, so a flood backs up into its own TCP window
+    start_server = websockets.serve(s.listen_socket, ['0.0.0.0'], args.port or DEFAULT_PORT,
+                                    max_queue=args.max_queue, max_size=args.max_size)
     scoring.score(['rr', 'rr'])  # Compile Numba code
-    print(f'Ready to accept connections')
+    events.info('server', 'Ready to accept connections')
     asyncio.get_event_loop().run_until_complete(start_server)
-    asyncio.get_event_loop().run_forever()
+    try:
+        asyncio.get_event_loop().run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        s.close()
 
     # TODO: grabbed piece broadcasting
     # TODO: serverside babylon
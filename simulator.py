@@ -0,0 +1,229 @@
+# Headless self-play. Runs the Game rules without any websockets, lots of games at once.
+# python simulator.py -n 100000 --policy greedy -o sims.fsqc
+# Scores are made like the server makes them, add --iters 500 for quick rough runs (the file's meta says which it was)
+import argparse
+import array
+import json
+import multiprocessing
+import random
+import struct
+import time
+
+import scoring
+from server import Game
+
+COLUMNAR_MAGIC = b'FSQC1\n'
+
+
+def random_policy(g, rng, board, free, cells):
+    """Any free piece, any free cell, any rotation."""
+    return rng.choice(free), rng.choice(cells), rng.randrange(4)
+
+
+def edge_needs(board, i, u):
+    """Half-edges of a piece at (i, u) that have a neighbor, as (index in the piece, neighbor's color there)."""
+    h, w = len(board), len(board[0])
+    needs = []
+    if i > 0 and board[i - 1][u] is not None:
+        n = board[i - 1][u]
+        needs += [(0, n[2]), (1, n[3])]
+    if i + 1 < h and board[i + 1][u] is not None:
+        n = board[i + 1][u]
+        needs += [(2, n[0]), (3, n[1])]
+    if u > 0 and board[i][u - 1] is not None:
+        n = board[i][u - 1]
+        needs += [(0, n[1]), (2, n[3])]
+    if u + 1 < w and board[i][u + 1] is not None:
+        n = board[i][u + 1]
+        needs += [(1, n[0]), (3, n[2])]
+    return needs
+
+
+def edge_matches(board, desc, i, u):
+    """How many half-edges of a piece (already rotated) touch the same color on the board."""
+    return sum(desc[k] == color for k, color in edge_needs(board, i, u))
+
+
+def greedy_policy(g, rng, board, free, cells, sample=4):
+    """Looks at a few random free pieces and puts the one that touches the most same-colored edges."""
+    needs = [(cell, edge_needs(board, cell[0], cell[1])) for cell in cells]  # Once per move, not per piece
+    best, best_matches = None, -1
+    for idx in rng.sample(free, min(sample, len(free))):
+        for rot in range(4):
+            desc = g.rotate_piece(g.p_descriptions[idx], rot)
+            for cell, need in needs:
+                m = 0
+                for k, color in need:
+                    m += desc[k] == color
+                if m > best_matches:
+                    best, best_matches = (idx, cell, rot), m
+    return best
+
+
+POLICIES = {'random': random_policy, 'greedy': greedy_policy}
+
+
+def play_game(seed, policy='random', prototypes=None, red=None, iters=20_000, players=1):
+    """Plays one full game. Returns the game row and its per-move rows."""
+    rng = random.Random(seed)
+    g = Game(rng=rng, prototypes=prototypes, red=red)
+    for p in range(players):
+        g.add_player(f'sim{p}', color=(0, 0, 0))
+    board = [[None] * g.w for _ in range(g.h)]
+    free = []  # Pieces not on the board yet, and empty cells. Kept in order, so the policies' picks don't change
+    for idx, pos in enumerate(g.p_positions):
+        pos = pos._data  # Plain dict, CustomDict lookups add up
+        if pos['type'] == 'board':
+            board[pos['ii']][pos['uu']] = g.rotate_piece(g.p_descriptions[idx], pos['r'])
+        else:
+            free.append(idx)
+    cells = [(i, u) for i in range(g.h) for u in range(g.w) if board[i][u] is None]
+
+    moves = []
+    pick = POLICIES[policy]
+    while not g.is_game_over():
+        idx, cell, rot = pick(g, rng, board, free, cells)
+        desc = g.rotate_piece(g.p_descriptions[idx], rot)
+        moves.append((len(moves), idx, cell[0], cell[1], rot, edge_matches(board, desc, cell[0], cell[1]),
+                      len(cells)))
+        g.put_piece(idx, cell, rot, g.cur_player)
+        board[cell[0]][cell[1]] = desc
+        free.remove(idx)
+        cells.remove(cell)
+
+    # Same as g.get_colored_state(), but the board here already has every piece rotated
+    state = []
+    for row in board:
+        state.append(''.join('ww' if d is None else d[:2] for d in row))
+        state.append(''.join('ww' if d is None else d[2:] for d in row))
+    sc = scoring.score(state, accurate=False, iters=iters)
+    game = (seed, sc['B'], sc['G'], sc['Y'], sc['total'], len(moves), ''.join(state))
+    return game, moves
+
+
+class ColumnarWriter:
+    """Streams tables into a compact columnar file, one chunk per batch.
+    Chunk: <I header length, JSON header, then each column as raw little-endian array bytes."""
+    TABLES = {
+        'games': [('game', 'I'), ('seed', 'Q'), ('policy', 'B'), ('red', 'B'),
+                  ('score_B', 'H'), ('score_G', 'H'), ('score_Y', 'H'), ('score_total', 'H'),
+                  ('moves', 'H'), ('board', 'B')],
+        'moves': [('game', 'I'), ('turn', 'H'), ('piece', 'H'), ('ii', 'B'), ('uu', 'B'), ('r', 'B'),
+                  ('matches', 'B'), ('options', 'H')],
+    }
+
+    def __init__(self, path, meta=None):
+        self.f = open(path, 'wb')
+        self.f.write(COLUMNAR_MAGIC)
+        self.write_chunk('meta', {}, rows=0, extra=meta or {})
+
+    def write_chunk(self, table, columns, rows, extra=None):
+        header = {'table': table, 'rows': rows, 'columns': [], **(extra or {})}
+        blobs = []
+        for name, typecode in self.TABLES.get(table, []):
+            a = columns[name]
+            header['columns'].append([name, typecode, len(a) // rows if rows else 1])
+            blobs.append(a.tobytes())
+        header_raw = json.dumps(header).encode()
+        self.f.write(struct.pack('<I', len(header_raw)))
+        self.f.write(header_raw)
+        for b in blobs:
+            self.f.write(b)
+
+    def write_games(self, first_game, policy_i, red, batch):
+        games = {name: array.array(t) for name, t in self.TABLES['games']}
+        moves = {name: array.array(t) for name, t in self.TABLES['moves']}
+        for offset, (game, game_moves) in enumerate(batch):
+            game_i = first_game + offset
+            seed, sc_b, sc_g, sc_y, sc_total, n_moves, board = game
+            for name, v in zip(['game', 'seed', 'policy', 'red', 'score_B', 'score_G', 'score_Y',
+                                'score_total', 'moves'],
+                               [game_i, seed, policy_i, red, sc_b, sc_g, sc_y, sc_total, n_moves]):
+                games[name].append(v)
+            games['board'].frombytes(board.encode())
+            for m in game_moves:
+                moves['game'].append(game_i)
+                for name, v in zip(['turn', 'piece', 'ii', 'uu', 'r', 'matches', 'options'], m):
+                    moves[name].append(v)
+        self.write_chunk('games', games, len(batch))
+        self.write_chunk('moves', moves, len(moves['game']))
+
+    def close(self):
+        self.f.close()
+
+
+def read_columnar(path):
+    """Loads a columnar file back. Returns (meta, {table: {column: array}}).
+    Fixed-width columns (like board) stay flat, slice them by meta['widths'][table][column]."""
+    tables = {}
+    meta = {'widths': {}}
+    with open(path, 'rb') as f:
+        assert f.read(len(COLUMNAR_MAGIC)) == COLUMNAR_MAGIC, 'Not a columnar simulation file'
+        while True:
+            raw = f.read(4)
+            if len(raw) < 4:
+                break
+            header = json.loads(f.read(struct.unpack('<I', raw)[0]))
+            if header['table'] == 'meta':
+                meta.update(header)
+                continue
+            table = tables.setdefault(header['table'], {})
+            for name, typecode, width in header['columns']:
+                a = array.array(typecode)
+                a.frombytes(f.read(a.itemsize * width * header['rows']))
+                table.setdefault(name, array.array(typecode)).extend(a)
+                meta['widths'].setdefault(header['table'], {})[name] = width
+    return meta, tables
+
+
+def play_batch(args):
+    seeds, policy, prototypes, red, iters, players = args
+    return [play_game(s, policy, prototypes, red, iters, players) for s in seeds]
+
+
+def parse_prototypes(s):
+    # "0012:2,0221:1,..."
+    return [(p.split(':')[0], int(p.split(':')[1])) for p in s.split(',')]
+
+
+def simulate(path, n, policy='random', prototypes=None, red=None, iters=20_000, players=1,
+             seed=0, workers=None, batch=256):
+    if red is None:
+        red = Game.RED_PIECES
+    prototypes = prototypes or Game.PROTOTYPES
+    writer = ColumnarWriter(path, meta={'policy': policy, 'prototypes': prototypes, 'red': red,
+                                        'iters': iters, 'players': players, 'seed': seed})
+    jobs = [(list(range(seed + i, seed + min(i + batch, n))), policy, prototypes, red, iters, players)
+            for i in range(0, n, batch)]
+    policy_i = list(POLICIES.keys()).index(policy)
+    done = 0
+    t_start = time.monotonic()
+    with multiprocessing.Pool(workers) as pool:
+        # imap keeps the order, so game numbers line up with seeds
+        for results in pool.imap(play_batch, jobs):
+            writer.write_games(done, policy_i, red, results)
+            done += len(results)
+    writer.close()
+    elapsed = time.monotonic() - t_start
+    print(f'Simulated {done} games in {elapsed:.2f}s ({done / max(elapsed, 1e-9):.0f} games/s)')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--games', default=1000, type=int)
+    parser.add_argument('-o', '--output', default='sims.fsqc')
+    parser.add_argument('--policy', default='random', choices=list(POLICIES.keys()))
+    parser.add_argument('--prototypes', default=None, type=parse_prototypes,
+                        help='Piece set, like 0012:2,0221:1,0002:2,0011:2,0110:2,0000:1')
+    parser.add_argument('--red', default=None, type=int, help='How many red pieces to drop on the board')
+    parser.add_argument('--iters', default=20_000, type=int,
+                        help='Monte-carlo iterations of the approximate scorer, same as the server by default. '
+                             'Fewer are a lot faster, but under-score more colors (about 5%% of them at 500)')
+    parser.add_argument('--players', default=1, type=int)
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('--workers', default=None, type=int)
+    args = parser.parse_args()
+
+    scoring.score(['rr', 'rr'])  # Compile Numba code
+    simulate(args.output, args.games, args.policy, args.prototypes, args.red, args.iters, args.players,
+             args.seed, args.workers)
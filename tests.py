@@ -1,8 +1,51 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import random
+import tempfile
 import unittest
 import time
 
+import audit
+import console_client
+import eventlog
+import replay
+import server
+import simulator
+import transport
 from scoring import score
 
+UNLIMITED = {cmd: (1e9, 10 ** 9) for cmd in server.DEFAULT_RATE_LIMITS}  # Rate limits for tests that flood on purpose
+
+
+def serve(name, **kwargs):
+    """A server behind a loopback transport, no room pool, no seats held. Close the LoopbackServer when done."""
+    s = server.Server(**{'room_pool': 0, 'grace': 0, **kwargs})
+    return s, transport.LoopbackServer(s.listen_socket, name=name)
+
+
+async def send(ws, **msg):
+    await ws.send(json.dumps(msg))
+
+
+async def read_until(ws, cmd, got=None):
+    """Reads until a message of this cmd comes, and returns it. Everything read on the way goes into got."""
+    while True:
+        msg = json.loads(await ws.recv())
+        if got is not None:
+            got.append(msg)
+        if msg['cmd'] == cmd:
+            return msg
+
+
+async def join(ws, game_id, got=None):
+    await send(ws, cmd='room', game_id=game_id)
+    return await read_until(ws, 'descriptions', got)
+
+
 class ScoringTests(unittest.TestCase):
     def setUp(self):
         score(['BB', 'BB'], False)
@@ -52,6 +95,496 @@ class ScoringTests(unittest.TestCase):
         scores = score(f, False)
         print('agony', scores, time.monotonic() - s)
 
+    def test_approximateMatchesExact(self):
+        rng = random.Random(5)
+        for _ in range(10):
+            f = [''.join(rng.choice('BGYBGYr') for _ in range(14)) for _ in range(10)]
+            exact = score(f, True, budget=3_000_000)
+            approx = score(f, False)
+            for color in ['B', 'G', 'Y']:
+                if exact[color] >= 0:
+                    self.assertEqual(approx[color], exact[color])
+
+
+class AuditTests(unittest.TestCase):
+    def test_budgetAndTuning(self):
+        f = ['BBGG', 'BBGG', 'YYrr']
+        exact = score(f, True)
+        self.assertEqual(exact, score(f, True, budget=10 ** 6))
+        self.assertEqual(score(f, True, budget=1)['total'], -1)
+
+        auditor = audit.ShadowAuditor(tune=True, iters=10_000, window=8)
+        auditor.record({**exact, 'B': exact['B'] - 1}, exact, 10_000)
+        auditor.record(exact, {**exact, 'G': -1}, 10_000)
+        stats = auditor.stats()
+        self.assertEqual(stats['colors']['B']['under'], 1)
+        self.assertEqual(stats['colors']['G']['checked'], 1)
+        self.assertEqual(stats['incomplete'], 1)
+        self.assertEqual(auditor.iters, 20_000)  # One miss in five colors is way over the target
+
+
+class SimulatorTests(unittest.TestCase):
+    def test_seededGamesRepeat(self):
+        for policy in simulator.POLICIES:
+            a = simulator.play_game(42, policy, iters=100)
+            b = simulator.play_game(42, policy, iters=100)
+            self.assertEqual(a, b)
+            game, moves = a
+            self.assertEqual(len(moves), game[5])
+            self.assertNotIn('w', game[6])
+
+    def test_columnarRoundTrip(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'sims.fsqc')
+            batch = [simulator.play_game(s, iters=100) for s in range(3)]
+            w = simulator.ColumnarWriter(path, meta={'policy': 'random'})
+            w.write_games(0, 0, 5, batch)
+            w.close()
+            meta, tables = simulator.read_columnar(path)
+        self.assertEqual(meta['policy'], 'random')
+        self.assertEqual(list(tables['games']['seed']), [0, 1, 2])
+        self.assertEqual(list(tables['games']['score_total']), [g[4] for g, _ in batch])
+        width = meta['widths']['games']['board']
+        self.assertEqual(bytes(tables['games']['board'][:width]).decode(), batch[0][0][6])
+        self.assertEqual(len(tables['moves']['game']), sum(len(m) for _, m in batch))
+
+
+class ReplayTests(unittest.TestCase):
+    def test_seekMatchesFullDecode(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'game.fsqr')
+            positions = [{'type': 'free', 'ii': float(i), 'uu': 0.0, 'r': 0} for i in range(20)]
+            w = replay.ReplayWriter(path, 'room', keyframe_every=4)
+            w.record({'cmd': 'descriptions', 'descriptions': ['BGYB'] * 20})
+            w.next_turn(positions)
+            for turn in range(20):
+                positions = [dict(p) for p in positions]
+                positions[turn] = {'type': 'board', 'ii': turn // 7, 'uu': turn % 7, 'r': turn % 4}
+                w.next_turn(positions)
+                w.record({'cmd': 'player_data', 'player_data': {}, 'cur_player': None})
+            w.record({'cmd': 'game_over', 'score': {'total': 7}})
+            w.close()
+
+            r = replay.ReplayReader(path)
+            self.assertEqual(len(r), 21)
+            full = [m['positions'] for m in r.messages() if m['cmd'] == 'positions']
+            for n in range(len(r)):
+                self.assertEqual(r.turn(n)[0]['positions'], full[n])
+            self.assertEqual(full[-1], positions)
+            self.assertEqual(list(r.messages(20))[-1]['cmd'], 'game_over')
+            r.close()
+
+    def test_unfinishedRoomsGetSealed(self):
+        async def run(d):
+            s, loop = serve('replays', replay_dir=d)
+            a, b, c = [await transport.connect(loop.address) for _ in range(3)]
+            await join(a, 'left')
+            await a.close()
+            await asyncio.sleep(0)
+            sealed_on_leave = s.games['left'].replay is None
+            await join(b, 'left')
+            await join(c, 'open')
+            s.close()
+            await loop.close()
+            return sealed_on_leave
+
+        with tempfile.TemporaryDirectory() as d:
+            self.assertTrue(asyncio.run(run(d)))
+            paths = sorted(os.listdir(d))
+            self.assertEqual([p.split('-')[0] for p in paths], ['left', 'left', 'open'])
+            for p in paths:
+                r = replay.ReplayReader(os.path.join(d, p))  # Has its index, even though no game ended
+                self.assertEqual(r.header[1]['cmd'], 'descriptions')
+                r.close()
+
+
+class RateLimitTests(unittest.TestCase):
+    def test_bucketRefills(self):
+        b = server.TokenBucket(rate=100.0, burst=3)
+        self.assertEqual([b.take() for _ in range(4)], [True, True, True, False])
+        self.assertGreater(b.wait_time(), 0.0)
+        time.sleep(b.wait_time() + 0.005)
+        self.assertTrue(b.take())
+
+    def test_commandsHaveSeparateBuckets(self):
+        s = server.Server(rate_limits={'curpos': (1.0, 2), '*': (1.0, 1)})
+        c = server.Client(None, None)
+        self.assertEqual([s.admit(c, 'curpos') for _ in range(3)], [True, True, False])
+        self.assertTrue(s.admit(c, 'positions'))
+        self.assertFalse(s.admit(c, 'descriptions'))  # Shares the '*' bucket with positions
+
+    def test_violationsAreForgiven(self):
+        s = server.Server(room_pool=0, max_violations=3, violation_window=0.03)
+        c = server.Client(None, None)
+        self.assertEqual([s.violate(c, 'put') for _ in range(4)], [False, False, False, True])
+        self.assertFalse(s.violate(c, 'curpos_coalesced'))
+        time.sleep(0.015)
+        self.assertFalse(s.violate(c, 'put'))  # About half of them are forgiven by now
+        self.assertEqual(c.violations, {'put': 5, 'curpos_coalesced': 1})
+
+    def test_rateMustBePositive(self):
+        self.assertEqual(server.parse_rate_limit('curpos=30:10'), ('curpos', (30.0, 10)))
+        for bad in ['put=0:5', 'put=-1:5', 'put=5:0', 'put=5']:
+            with self.assertRaises(argparse.ArgumentTypeError):
+                server.parse_rate_limit(bad)
+
+
+class RoomPoolTests(unittest.TestCase):
+    def test_finishedGamesComeBackFresh(self):
+        async def run():
+            pool = server.RoomPool(size=2)
+            pool.fill()
+            g = pool.take()
+            g.add_player('a', None)
+            idx = next(i for i, p in enumerate(g.p_positions) if p.type != 'board')
+            cell = next((i, u) for i in range(g.h) for u in range(g.w) if not g.occupied[i][u])
+            g.put_piece(idx, cell, 0, 'a')
+            pool.give_back(g)
+            while pool.refilling is not None:
+                await asyncio.sleep(0)
+            return pool, g
+
+        pool, g = asyncio.run(run())
+        self.assertEqual((pool.hits, pool.misses, len(pool.ready)), (1, 0, 2))
+        self.assertIn(g, pool.ready)
+        self.assertEqual((g.players, g.clients), ([], {}))
+        self.assertEqual(sum(map(sum, g.occupied)), g.RED_PIECES)
+        self.assertEqual(sum(p.type == 'board' for p in g.p_positions), g.RED_PIECES)
+
+
+class EventLogTests(unittest.TestCase):
+    def test_levelsSamplingAndLimits(self):
+        out = io.StringIO()
+        log = eventlog.EventLog(samples={'put': 10}, limits={'curpos': 5}, stream=out)
+        for i in range(100):
+            log.debug('positions', ' {sid} Requested positions', sid=i)
+            log.info('put', ' {sid} Put piece', sid=i)
+            log.info('curpos', ' {sid} Moved', sid=i)
+        log.close()
+        lines = out.getvalue().splitlines()
+        self.assertEqual(sum('Requested positions' in line for line in lines), 0)
+        self.assertEqual([line.split()[-3] for line in lines if 'Put piece' in line], [str(i) for i in range(0, 100, 10)])
+        self.assertEqual(sum('Moved' in line for line in lines), 5)
+
+    def test_alwaysGetsThrough(self):
+        out = io.StringIO()
+        log = eventlog.EventLog(level=eventlog.ERROR, samples={'op': 10}, limits={'*': 0}, stream=out, max_queue=0)
+        log.warn('op', 'Hidden')
+        log.always('op', 'Op token is: {token}', token=123)
+        log.close()
+        self.assertEqual([line.split(' ', 2)[2].strip() for line in out.getvalue().splitlines()], ['Op token is: 123'])
+
+
+class ChannelTests(unittest.TestCase):
+    def test_oneConnectionManyRooms(self):
+        async def run():
+            s, loop = serve('channels')
+            ws = await transport.connect(loop.address)
+            got = []
+            for ch in ['a', 'b']:
+                await send(ws, cmd='room', game_id='room_' + ch, ch=ch)
+                await read_until(ws, 'descriptions', got)
+            c = next(c for c in s.clients.values() if c.channels)
+            self.assertIs(s.open_channel(c, 'a'), c.channels['a'])
+            await send(ws, cmd='leave', ch='a')
+            got.append(await read_until(ws, 'msg'))
+            channels, room_a = list(c.channels.keys()), s.games['room_a'].clients
+            shared = c.channels['b'].buckets is c.buckets
+            await loop.close()
+            return got, channels, room_a, shared
+
+        got, channels, room_a, shared = asyncio.run(run())
+        joined = {m['ch']: m['msg'] for m in got if m['cmd'] == 'msg' and 'now in game' in m['msg']}
+        self.assertEqual(joined, {'a': 'You are now in game room_a', 'b': 'You are now in game room_b'})
+        yous = [m for m in got if m['cmd'] == 'you']
+        self.assertEqual(len({m['you'] for m in yous}), 2)
+        self.assertEqual(got[-1], {'ch': 'a', 'cmd': 'msg', 'msg': 'Left channel a', 'seq': got[-1]['seq']})
+        self.assertEqual(channels, ['b'])
+        self.assertEqual(room_a, {})
+        self.assertTrue(shared)  # Channels don't get extra rate limit
+
+
+class LobbyTests(unittest.TestCase):
+    def test_pagesFollowChanges(self):
+        games = {}
+        lobby = server.Lobby(games, tick=3600.0)
+        for i in range(25):
+            g = games[f'room{i:02}'] = server.GameServerMode()
+            for p in range(i % 3):
+                g.add_player(f'p{i}_{p}', None)
+            lobby.touch(f'room{i:02}')
+        first = lobby.page('all', 0, 10)
+        self.assertEqual((first['total'], first['pages']), (25, 3))
+        self.assertEqual([r['players'] for r in first['rooms']], [2] * 8 + [1] * 2)
+        self.assertEqual(lobby.page('empty', 0, 100)['total'], 9)
+
+        games['room00'].add_player('x', None)
+        lobby.touch('room00')
+        del games['room02']
+        lobby.touch('room02')
+        self.assertEqual(lobby.page('all', 0, 100)['total'], 25)  # Still within the tick
+        lobby.refresh()
+        self.assertEqual(lobby.page('all', 0, 100)['total'], 24)
+        self.assertEqual(lobby.page('empty', 0, 100)['total'], 8)
+        self.assertEqual(lobby.page('playing', 0, 8)['rooms'][7]['game_id'], 'room00')  # After the 7 rooms of two
+
+
+class ProfileTests(unittest.TestCase):
+    def test_profileIsOpOnly(self):
+        async def run():
+            s, loop = serve('profiles', profile_dir=tempfile.mkdtemp(), rate_limits=UNLIMITED)
+            ws = await transport.connect(loop.address)
+            await send(ws, cmd='profile', mode='cpu', seconds=0.01)
+            refused = await read_until(ws, 'msg')
+            await send(ws, cmd='op', token=s.op_token)
+            await read_until(ws, 'op')
+            reports, busy = [], []
+            for mode, to_file in [('cpu', False), ('memory', True)]:
+                await send(ws, cmd='profile', mode=mode, seconds=0.05, file=to_file)
+                await read_until(ws, 'msg')  # Taking a profile
+                await send(ws, cmd='profile', mode=mode, seconds=0.05)  # One at a time
+                busy.append((await read_until(ws, 'msg'))['msg'])
+                reports.append(await read_until(ws, 'profile'))
+            await loop.close()
+            return refused, busy, reports
+
+        refused, busy, (cpu, memory) = asyncio.run(run())
+        self.assertEqual(refused['msg'], 'Erroneous command')
+        self.assertEqual(busy, ['Erroneous command'] * 2)
+        self.assertIn('function calls', cpu['report'])
+        with open(memory['path']) as f:
+            self.assertIn('Grew the most', f.read())
+
+
+class ProbeTests(unittest.TestCase):
+    def test_repliesMatchCommands(self):
+        async def run():
+            p = console_client.Probe(transport.loopback_pair()[0])  # Nobody reads the other end, nothing needs to
+            for cmd in [['room', 'a'], ['put', '0', '9', '9', '0'], ['ping'], ['ping'], ['positions']]:
+                await p.cmd(cmd)
+            await p.process_message({'cmd': 'msg', 'msg': 'You are now in game a', 'id': 1})
+            await p.process_message({'cmd': 'positions', 'positions': [], 'id': 5})  # Not in order
+            await p.process_message({'cmd': 'positions', 'positions': [], 'id': 1})
+            await p.process_message({'cmd': 'msg', 'msg': 'Erroneous command', 'yours': {'cmd': 'put', 'id': 2}})
+            await p.process_message({'cmd': 'pong', 'id': 4})
+            await p.process_message({'cmd': 'positions', 'positions': []})  # Somebody else's move
+            return p
+
+        p = asyncio.run(run())
+        self.assertEqual({cmd: len(rtts) for cmd, rtts in p.rtts.items()}, {'positions': 1, 'room': 1, 'ping': 1})
+        self.assertEqual(p.failed, {'put': 1})
+        self.assertEqual(list(p.pending.keys()), [3])  # First ping never got its pong
+        self.assertFalse(p.summary())
+
+    def test_serverEchoesIds(self):
+        async def run():
+            s, loop = serve('ids', rate_limits=UNLIMITED)
+            a, b = await transport.connect(loop.address), await transport.connect(loop.address)
+            got_a, got_b = [], []
+            await send(a, cmd='room', game_id='r', id=7)
+            positions = (await read_until(a, 'positions', got_a))['positions']
+            await read_until(a, 'descriptions', got_a)
+            await send(b, cmd='room', game_id='r', id=1)
+            await read_until(b, 'descriptions', [])
+            idx = next(i for i, p in enumerate(positions) if p['type'] != 'board')
+            cell = next((i, u) for i in range(5) for u in range(7) if not s.games['r'].occupied[i][u])
+            await send(a, cmd='put', idx=idx, pos=cell, rot=0, id=8)
+            await read_until(a, 'positions', got_a)
+            await read_until(b, 'positions', got_b)
+            await loop.close()
+            return got_a, got_b
+
+        got_a, got_b = asyncio.run(run())
+        self.assertEqual([(m['cmd'], m.get('id')) for m in got_a if 'seq' in m],
+                         [('msg', 7), ('you', 7), ('positions', 7), ('descriptions', 7), ('msg', 8), ('positions', 8)])
+        self.assertNotIn('id', got_b[-1])  # A's move, not a reply to anything B asked
+
+
+class SpectatorTests(unittest.TestCase):
+    def test_framesAreCoalescedAndPutIsRefused(self):
+        async def run():
+            s, loop = serve('spectators', spectator_fps=20.0, rate_limits=UNLIMITED, lobby_tick=0.0)
+            player, watcher = await transport.connect(loop.address), await transport.connect(loop.address)
+            await join(player, 'r')
+            seen = []
+            await send(watcher, cmd='spectate', game_id='r')
+            await read_until(watcher, 'frame', seen)
+
+            for x in range(50):  # A lot faster than 20 fps
+                await send(player, cmd='curpos', curpos=[x, x])
+            await asyncio.sleep(0.2)
+            await send(watcher, cmd='put', idx=0, pos=[0, 0], rot=0)
+            await read_until(watcher, 'msg', seen)
+            await send(watcher, cmd='lobby')
+            lobby = await read_until(watcher, 'lobby', seen)
+            placed = s.games['r'].placed - s.games['r'].red
+            await loop.close()
+            return seen, lobby, placed
+
+        seen, lobby, placed = asyncio.run(run())
+        frames = [m for m in seen if m['cmd'] == 'frame']
+        self.assertLess(len(frames), 10)  # 50 cursor moves, but at most 20 frames a second
+        self.assertEqual(list(frames[-1]['player_data'].values())[0]['curpos'], [49, 49])  # The latest wins
+        self.assertNotIn('positions', [m['cmd'] for m in seen])  # Frames are all spectators get
+        self.assertEqual(seen[-2]['msg'], 'Erroneous command')
+        self.assertEqual(seen[-2]['yours']['cmd'], 'put')
+        self.assertEqual(placed, 0)
+        self.assertEqual([(r['players'], r['spectators']) for r in lobby['rooms']], [(1, 1)])
+
+    def test_watchersCanMoveOn(self):
+        async def run():
+            s, loop = serve('unwatch')
+            player, a, b = [await transport.connect(loop.address) for _ in range(3)]
+            await join(player, 'r')
+            for ws in [a, b]:
+                await send(ws, cmd='spectate', game_id='r')
+                await read_until(ws, 'frame')
+            await send(a, cmd='unwatch')
+            await send(a, cmd='spectate', game_id='r')  # Watching again is fine
+            await read_until(a, 'frame')
+            await send(a, cmd='unwatch')
+            await join(a, 'other')
+            await join(b, 'other')  # Stops watching on its own
+            spectators = dict(s.games['r'].spectators)
+            watching = [c.watching for c in s.clients.values()]
+            await send(b, cmd='spectate', game_id='r')
+            refused = await read_until(b, 'msg')
+            await loop.close()
+            return spectators, watching, refused
+
+        spectators, watching, refused = asyncio.run(run())
+        self.assertEqual(spectators, {})
+        self.assertEqual(watching, [None, None, None])
+        self.assertEqual(refused['msg'], 'You are playing in game other, leave it to watch another')
+
+
+class ConsoleTests(unittest.TestCase):
+    def test_violationsGetPrinted(self):
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            c = console_client.Client(None)
+            asyncio.run(c.process_message({'cmd': 'violations', 'violations': {'abc': {'put': 3, 'curpos': 1}}}))
+        self.assertEqual(out.getvalue().strip(), 'abc: curpos 1, put 3')
+
+
+class TransportTests(unittest.TestCase):
+    def test_loopbackRunsTheServer(self):
+        async def run():
+            s, loop = serve('tests')
+            got = []
+            async with transport.connect(loop.address) as ws:
+                await join(ws, 'r', got)
+            await asyncio.sleep(0)
+            clients = dict(s.clients)
+            await loop.close()
+            return got, clients
+
+        got, clients = asyncio.run(run())
+        self.assertEqual(got[0], {'cmd': 'version', 'version': server.GAME_VERSION})
+        self.assertIn('You are now in game r', [m.get('msg') for m in got])
+        self.assertEqual(clients, {})  # Closing the loopback is a disconnect like any other
+
+    def test_backpressure(self):
+        async def run():
+            a, b = transport.loopback_pair(max_queue=2)
+            sender = asyncio.ensure_future(asyncio.gather(*[a.send(str(n)) for n in range(5)]))
+            for _ in range(10):
+                await asyncio.sleep(0)
+            stuck = not sender.done()
+            got = [await b.recv() for _ in range(5)]
+            await sender
+            await a.close()
+            return stuck, got
+
+        stuck, got = asyncio.run(run())
+        self.assertTrue(stuck)
+        self.assertEqual(got, ['0', '1', '2', '3', '4'])
+
+
+class ResumeTests(unittest.TestCase):
+    def test_onlyMissedMessagesReplayed(self):
+        async def put_any(ws, positions):
+            idx = next(i for i, p in enumerate(positions) if p['type'] != 'board')
+            taken = {(p['ii'], p['uu']) for p in positions if p['type'] == 'board'}
+            cell = next((i, u) for i in range(5) for u in range(7) if (i, u) not in taken)
+            await send(ws, cmd='put', idx=idx, pos=cell, rot=0)
+
+        async def run():
+            s, loop = serve('resume', grace=30.0, rate_limits=UNLIMITED)
+            a, b = await transport.connect(loop.address), await transport.connect(loop.address)
+            seen = []
+            await send(a, cmd='room', game_id='r')
+            token = (await read_until(a, 'you', seen))['token']
+            positions = (await read_until(a, 'positions', seen))['positions']
+            await join(b, 'r')
+            await put_any(a, positions)
+            positions = (await read_until(a, 'positions', seen))['positions']
+            ack = max(m.get('seq', 0) for m in seen)
+            await a.close()
+            await asyncio.sleep(0)
+
+            for x in range(512):  # Several times what the outbox holds, if cursors went into it
+                await send(b, cmd='curpos', curpos=[x, x])
+            await put_any(b, positions)
+            await read_until(b, 'positions')
+            while s.clients[s.sessions[token]].seq == ack:
+                await asyncio.sleep(0)
+
+            a = await transport.connect(loop.address)
+            await send(a, cmd='resume', token=token, ack=ack)
+            after = []
+            await read_until(a, 'player_data', after)
+            await loop.close()
+            return ack, after
+
+        ack, after = asyncio.run(run())
+        self.assertEqual([m['cmd'] for m in after], ['version', 'positions', 'resumed', 'player_data'])
+        self.assertEqual(after[1]['seq'], ack + 1)  # Just B's move, nothing from before the drop
+        self.assertEqual(after[2]['replayed'], 1)
+        self.assertNotIn('seq', after[3])
+        self.assertEqual(after[3]['player_data'][after[2]['you']]['curpos'], None)
+        self.assertEqual([p['curpos'] for p in after[3]['player_data'].values()].count([511, 511]), 1)
+
+    def test_outboxIsBoundedByBytes(self):
+        async def run():
+            c = server.Client(None, None)
+            await c.send_stuff({'cmd': 'msg', 'msg': 'Before the seat'})
+            c.game = 'r'
+            for _ in range(100):
+                await c.send_stuff({'cmd': 'descriptions', 'descriptions': ['BGYB'] * 400})
+            kept = (len(c.outbox), c.outbox_bytes, c.missed_since(c.seq - 1), c.missed_since(0))
+            c.game = None
+            await c.send_stuff({'cmd': 'game_over'})
+            return kept, len(c.outbox), c.outbox_bytes
+
+        (n, size, last, everything), n_after, size_after = asyncio.run(run())
+        self.assertLessEqual(size, server.Client.OUTBOX_BYTES)
+        self.assertGreater(size, server.Client.OUTBOX_BYTES - size / n)  # As full as it gets
+        self.assertEqual(len(last), 1)
+        self.assertIsNone(everything)
+        self.assertEqual((n_after, size_after), (0, 0))
+
+    def test_seatExpires(self):
+        async def run():
+            s, loop = serve('expire', grace=0.05)
+            a = await transport.connect(loop.address)
+            await send(a, cmd='room', game_id='r')
+            msg = await read_until(a, 'you')
+            await a.close()
+            await asyncio.sleep(0.01)
+            held = msg['you'] in s.games['r'].clients
+            await asyncio.sleep(0.1)
+            a = await transport.connect(loop.address)
+            await send(a, cmd='resume', token=msg['token'], ack=msg['seq'])
+            reply = await read_until(a, 'resumed')
+            await loop.close()
+            return held, s.games['r'].players, reply
+
+        held, players, reply = asyncio.run(run())
+        self.assertTrue(held)
+        self.assertEqual(players, [])
+        self.assertFalse(reply['ok'])
+
 
 if __name__ == '__main__':
     unittest.main()
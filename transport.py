@@ -0,0 +1,166 @@
+# Where messages travel. Normally websockets, but the server and the clients only need
+# send(), recv(), async for, close() and broadcast(), so they can also talk through an in-memory loopback:
+# one process, no ports, no sockets, same code path from parse to fan-out. bench_server.py uses it.
+# Addresses like 'loop:name' go to the LoopbackServer registered under that name, everything else is ws://.
+import asyncio
+
+import websockets
+from websockets.exceptions import ConnectionClosedError, ConnectionClosedOK
+from websockets.frames import Close
+
+LOOP_PREFIX = 'loop:'
+_servers: dict[str, 'LoopbackServer'] = {}
+
+_CLOSED = object()
+
+
+class LoopbackSocket:
+    """One end of an in-memory connection. Messages are handed over as they are, nothing is copied or encoded."""
+    def __init__(self, max_queue=None):
+        self.peer: LoopbackSocket | None = None
+        self.inbox: asyncio.Queue = asyncio.Queue()
+        self.max_queue = max_queue  # Like websockets, stop taking messages from the peer when this many wait
+        self.drained = asyncio.Event()  # Set when recv() makes room in a full inbox, or on close
+        self.close_code = None
+        self.close_reason = ''
+        self.remote_address = ('loopback', 0)
+
+    def closed_error(self):
+        close = Close(self.close_code, self.close_reason)
+        if self.close_code in (1000, 1001):
+            return ConnectionClosedOK(close, close, True)
+        return ConnectionClosedError(close, close, True)
+
+    def send_nowait(self, raw):
+        if self.close_code is not None:
+            raise self.closed_error()
+        self.peer.inbox.put_nowait(raw)
+
+    async def send(self, raw):
+        self.send_nowait(raw)
+        if self.peer.max_queue is not None and self.peer.inbox.qsize() >= self.peer.max_queue:
+            await self.peer.wait_drained()  # Backpressure, the same way a full TCP window does it
+        else:
+            await asyncio.sleep(0)  # A real send yields too, keeps one chatty client from starving the rest
+
+    async def wait_drained(self):
+        while self.inbox.qsize() >= self.max_queue and self.close_code is None:
+            self.drained.clear()
+            await self.drained.wait()
+
+    async def recv(self):
+        if self.close_code is not None and self.inbox.empty():
+            raise self.closed_error()
+        raw = await self.inbox.get()
+        if self.max_queue is not None and self.inbox.qsize() < self.max_queue:
+            self.drained.set()
+        if raw is _CLOSED:
+            self.inbox.put_nowait(_CLOSED)  # Anyone else waiting gets it too
+            raise self.closed_error()
+        return raw
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self.recv()
+        except ConnectionClosedOK:
+            raise StopAsyncIteration
+
+    async def close(self, code=1000, reason=''):
+        for end in [self, self.peer]:
+            if end.close_code is None:
+                end.close_code, end.close_reason = code, reason
+                end.inbox.put_nowait(_CLOSED)
+                end.drained.set()  # Nobody is going to read it anymore
+        await asyncio.sleep(0)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+
+def loopback_pair(max_queue=None):
+    """(client end, server end)."""
+    a, b = LoopbackSocket(max_queue), LoopbackSocket(max_queue)
+    a.peer, b.peer = b, a
+    return a, b
+
+
+class LoopbackServer:
+    """Stands in for websockets.serve. Every connect() runs handler(server end) as a task, like a new connection."""
+    def __init__(self, handler, name='default', max_queue=16):
+        self.handler = handler
+        self.name = name
+        self.max_queue = max_queue
+        self.tasks: dict[asyncio.Task, LoopbackSocket] = {}  # Handler -> the server end it got
+        _servers[name] = self
+
+    @property
+    def address(self):
+        return LOOP_PREFIX + self.name
+
+    def connect(self):
+        client, server = loopback_pair()
+        server.max_queue = self.max_queue
+        task = asyncio.ensure_future(self.handler(server))
+        self.tasks[task] = server
+        task.add_done_callback(lambda t: self.tasks.pop(t, None))
+        return client
+
+    async def close(self, timeout=1.0):
+        """Like websockets' server: every connection gets 1001 Going away, handlers get to finish up."""
+        _servers.pop(self.name, None)
+        for socket in list(self.tasks.values()):
+            await socket.close(1001, 'Going away')
+        if self.tasks:
+            _, late = await asyncio.wait(list(self.tasks), timeout=timeout)
+            for task in late:
+                task.cancel()
+
+
+class _LoopbackConnect:
+    """What connect() gives for loop: addresses. Awaitable, or an async context manager, like websockets.connect."""
+    def __init__(self, name):
+        self.name = name
+        self.socket = None
+
+    async def _connect(self):
+        if self.name not in _servers:
+            raise ConnectionRefusedError(f'No loopback server called {self.name}')
+        self.socket = _servers[self.name].connect()
+        return self.socket
+
+    def __await__(self):
+        return self._connect().__await__()
+
+    async def __aenter__(self):
+        return await self._connect()
+
+    async def __aexit__(self, *exc):
+        await self.socket.close()
+
+
+def connect(where, **kwargs):
+    """where is host:port, or loop:name. kwargs go to websockets.connect."""
+    if where.startswith(LOOP_PREFIX):
+        return _LoopbackConnect(where[len(LOOP_PREFIX):])
+    return websockets.connect(f'ws://{where}', **kwargs)
+
+
+def broadcast(sockets, raw):
+    """Sends raw to every socket without waiting for any of them. Mixed loopback and real ones are fine."""
+    real = []
+    for ws in sockets:
+        if isinstance(ws, LoopbackSocket):
+            try:
+                ws.send_nowait(raw)
+            except (ConnectionClosedOK, ConnectionClosedError):
+                pass  # Same as websockets.broadcast: the closed ones are skipped
+        else:
+            real.append(ws)
+    if real:
+        websockets.broadcast(real, raw)